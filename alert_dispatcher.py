@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class AlertDispatcher:
+    '''Delivers alerts from a bounded queue on background worker threads
+
+    Request handlers call enqueue, which only puts the alert on a queue
+    and returns, so a slow or unreachable alert service no longer holds up
+    the request. Worker threads take alerts off the queue and pass them to
+    the deliver function.
+
+    deliver is called with the alert and should return True when the alert
+    was delivered and False when the alert service rejected it (which is
+    not retried). Any exception is treated as a transient failure and the
+    delivery is retried up to retries more times, waiting backoff,
+    2 * backoff, 4 * backoff, ... seconds between attempts.
+
+    :param deliver: function taking an alert and returning True or False
+    :param maxsize: int maximum number of alerts waiting in the queue
+    :param workers: int number of worker threads
+    :param retries: int number of retries after a failed delivery
+    :param backoff: float seconds to wait before the first retry
+    '''
+
+    def __init__(self, deliver, maxsize=1000, workers=2, retries=3,
+                 backoff=0.5):
+        self.deliver = deliver
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self._queue = queue.Queue(maxsize)
+        self._threads = list()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._counts = {"queued": 0, "sent": 0, "failed": 0, "retried": 0,
+                        "dropped": 0}
+        self._total_latency = 0.0
+        self._last_latency = None
+
+    def start(self):
+        '''Starts the worker threads if they are not already running'''
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name="alert-worker-{}".format(i))
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        '''Stops the worker threads once the queued alerts are handled
+
+        Queued alerts still get their first delivery attempt, but alerts
+        waiting to be retried are given up on and counted as failed, so
+        stopping is not held up by the backoff.
+
+        :param timeout: float seconds to wait for each worker, None to wait
+                        until they finish
+        '''
+        with self._lock:
+            threads = self._threads
+            self._threads = list()
+        if threads:
+            self._stopping.set()
+        for thread in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def enqueue(self, alert):
+        '''Puts an alert on the queue without waiting for delivery
+
+        The worker threads are started on the first call.
+
+        :param alert: object passed on to the deliver function
+        :return: True if the alert was queued, False if the queue is full
+        '''
+        self.start()
+        try:
+            self._queue.put_nowait((time.monotonic(), alert))
+        except queue.Full:
+            self._count("dropped")
+            logging.warning("Alert queue full, alert dropped")
+            return False
+        self._count("queued")
+        return True
+
+    def join(self):
+        '''Waits until every queued alert has been handled'''
+        self._queue.join()
+
+    def stats(self):
+        '''Returns the queue depth, delivery counts and latencies
+
+        :return: dictionary with queue_depth, queued, sent, failed, retried,
+                 dropped, average_latency and last_latency (in seconds)
+        '''
+        with self._lock:
+            stats = dict(self._counts)
+            stats["queue_depth"] = self._queue.qsize()
+            stats["average_latency"] = None
+            if stats["sent"]:
+                stats["average_latency"] = self._total_latency / stats["sent"]
+            stats["last_latency"] = self._last_latency
+        return stats
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._handle(*item)
+            finally:
+                self._queue.task_done()
+
+    def _handle(self, queued_at, alert):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                if self._stopping.wait(self.backoff * 2 ** (attempt - 1)):
+                    break
+                self._count("retried")
+            try:
+                delivered = self.deliver(alert)
+            except Exception as e:
+                logging.warning("Alert delivery failed: {}".format(e))
+                continue
+            if not delivered:
+                break
+            self._record_sent(queued_at)
+            return
+        self._count("failed")
+
+    def _record_sent(self, queued_at):
+        latency = time.monotonic() - queued_at
+        with self._lock:
+            self._counts["sent"] += 1
+            self._total_latency += latency
+            self._last_latency = latency
+
+
+class AsyncAlertDispatcher(AlertDispatcher):
+    '''Delivers alerts from a bounded queue on asyncio worker tasks
+
+    This works like AlertDispatcher, with the same counts and stats, but
+    deliver is a coroutine function and the workers are tasks on the
+    running event loop, so alerts waiting on a slow alert service hold no
+    threads. enqueue may also be called from other threads, such as
+    helpers run on the loop's executor, once start has been called on the
+    loop; the alert is then handed over to the loop.
+
+    :param deliver: coroutine function taking an alert and returning True
+                    or False
+    :param maxsize: int maximum number of alerts waiting in the queue
+    :param workers: int number of worker tasks
+    :param retries: int number of retries after a failed delivery
+    :param backoff: float seconds to wait before the first retry
+    '''
+
+    def __init__(self, deliver, maxsize=1000, workers=2, retries=3,
+                 backoff=0.5):
+        super().__init__(deliver, maxsize, workers, retries, backoff)
+        self._queue = asyncio.Queue(maxsize)
+        self._tasks = list()
+        self._loop = None
+
+    def start(self):
+        '''Starts the worker tasks if they are not already running
+
+        Must be called from the event loop, which later calls to enqueue
+        from other threads hand their alerts to.
+        '''
+        if not self._tasks:
+            self._loop = asyncio.get_running_loop()
+            self._tasks = [self._loop.create_task(self._work())
+                           for i in range(self.workers)]
+
+    async def stop(self):
+        '''Stops the worker tasks once the queued alerts are handled'''
+        tasks, self._tasks = self._tasks, list()
+        self._loop = None
+        if tasks:
+            await self._queue.join()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def enqueue(self, alert):
+        '''Puts an alert on the queue without waiting for delivery
+
+        The worker tasks are started on the first call. Called from a
+        thread other than the event loop's, the alert is passed to the loop
+        with call_soon_threadsafe and True is returned straight away; if
+        the queue turns out to be full it is counted as dropped.
+
+        :param alert: object passed on to the deliver function
+        :return: True if the alert was queued, False if the queue is full
+        '''
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is not None and running is not self._loop:
+            self._loop.call_soon_threadsafe(self._put, time.monotonic(),
+                                            alert)
+            return True
+        self.start()
+        return self._put(time.monotonic(), alert)
+
+    def _put(self, queued_at, alert):
+        try:
+            self._queue.put_nowait((queued_at, alert))
+        except asyncio.QueueFull:
+            self._count("dropped")
+            logging.warning("Alert queue full, alert dropped")
+            return False
+        self._count("queued")
+        return True
+
+    async def join(self):
+        '''Waits until every queued alert has been handled'''
+        await self._queue.join()
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._handle(*item)
+            finally:
+                self._queue.task_done()
+
+    async def _handle(self, queued_at, alert):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retried")
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                delivered = await self.deliver(alert)
+            except Exception as e:
+                logging.warning("Alert delivery failed: {}".format(e))
+                continue
+            if not delivered:
+                break
+            self._record_sent(queued_at)
+            return
+        self._count("failed")
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import time
+
+import aiohttp
+
+
+def serve_flask(port):
+    '''Runs heart_rate_server.app on the threaded Werkzeug server
+
+    :param port: int port to listen on
+    '''
+    import logging
+    from werkzeug.serving import make_server
+    import heart_rate_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", port, heart_rate_server.app,
+                         threaded=True)
+    server.request_queue_size = 4096
+    server.serve_forever()
+
+
+def serve_aiohttp(port):
+    '''Runs the heart_rate_async app
+
+    :param port: int port to listen on
+    '''
+    from aiohttp import web
+    from heart_rate_async import create_app
+    web.run_app(create_app(), host="127.0.0.1", port=port, backlog=4096,
+                print=None, access_log=None)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_up(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url + "/api/alerts/stats") as r:
+                await r.read()
+                return
+        except aiohttp.ClientError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def drive(url, patients, concurrency, requests_per_client, idle):
+    '''Posts heart rates from concurrent clients and times each request
+
+    :param url: str base URL of the server
+    :param patients: int number of patients the readings are spread over
+    :param concurrency: int number of clients posting at the same time
+    :param requests_per_client: int number of readings each client posts
+    :param idle: int number of dashboards holding an event stream open
+    :return: float seconds taken and list of float request latencies
+    '''
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_until_up(session, url)
+        await session.post(url + "/api/new_attending", json={
+            "attending_username": "Bench.B",
+            "attending_email": "bench@example.com",
+            "attending_phone": "919-200-8973"})
+        for patient_id in range(patients):
+            await session.post(url + "/api/new_patient", json={
+                "patient_id": patient_id, "patient_age": 50,
+                "attending_username": "Bench.B"})
+        streams = list()
+        for i in range(idle):
+            streams.append(await session.get(
+                url + "/api/patients/Bench.B/events"))
+        latencies = list()
+
+        async def client(number):
+            for i in range(requests_per_client):
+                reading = {"patient_id": (number + i) % patients,
+                           "heart_rate": 60 + i % 40}
+                start = time.perf_counter()
+                async with session.post(url + "/api/heart_rate",
+                                        json=reading) as r:
+                    await r.read()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        for stream in streams:
+            stream.close()
+    return elapsed, latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares heart rate ingestion throughput and latency "
+                    "of the Flask and asyncio servers")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=20000,
+                        help="readings posted per run")
+    parser.add_argument("--idle", type=int, default=0,
+                        help="event streams held open during each run")
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")
+    print("{:>8} {:>12} {:>10} {:>10} {:>10}".format(
+        "server", "concurrency", "req/s", "p50 (ms)", "p99 (ms)"))
+    for name, target in (("flask", serve_flask), ("asyncio", serve_aiohttp)):
+        for concurrency in args.concurrency:
+            port = free_port()
+            process = context.Process(target=target, args=(port,),
+                                      daemon=True)
+            process.start()
+            try:
+                elapsed, latencies = asyncio.run(drive(
+                    "http://127.0.0.1:{}".format(port), args.patients,
+                    concurrency, max(1, args.requests // concurrency),
+                    args.idle))
+            finally:
+                process.terminate()
+                process.join()
+            print("{:>8} {:>12} {:>10.0f} {:>10.2f} {:>10.2f}".format(
+                name, concurrency, len(latencies) / elapsed,
+                1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.99)))
+
+
+if __name__ == '__main__':
+    main()
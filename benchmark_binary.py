@@ -0,0 +1,99 @@
+import argparse
+import json
+import random
+import time
+
+import heart_rate_server as server
+from binary_ingest import MIME_TYPE, SERVER_TIME, pack_records, send_records
+from heart_rate_database import PatientStore, AttendantRegistry
+
+
+def fresh_store(patients):
+    '''Replaces the databases with empty patients and no email server
+
+    :param patients: int number of patients
+    '''
+    server.patient_db = PatientStore()
+    server.attendant_db = AttendantRegistry()
+    server.alert_dispatcher = server.AlertDispatcher(lambda email: True)
+    for patient_id in range(patients):
+        server.add_patient_to_db([patient_id, "Bench.B", 30])
+
+
+def make_readings(patients, count, seed=1):
+    rng = random.Random(seed)
+    return [(rng.randrange(patients), rng.randrange(50, 180), SERVER_TIME)
+            for _ in range(count)]
+
+
+def json_batch(readings):
+    return json.dumps([{"patient_id": patient_id, "heart_rate": rate}
+                       for patient_id, rate, _ in readings]).encode()
+
+
+def json_lines(readings):
+    return b"".join(json.dumps({"patient_id": patient_id,
+                                "heart_rate": rate}).encode() + b"\n"
+                    for patient_id, rate, _ in readings)
+
+
+def time_uploads(send, bodies):
+    '''Times sending every body once
+
+    :param send: function sending one body
+    :param bodies: list of bytes bodies
+    :return: float seconds taken
+    '''
+    start = time.perf_counter()
+    for body in bodies:
+        send(body)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares heart rate ingestion over JSON and over "
+                    "packed binary records")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--readings", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="readings per request or connection")
+    args = parser.parse_args()
+    readings = make_readings(args.patients, args.readings)
+    batches = [readings[i:i + args.batch]
+               for i in range(0, len(readings), args.batch)]
+    client = server.app.test_client()
+    listener = server.open_binary_listener(port=0)
+    port = listener.server_address[1]
+
+    def post(path, content_type):
+        return lambda body: client.post(path, data=body,
+                                        content_type=content_type).data
+
+    paths = [("JSON batch", json_batch,
+              post("/api/heart_rate/batch", "application/json")),
+             ("NDJSON stream", json_lines,
+              post("/api/heart_rate/stream", "application/x-ndjson")),
+             ("binary POST", pack_records,
+              post("/api/heart_rate/binary", MIME_TYPE)),
+             ("binary TCP", pack_records,
+              lambda body: send_records("127.0.0.1", port, body))]
+    print("{:>14} {:>12} {:>14} {:>10}".format(
+        "path", "bytes/read", "readings/s", "speedup"))
+    baseline = None
+    for label, encode, send in paths:
+        bodies = [encode(batch) for batch in batches]
+        fresh_store(args.patients)
+        seconds = time_uploads(send, bodies)
+        assert sum(len(server.patient_db.get(patient_id)["series"])
+                   for patient_id in range(args.patients)) == len(readings)
+        rate = len(readings) / seconds
+        baseline = baseline or rate
+        print("{:>14} {:>12.1f} {:>14.0f} {:>9.1f}x".format(
+            label, sum(map(len, bodies)) / len(readings), rate,
+            rate / baseline))
+    listener.shutdown()
+
+
+if __name__ == '__main__':
+    main()
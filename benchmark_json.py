@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import heart_rate_server as server
+from heart_rate_database import PatientStore, AttendantRegistry
+from json_codec import available_codecs
+
+
+def fill_store(patients, readings):
+    '''Fills fresh databases with patients of one attending physician
+
+    :param patients: int number of patients
+    :param readings: int number of heart rates per patient
+    '''
+    server.patient_db = PatientStore()
+    server.attendant_db = AttendantRegistry()
+    server.alert_dispatcher = server.AlertDispatcher(lambda email: True)
+    server.add_attendant_to_db(["Bench.B", "bench@duke.edu",
+                                "919-200-8973"], server.attendant_db)
+    times = [1520593236000 + 1000 * i for i in range(readings)]
+    for patient_id in range(patients):
+        server.add_patient_to_attendant_db([patient_id, "Bench.B", 30],
+                                           server.attendant_db)
+        server.add_patient_to_db([patient_id, "Bench.B", 30])
+        server.add_heart_rates_to_patient_db(
+            patient_id, [60 + (7 * i + patient_id) % 80
+                         for i in range(readings)], times)
+
+
+def routes(readings):
+    '''Lists the GET requests to time
+
+    :param readings: int number of heart rates per patient
+    :return: list of (str label, str URL) pairs
+    '''
+    page = min(readings, server.HISTORY_PAGE)
+    return [("heart rate list", "/api/heart_rate/0"),
+            ("history page", "/api/heart_rate/0?limit={}".format(page)),
+            ("history ndjson",
+             "/api/heart_rate/0?format=ndjson&limit={}".format(page)),
+            ("roster", "/api/patients/Bench.B"),
+            ("status", "/api/status/0"),
+            ("summary", "/api/heart_rate/summary/0")]
+
+
+def time_route(client, url, number):
+    '''Times GET requests to one URL through the Flask test client
+
+    :param client: Flask test client
+    :param url: str URL to request
+    :param number: int number of requests
+    :return: float seconds per request and bytes of the last response
+    '''
+    body = client.get(url).data
+    start = time.perf_counter()
+    for _ in range(number):
+        client.get(url).data
+    return (time.perf_counter() - start) / number, body
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the GET routes with each JSON codec")
+    parser.add_argument("--patients", type=int, default=200)
+    parser.add_argument("--readings", type=int, default=20000)
+    parser.add_argument("--number", type=int, default=50)
+    args = parser.parse_args()
+    fill_store(args.patients, args.readings)
+    client = server.app.test_client()
+    codecs = available_codecs()[::-1]
+    results = dict()
+    for name in codecs:
+        server.set_json_codec(name)
+        for label, url in routes(args.readings):
+            results[label, name] = time_route(client, url, args.number)
+    print("{:>16} ".format("route") +
+          " ".join("{:>12}".format(name + " (ms)") for name in codecs) +
+          " {:>8}".format("speedup"))
+    for label, url in routes(args.readings):
+        seconds = [results[label, name][0] for name in codecs]
+        bodies = {results[label, name][1] for name in codecs}
+        assert len(bodies) == 1, "codecs disagree on " + url
+        print("{:>16} ".format(label) +
+              " ".join("{:>12.3f}".format(1e3 * s) for s in seconds) +
+              " {:>7.1f}x".format(seconds[0] / seconds[-1]))
+
+
+if __name__ == '__main__':
+    main()
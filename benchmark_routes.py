@@ -0,0 +1,304 @@
+import argparse
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from itertools import count
+
+import heart_rate_server as server
+from binary_ingest import MIME_TYPE, SERVER_TIME, pack_records
+from heart_rate_database import PatientStore, AttendantRegistry
+from heart_rate_series import format_epoch_ms
+
+BASELINE = "benchmark_routes_baseline.json"
+FIRST_TIME = 1520593236000
+BATCH = 100
+
+
+def fill_store(patients, readings, attendants):
+    '''Replaces the databases with a store of the given size
+
+    Patients are spread evenly over the attendants and every patient gets
+    the same number of readings, one second apart, so that the total is
+    patients * readings. Alerts are delivered to nowhere.
+
+    :param patients: int number of patients
+    :param readings: int number of heart rates per patient
+    :param attendants: int number of attending physicians
+    :return: list of str attending usernames
+    '''
+    server.patient_db = PatientStore()
+    server.attendant_db = AttendantRegistry()
+    server.alert_dispatcher = server.AlertDispatcher(lambda email: True)
+    usernames = ["Bench.{}".format(i) for i in range(attendants)]
+    for username in usernames:
+        server.add_attendant_to_db([username, username + "@duke.edu",
+                                    "919-200-8973"], server.attendant_db)
+    times = [FIRST_TIME + 1000 * i for i in range(readings)]
+    for patient_id in range(patients):
+        username = usernames[patient_id % attendants]
+        server.add_patient_to_attendant_db([patient_id, username, 40],
+                                           server.attendant_db)
+        server.add_patient_to_db([patient_id, username, 40])
+        server.add_heart_rates_to_patient_db(
+            patient_id, [60 + (7 * i + patient_id) % 60
+                         for i in range(readings)], times)
+    return usernames
+
+
+def first_event(client, url):
+    '''Reads the roster event of an event stream and closes it'''
+    response = client.get(url, buffered=False)
+    chunk = next(iter(response.response))
+    response.close()
+    return chunk
+
+
+def make_cases(patients, readings, usernames, seed=1):
+    '''Builds the operations to time
+
+    Each case is a function doing one call with arguments picked at random
+    from the store, so calls spread over patients and attendants.
+
+    :param patients: int number of patients in the store
+    :param readings: int number of heart rates per patient
+    :param usernames: list of str attending usernames
+    :param seed: int seed of the random choices
+    :return: list of (str name, function) pairs
+    '''
+    rng = random.Random(seed)
+    client = server.app.test_client()
+    new_ids = count(patients)
+    new_names = count()
+    page = min(readings, 100)
+
+    def patient():
+        return rng.randrange(patients)
+
+    def username():
+        return rng.choice(usernames)
+
+    def since():
+        return format_epoch_ms(FIRST_TIME + 1000 * rng.randrange(readings))
+
+    def etagged(url):
+        etag = client.get(url).headers["ETag"]
+        return lambda: client.get(url, headers={"If-None-Match": etag})
+
+    def readings_batch():
+        return [{"patient_id": patient(), "heart_rate": rng.randrange(50, 180)}
+                for _ in range(BATCH)]
+
+    roster_ids = server.get_patient_id_list(usernames[0])
+    status_304 = etagged("/api/status/0")
+    roster_304 = etagged("/api/patients/" + usernames[0])
+    return [
+        ("GET heart_rate list",
+         lambda: client.get("/api/heart_rate/{}".format(patient()))),
+        ("GET heart_rate page",
+         lambda: client.get("/api/heart_rate/{}?limit={}".format(
+             patient(), page))),
+        ("GET heart_rate ndjson",
+         lambda: client.get("/api/heart_rate/{}?format=ndjson&limit={}"
+                            .format(patient(), page)).data),
+        ("GET average",
+         lambda: client.get("/api/heart_rate/average/{}".format(patient()))),
+        ("GET summary",
+         lambda: client.get("/api/heart_rate/summary/{}".format(patient()))),
+        ("GET status",
+         lambda: client.get("/api/status/{}".format(patient()))),
+        ("GET status 304", status_304),
+        ("GET patients",
+         lambda: client.get("/api/patients/{}".format(username()))),
+        ("GET patients 304", roster_304),
+        ("GET patients events",
+         lambda: first_event(client, "/api/patients/{}/events".format(
+             username()))),
+        ("GET alerts stats", lambda: client.get("/api/alerts/stats")),
+        ("POST new_attending",
+         lambda: client.post("/api/new_attending", json={
+             "attending_username": "New.{}".format(next(new_names)),
+             "attending_email": "new@duke.edu",
+             "attending_phone": "919-200-8973"})),
+        ("POST new_patient",
+         lambda: client.post("/api/new_patient", json={
+             "patient_id": next(new_ids), "attending_username": username(),
+             "patient_age": 40})),
+        ("POST heart_rate",
+         lambda: client.post("/api/heart_rate", json={
+             "patient_id": patient(), "heart_rate": rng.randrange(50, 180)})),
+        ("POST heart_rate batch/{}".format(BATCH),
+         lambda: client.post("/api/heart_rate/batch",
+                             json=readings_batch())),
+        ("POST heart_rate stream/{}".format(BATCH),
+         lambda: client.post("/api/heart_rate/stream", data=b"".join(
+             json.dumps(reading).encode() + b"\n"
+             for reading in readings_batch())).data),
+        ("POST heart_rate binary/{}".format(BATCH),
+         lambda: client.post("/api/heart_rate/binary", data=pack_records(
+             (reading["patient_id"], reading["heart_rate"], SERVER_TIME)
+             for reading in readings_batch()), content_type=MIME_TYPE)),
+        ("POST interval_average",
+         lambda: client.post("/api/heart_rate/interval_average", json={
+             "patient_id": patient(), "heart_rate_average_since": since()})),
+        ("find_patient",
+         lambda: server.find_patient(patient(), server.patient_db)),
+        ("patients_for_attending_username",
+         lambda: server.patients_for_attending_username(roster_ids)),
+        ("find_first_time",
+         lambda: server.find_first_time(
+             since(), server.patient_db.get(patient())["timestamp"])),
+        ("check_heart_rate",
+         lambda: server.check_heart_rate([patient(), rng.randrange(50, 180)],
+                                         since())),
+    ]
+
+
+def measure(function, number, memory_number):
+    '''Times calls of a function one by one and finds its peak memory
+
+    :param function: function to call
+    :param number: int number of timed calls
+    :param memory_number: int number of calls traced for memory
+    :return: dictionary with ops (calls per second), p50_us and p99_us
+             (microseconds per call) and peak_kib (KiB allocated at most
+             while calls were running)
+    '''
+    for _ in range(min(number, 10)):
+        function()
+    latencies = list()
+    clock = time.perf_counter
+    start = clock()
+    for _ in range(number):
+        before = clock()
+        function()
+        latencies.append(clock() - before)
+    total = clock() - start
+    latencies.sort()
+    tracemalloc.start()
+    for _ in range(memory_number):
+        function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"ops": round(number / total, 1),
+            "p50_us": round(1e6 * latencies[len(latencies) // 2], 1),
+            "p99_us": round(1e6 * latencies[min(len(latencies) - 1,
+                                                len(latencies) * 99 // 100)],
+                            1),
+            "peak_kib": round(peak / 1024, 1)}
+
+
+def compare(results, baseline, tolerance, min_delta_us=5.0):
+    '''Compares results with a baseline run
+
+    A case has regressed if its p50 latency is more than tolerance times
+    the baseline's and also more than min_delta_us microseconds above it,
+    so that timer noise on the fastest helpers is not reported.
+
+    :param results: dictionary of case name to measure results
+    :param baseline: dictionary of case name to measure results
+    :param tolerance: float slowdown allowed
+    :param min_delta_us: float microseconds of slowdown always allowed
+    :return: dictionary of case name to float p50 ratio (new / baseline)
+             and list of the names of the cases that regressed
+    '''
+    ratios = dict()
+    regressed = list()
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]["p50_us"], result["p50_us"]
+        ratios[name] = new / old
+        if ratios[name] > tolerance and new - old > min_delta_us:
+            regressed.append(name)
+    return ratios, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times every route and the core helpers of "
+                    "heart_rate_server in process at a given store size")
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--readings", type=int, default=100,
+                        help="heart rates per patient")
+    parser.add_argument("--attendants", type=int, default=100)
+    parser.add_argument("--number", type=int, default=1000,
+                        help="timed calls per case")
+    parser.add_argument("--memory-number", type=int, default=20,
+                        help="calls per case traced for peak memory")
+    parser.add_argument("--only", default="",
+                        help="time only cases whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="JSON file of an earlier run to compare with")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="p50 slowdown counted as a regression")
+    parser.add_argument("--min-delta-us", type=float, default=5.0,
+                        help="p50 slowdown in microseconds always allowed")
+    args = parser.parse_args()
+    scale = {"patients": args.patients, "readings": args.readings,
+             "attendants": args.attendants}
+    machine = "Python {} on {}".format(platform.python_version(),
+                                       platform.platform())
+
+    start = time.perf_counter()
+    usernames = fill_store(args.patients, args.readings, args.attendants)
+    print("Store of {} patients and {} readings built in {:.1f} s, peak "
+          "RSS {:.0f} MiB".format(
+              args.patients, args.patients * args.readings,
+              time.perf_counter() - start,
+              resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    baseline = dict()
+    if not args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            stored = {"scale": scale, "results": dict()}
+        if stored["scale"] != scale:
+            print("Baseline was run at {}, not compared".format(
+                stored["scale"]))
+        else:
+            baseline = stored["results"]
+            if stored.get("machine", machine) != machine:
+                print("Baseline was run with " + stored["machine"])
+
+    results = dict()
+    print("{:<34} {:>10} {:>10} {:>10} {:>10} {:>9}".format(
+        "case", "ops/s", "p50 (us)", "p99 (us)", "peak KiB", "vs base"))
+    for name, function in make_cases(args.patients, args.readings,
+                                     usernames):
+        if args.only not in name:
+            continue
+        result = measure(function, args.number, args.memory_number)
+        results[name] = result
+        ratio = ""
+        if name in baseline:
+            ratio = "{:.2f}x".format(result["p50_us"] /
+                                     baseline[name]["p50_us"])
+        print("{:<34} {:>10.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>9}".format(
+            name, result["ops"], result["p50_us"], result["p99_us"],
+            result["peak_kib"], ratio))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"scale": scale, "machine": machine,
+                       "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to " + args.baseline)
+        return 0
+    ratios, regressed = compare(results, baseline, args.tolerance,
+                                args.min_delta_us)
+    for name in regressed:
+        print("REGRESSED: {} p50 is {:.2f}x the baseline".format(
+            name, ratios[name]))
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
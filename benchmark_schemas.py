@@ -0,0 +1,141 @@
+import argparse
+import timeit
+
+import request_schemas
+from heart_rate_server import (check_bad_input, read_attending, read_patient,
+                               read_heart_rate_info)
+
+
+def verify_strings(in_dict, expected_keys, expected_values):
+    '''The key and type loop of verify_new_attending before the schemas
+
+    :param in_dict: dictionary sent by the client
+    :param expected_keys: tuple of str keys
+    :param expected_values: tuple of the types of the values
+    :return: True or str describing the first problem
+    '''
+    for key, ty in zip(expected_keys, expected_values):
+        if key not in in_dict.keys():
+            return "{} key not found in input".format(key)
+        if type(in_dict[key]) != ty:
+            return "{} value is not the correct type".format(key)
+    return True
+
+
+def verify_numbers(in_dict, expected_keys, expected_values):
+    '''The key and type loop of verify_new_patient_info,
+    verify_heart_rate_post and verify_internal_average before the schemas
+
+    A value of the wrong type only fails if check_bad_input finds it is a
+    string with something other than digits in it.
+
+    :param in_dict: dictionary sent by the client
+    :param expected_keys: tuple of str keys
+    :param expected_values: tuple of the types of the values
+    :return: True or str describing the first problem
+    '''
+    for key, ty in zip(expected_keys, expected_values):
+        if key not in in_dict.keys():
+            return "{} key not found in input".format(key)
+        if type(in_dict[key]) != ty and check_bad_input(in_dict[key]):
+            return "{} value is not the correct type".format(key)
+    return True
+
+
+def old_new_attending(in_dict):
+    '''Checks and reads a new attendant body as POST /api/new_attending
+    did before the schemas, with verify_new_attending and read_attending
+
+    :param in_dict: dictionary sent by the client
+    :return: list of values or str describing the first problem
+    '''
+    verify_input = verify_strings(
+        in_dict, ("attending_username", "attending_email",
+                  "attending_phone"), (str, str, str))
+    if verify_input is not True:
+        return verify_input
+    return read_attending(in_dict)
+
+
+def old_new_patient(in_dict):
+    '''Checks and reads a new patient body as POST /api/new_patient did
+    before the schemas, with verify_new_patient_info and read_patient
+
+    :param in_dict: dictionary sent by the client
+    :return: list of values or str describing the first problem
+    '''
+    verify_input = verify_numbers(
+        in_dict, ("patient_id", "attending_username", "patient_age"),
+        (int, str, int))
+    if verify_input is not True:
+        return verify_input
+    return read_patient(in_dict)
+
+
+def old_heart_rate(in_dict):
+    '''Checks and reads a heart rate body as POST /api/heart_rate did
+    before the schemas, with verify_heart_rate_post and
+    read_heart_rate_info
+
+    :param in_dict: dictionary sent by the client
+    :return: list of values or str describing the first problem
+    '''
+    verify_input = verify_numbers(in_dict, ("patient_id", "heart_rate"),
+                                  (int, int))
+    if verify_input is not True:
+        return verify_input
+    return read_heart_rate_info(in_dict)
+
+
+def old_interval_average(in_dict):
+    '''Checks and reads an interval average body as
+    POST /api/heart_rate/interval_average did before the schemas, with
+    verify_internal_average and int() on the patient ID
+
+    :param in_dict: dictionary sent by the client
+    :return: list of values or str describing the first problem
+    '''
+    verify_input = verify_numbers(
+        in_dict, ("patient_id", "heart_rate_average_since"), (int, str))
+    if verify_input is not True:
+        return verify_input
+    return [int(in_dict["patient_id"]), in_dict["heart_rate_average_since"]]
+
+
+REQUESTS = {
+    "new_attending": (request_schemas.NEW_ATTENDING, old_new_attending,
+                      {"attending_username": "Smith.J",
+                       "attending_email": "smith@duke.edu",
+                       "attending_phone": "919-867-5309"}),
+    "new_patient": (request_schemas.NEW_PATIENT, old_new_patient,
+                    {"patient_id": "120", "attending_username": "Smith.J",
+                     "patient_age": 50}),
+    "heart_rate": (request_schemas.HEART_RATE, old_heart_rate,
+                   {"patient_id": 120, "heart_rate": "100"}),
+    "interval_average": (request_schemas.INTERVAL_AVERAGE,
+                         old_interval_average,
+                         {"patient_id": 120,
+                          "heart_rate_average_since":
+                          "2018-03-09 11:00:36"})}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the cost of checking and converting each "
+                    "route's request body")
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+    print("{:>18} {:>14} {:>14} {:>8}".format(
+        "route", "before (ns)", "schema (ns)", "speedup"))
+    for route, (schema, old, body) in REQUESTS.items():
+        assert old(body) == schema(body)
+        before = timeit.timeit(lambda: old(body),
+                               number=args.number) / args.number
+        schema_time = timeit.timeit(lambda: schema(body),
+                                    number=args.number) / args.number
+        print("{:>18} {:>14.0f} {:>14.0f} {:>7.1f}x".format(
+            route, 1e9 * before, 1e9 * schema_time, before / schema_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import shutil
+import tempfile
+import time
+
+from storage_engine import StorageEngine
+from heart_rate_series import HeartRateSeries
+
+
+def fill(directory, patients, readings, batch, fsync):
+    '''Logs heart rates for a number of patients and returns the databases
+
+    :param directory: str path of the data directory
+    :param patients: int number of patients
+    :param readings: int number of heart rates per patient
+    :param batch: int number of heart rates per log record
+    :param fsync: str fsync policy
+    :return: list of attendant dictionaries, list of patient dictionaries
+             and float seconds spent logging
+    '''
+    engine = StorageEngine(directory, fsync=fsync, snapshot_every=0)
+    engine.recover(lambda kind, values: None)
+    attendants = [{"attending_username": "Bench.B",
+                   "attending_email": "bench@duke.edu",
+                   "attending_phone": "919-200-8973",
+                   "patients": list(range(patients))}]
+    patient_db = list()
+    start = time.perf_counter()
+    engine.log_attendant("Bench.B", "bench@duke.edu", "919-200-8973")
+    for patient_id in range(patients):
+        engine.log_patient(patient_id, "Bench.B", 30)
+        series = HeartRateSeries()
+        patient_db.append({"patient_id": patient_id,
+                           "attending_username": "Bench.B",
+                           "patient_age": 30, "status": "",
+                           "series": series})
+        for first in range(0, readings, batch):
+            count = min(batch, readings - first)
+            rates = [60 + (first + i) % 60 for i in range(count)]
+            times = [1000 * (first + i) for i in range(count)]
+            series.extend(rates, times)
+            engine.log_readings(patient_id, first, rates, times)
+    engine.close()
+    return attendants, patient_db, time.perf_counter() - start
+
+
+def restart(directory):
+    '''Recovers a data directory and returns the time it took
+
+    :param directory: str path of the data directory
+    :return: float seconds spent recovering
+    '''
+    series = dict()
+
+    def apply(kind, values):
+        if kind == "patient":
+            series[values[0]] = values[4] or HeartRateSeries()
+        elif kind == "readings":
+            series[values[0]].extend(values[2], values[3])
+
+    start = time.perf_counter()
+    engine = StorageEngine(directory, snapshot_every=0)
+    engine.recover(apply)
+    elapsed = time.perf_counter() - start
+    engine.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures restart time of the storage engine from the "
+                    "log alone and from a snapshot")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--readings", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--fsync", default="none")
+    args = parser.parse_args()
+    print("{:>12} {:>10} {:>12} {:>14}".format(
+        "readings", "log (s)", "replay (s)", "snapshot (s)"))
+    for readings in args.readings:
+        directory = tempfile.mkdtemp()
+        try:
+            attendants, patients, logging_time = fill(
+                directory, args.patients, readings, args.batch, args.fsync)
+            replay_time = restart(directory)
+            engine = StorageEngine(directory, snapshot_every=0)
+            engine.recover(lambda kind, values: None)
+            engine.snapshot(attendants, patients)
+            engine.close()
+            snapshot_time = restart(directory)
+        finally:
+            shutil.rmtree(directory)
+        print("{:>12} {:>10.3f} {:>12.3f} {:>14.3f}".format(
+            readings * args.patients, logging_time, replay_time,
+            snapshot_time))
+
+
+if __name__ == '__main__':
+    main()
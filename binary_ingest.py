@@ -0,0 +1,152 @@
+import socket
+import socketserver
+import struct
+
+import numpy as np
+
+# One reading: uint32 patient_id, uint16 heart_rate, two bytes of padding
+# and int64 device timestamp in epoch milliseconds, little-endian, 16
+# bytes in all. A timestamp of SERVER_TIME asks the server to use its own
+# clock, for monitors that do not keep time.
+RECORD = struct.Struct("<IHxxq")
+RECORD_DTYPE = np.dtype({"names": ["patient_id", "heart_rate", "timestamp"],
+                         "formats": ["<u4", "<u2", "<i8"],
+                         "offsets": [0, 4, 8], "itemsize": RECORD.size})
+SERVER_TIME = 0
+# Reply to a TCP sender once it has finished: uint32 readings stored and
+# uint32 readings rejected.
+ACK = struct.Struct("<II")
+MIME_TYPE = "application/octet-stream"
+
+
+def pack_records(readings):
+    '''Packs readings into binary records
+
+    :param readings: iterable of (int patient ID, int heart rate, int
+                     epoch milliseconds or SERVER_TIME) tuples
+    :return: bytes of the packed records
+    '''
+    readings = list(readings)
+    data = bytearray(RECORD.size * len(readings))
+    for i, reading in enumerate(readings):
+        RECORD.pack_into(data, i * RECORD.size, *reading)
+    return bytes(data)
+
+
+def record_array(data):
+    '''Views packed records as a numpy structured array, without copying
+
+    The array is a view into data, which must not change while it is in
+    use.
+
+    :param data: bytes-like object holding whole records
+    :return: numpy array of RECORD_DTYPE
+    :raises ValueError: if data is not a whole number of records
+    '''
+    view = memoryview(data).cast("B")
+    if len(view) % RECORD.size:
+        raise ValueError("body is not a whole number of {}-byte "
+                         "records".format(RECORD.size))
+    return np.frombuffer(view, dtype=RECORD_DTYPE)
+
+
+def decode_records(data):
+    '''Reads packed records without copying them
+
+    :param data: bytes-like object holding whole records
+    :return: numpy arrays of patient IDs, heart rates and timestamps, views
+             into data
+    :raises ValueError: if data is not a whole number of records
+    '''
+    records = record_array(data)
+    return (records["patient_id"], records["heart_rate"],
+            records["timestamp"])
+
+
+def group_by_patient(patient_ids, timestamps):
+    '''Groups records by patient, each group in time order
+
+    :param patient_ids: numpy array of patient IDs
+    :param timestamps: numpy array of timestamps
+    :return: generator of (int patient ID, numpy array of record indexes)
+    '''
+    order = np.lexsort((timestamps, patient_ids))
+    ordered = patient_ids[order]
+    starts = np.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+    for indexes in np.split(order, starts) if len(order) else ():
+        yield int(patient_ids[indexes[0]]), indexes
+
+
+class BinaryIngestHandler(socketserver.BaseRequestHandler):
+    '''Reads packed records from one TCP connection
+
+    Records are received into a fixed buffer and every run of whole
+    records is handed to the server's ingest function straight from that
+    buffer. When the sender shuts down its side of the connection, a
+    trailing partial record is counted as rejected and the totals are
+    sent back as an ACK.
+    '''
+
+    def handle(self):
+        buffer = bytearray(self.server.buffer_records * RECORD.size)
+        view = memoryview(buffer)
+        filled = stored = rejected = 0
+        while True:
+            received = self.request.recv_into(view[filled:])
+            if not received:
+                break
+            filled += received
+            whole = filled - filled % RECORD.size
+            if not whole:
+                continue
+            result = self.server.ingest(view[:whole])
+            stored += result["stored"]
+            rejected += result["rejected"]
+            buffer[:filled - whole] = view[whole:filled]
+            filled -= whole
+        if filled:
+            rejected += 1
+        self.request.sendall(ACK.pack(stored, rejected))
+
+
+class BinaryIngestServer(socketserver.ThreadingTCPServer):
+    '''TCP server taking packed records from bedside monitors
+
+    Each connection is served on its own thread.
+
+    :param address: (str host, int port) to listen on, port 0 for any
+    :param ingest: function taking a memoryview of whole records and
+                   returning a dictionary with "stored" and "rejected"
+                   counts
+    :param buffer_records: int number of records received at most per
+                           call to ingest
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, ingest, buffer_records=4096):
+        self.ingest = ingest
+        self.buffer_records = buffer_records
+        super().__init__(address, BinaryIngestHandler)
+
+
+def send_records(host, port, data, timeout=30):
+    '''Sends packed records over TCP and waits for the ACK
+
+    :param host: str host of the binary listener
+    :param port: int port of the binary listener
+    :param data: bytes of packed records
+    :param timeout: float seconds to wait on the connection
+    :return: int readings stored and int readings rejected
+    '''
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        reply = b""
+        while len(reply) < ACK.size:
+            chunk = sock.recv(ACK.size - len(reply))
+            if not chunk:
+                raise ConnectionError("connection closed before the ACK")
+            reply += chunk
+    return ACK.unpack(reply)
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+EMAIL_KEYS = ("from_email", "to_email", "subject", "content")
+EMAIL_PATH = "/hrss/send_email"
+STUB_STATS = web.AppKey("stub_stats", dict)
+
+
+def create_stub_app(delay=0.0, fail_rate=0.0, seed=None):
+    '''Builds a local stand-in for the email server
+
+    It takes the emails the heart rate server posts to HR_EMAIL_SERVER,
+    counts them instead of sending them, and answers like the real email
+    server, so load tests do not email anyone. It can also wait before
+    answering and fail a share of the emails with a 503, to try out the
+    alert dispatcher's retries.
+
+    :param delay: float seconds to wait before answering each email
+    :param fail_rate: float share of emails answered with a 503
+    :param seed: int seed of the random failures, None for any
+    :return: aiohttp Application serving POST /hrss/send_email and
+             GET /hrss/stats
+    '''
+    rng = random.Random(seed)
+    stats = {"received": 0, "failed": 0, "rejected": 0,
+             "by_recipient": dict()}
+
+    async def send_email(request):
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            email = await request.json()
+        except ValueError:
+            email = None
+        if type(email) is not dict or any(key not in email
+                                          for key in EMAIL_KEYS):
+            stats["rejected"] += 1
+            return web.Response(text="Email is missing a key", status=400)
+        if rng.random() < fail_rate:
+            stats["failed"] += 1
+            return web.Response(text="Email server busy", status=503)
+        stats["received"] += 1
+        recipients = stats["by_recipient"]
+        recipients[email["to_email"]] = \
+            recipients.get(email["to_email"], 0) + 1
+        return web.Response(text="Email sent to " + email["to_email"])
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app[STUB_STATS] = stats
+    app.router.add_post(EMAIL_PATH, send_email)
+    app.router.add_get("/hrss/stats", get_stats)
+    return app
+
+
+async def start_stub(host="127.0.0.1", port=5007, **options):
+    '''Starts the email stub on the running event loop
+
+    :param host: str host to listen on
+    :param port: int port to listen on, 0 for any free port
+    :param options: delay, fail_rate or seed, as for create_stub_app
+    :return: aiohttp AppRunner (call cleanup to stop it) and str URL to
+             set as HR_EMAIL_SERVER
+    '''
+    runner = web.AppRunner(create_stub_app(**options), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://{}:{}{}".format(host, port, EMAIL_PATH)
+
+
+def stub_stats(runner):
+    '''Returns the counts of an email stub started with start_stub
+
+    :param runner: aiohttp AppRunner from start_stub
+    :return: dictionary with received, failed and rejected counts and the
+             number of emails for each recipient
+    '''
+    return runner.app[STUB_STATS]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Local email server stub for load tests; run the heart "
+                    "rate server with HR_EMAIL_SERVER=http://<host>:<port>"
+                    + EMAIL_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5007)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(create_stub_app(args.delay, args.fail_rate), host=args.host,
+                port=args.port, access_log=None)
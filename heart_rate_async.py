@@ -0,0 +1,439 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+from aiohttp.helpers import ETAG_ANY
+
+import heart_rate_server as server
+from alert_dispatcher import AsyncAlertDispatcher
+from heart_rate_database import PatientStore, AttendantRegistry
+from heart_rate_series import to_epoch_ms
+from request_schemas import NEW_ATTENDING, NEW_PATIENT, INTERVAL_AVERAGE
+
+CLIENT_SESSION = web.AppKey("client_session", aiohttp.ClientSession)
+DISPATCHER = web.AppKey("dispatcher", AsyncAlertDispatcher)
+EMAIL_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+routes = web.RouteTableDef()
+
+
+def text(message, status=200):
+    '''Builds a plain response the way Flask answers a returned string
+
+    :param message: str message for the client
+    :param status: int status code
+    :return: aiohttp Response
+    '''
+    return web.Response(text=str(message), status=status,
+                        content_type="text/html")
+
+
+def codec():
+    '''Returns the JSON codec the Flask app is set to use
+
+    :return: codec object (see json_codec)
+    '''
+    return server.app.json.codec
+
+
+def json_response(payload, status=200):
+    '''Builds a JSON response the way jsonify does
+
+    :param payload: JSON serializable object
+    :param status: int status code
+    :return: aiohttp Response
+    '''
+    return web.Response(body=codec().dumps(payload) + b"\n",
+                        status=status, content_type="application/json")
+
+
+def result_response(result):
+    '''Answers with a helper's result, which is either data or an error
+
+    Helpers such as get_patient_summary return a (message, status) tuple
+    on errors, which Flask turns into a plain response.
+
+    :param result: JSON serializable object or (str, int) tuple
+    :return: aiohttp Response
+    '''
+    if type(result) is tuple:
+        return text(*result)
+    return json_response(result)
+
+
+def conditional_json(request, etag, build):
+    '''Answers a GET request with JSON or, if the ETag matches, a 304
+
+    :param request: aiohttp Request
+    :param etag: str ETag of the current data, None for no ETag
+    :param build: function returning the JSON serializable payload
+    :return: aiohttp Response
+    '''
+    if etag is not None and any(tag.value in (etag, ETAG_ANY)
+                                for tag in request.if_none_match or ()):
+        response = web.Response(status=304)
+    else:
+        response = json_response(build())
+    if etag is not None:
+        response.etag = etag
+    return response
+
+
+async def read_json(request):
+    '''Reads the JSON body of a request
+
+    :param request: aiohttp Request
+    :return: the decoded body
+    :raises HTTPBadRequest: if the body is not JSON
+    '''
+    try:
+        return codec().loads(await request.read())
+    except ValueError:
+        raise web.HTTPBadRequest(text="Failed to decode JSON object")
+
+
+async def run_write(function, *args):
+    '''Runs a helper that stores data
+
+    Helpers are called on the event loop, as they only hold a patient's
+    lock for a moment. With the "always" fsync policy a write waits for
+    its log record to reach the disk, so it is run on the default
+    executor instead; concurrent writes then still share one fsync.
+
+    :param function: helper to call
+    :param args: arguments of the helper
+    :return: whatever the helper returns
+    '''
+    if server.storage is not None and server.storage.fsync == "always":
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+    return function(*args)
+
+
+def now():
+    return server.current_time(datetime.now())
+
+
+async def deliver_email(session, email_dict):
+    '''Posts an email to the email server without blocking the event loop
+
+    Works like heart_rate_server.deliver_email: server errors raise so the
+    dispatcher retries, and rejected emails are logged and not retried.
+
+    :param session: aiohttp ClientSession
+    :param email_dict: dictionary made by build_email
+    :return: True if the email server accepted the email, False otherwise
+    '''
+    async with session.post(server.EMAIL_SERVER, json=email_dict,
+                            timeout=EMAIL_TIMEOUT) as r:
+        if r.status >= 500:
+            r.raise_for_status()
+        body = await r.text()
+    logging.info("Email server response for " + email_dict["to_email"] +
+                 ": " + body + "\n")
+    return r.ok
+
+
+@routes.post("/api/new_patient")
+async def post_new_patient(request):
+    '''Stores a new patient, as POST /api/new_patient of the Flask app'''
+    in_dict = await read_json(request)
+    patient_info = NEW_PATIENT(in_dict)
+    if type(patient_info) is str:
+        return text(patient_info, 400)
+    if server.add_patient_to_attendant_db(patient_info,
+                                          server.attendant_db):
+        return text("Attendant does not exist", 400)
+    await run_write(server.add_patient_to_db, patient_info)
+    logging.info("New patient added... " + "Patient ID: " +
+                 str(in_dict["patient_id"]) + "\n")
+    return text("Patient information stored")
+
+
+@routes.post("/api/new_attending")
+async def post_new_attending(request):
+    '''Stores a new attendant, as POST /api/new_attending of the Flask app'''
+    in_dict = await read_json(request)
+    attendant_info = NEW_ATTENDING(in_dict)
+    if type(attendant_info) is str:
+        return text(attendant_info, 400)
+    await run_write(server.add_attendant_to_db, attendant_info,
+                    server.attendant_db)
+    logging.info("New attendant added... Username: " +
+                 in_dict["attending_username"] + ", email: " +
+                 in_dict["attending_email"] + "\n")
+    return text("Attendant information stored")
+
+
+@routes.post("/api/heart_rate")
+async def post_heart_rate(request):
+    '''Stores and checks a heart rate, as POST /api/heart_rate'''
+    in_dict = await read_json(request)
+    return text(*await run_write(server.process_heart_rate, in_dict, now()))
+
+
+@routes.post("/api/heart_rate/stream")
+async def post_heart_rate_stream(request):
+    '''Stores a stream of NDJSON heart rates, as POST /api/heart_rate/stream
+
+    Chunks of the body are split into lines by an NdjsonSplitter as they
+    arrive and each line is acknowledged as soon as it is stored.
+    '''
+    response = web.StreamResponse(
+        headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    splitter = server.NdjsonSplitter()
+    stored = 0
+    rejected = 0
+    number = 0
+
+    async def acknowledge(lines):
+        nonlocal stored, rejected, number
+        for line in lines:
+            number += 1
+            if line is not None and not line.strip():
+                continue
+            message, code = await run_write(server.process_ndjson_line,
+                                            line, now())
+            if code == 200:
+                stored += 1
+            else:
+                rejected += 1
+            await response.write(codec().dumps(
+                {"line": number, "status_code": code, "message": message})
+                + b"\n")
+
+    async for chunk in request.content.iter_chunked(65536):
+        await acknowledge(splitter.feed(chunk))
+    await acknowledge(splitter.close())
+    await response.write(codec().dumps(
+        {"stored": stored, "rejected": rejected}) + b"\n")
+    await response.write_eof()
+    return response
+
+
+@routes.post("/api/heart_rate/batch")
+async def post_heart_rate_batch(request):
+    '''Stores a batch of heart rates, as POST /api/heart_rate/batch'''
+    in_data = await read_json(request)
+    if type(in_data) == dict:
+        if "readings" not in in_data.keys():
+            return text("readings key not found in input", 400)
+        in_data = in_data["readings"]
+    if type(in_data) != list:
+        return text("readings value is not the correct type", 400)
+    results = await run_write(server.ingest_heart_rate_batch, in_data,
+                              now())
+    stored = sum(1 for result in results if result["stored"])
+    logging.info("Heart rate batch stored... " + str(stored) + " of " +
+                 str(len(results)) + " readings\n")
+    return json_response({"stored": stored,
+                          "rejected": len(results) - stored,
+                          "results": results})
+
+
+@routes.post("/api/heart_rate/binary")
+async def post_heart_rate_binary(request):
+    '''Stores packed binary heart rates, as POST /api/heart_rate/binary'''
+    if request.content_type != server.MIME_TYPE:
+        return text("Content-Type must be " + server.MIME_TYPE, 400)
+    data = await request.read()
+    try:
+        result = await run_write(server.ingest_binary_records, data, now())
+    except ValueError as e:
+        return text(str(e), 400)
+    logging.info("Binary heart rates stored... " + str(result["stored"]) +
+                 " of " + str(result["stored"] + result["rejected"]) +
+                 " readings\n")
+    return json_response(result)
+
+
+async def stream_pieces(request, pieces, content_type):
+    response = web.StreamResponse(headers={"Content-Type": content_type})
+    await response.prepare(request)
+    for piece in pieces:
+        await response.write(piece)
+    await response.write_eof()
+    return response
+
+
+@routes.get("/api/heart_rate/{patient_id}")
+async def get_patient_heart_data(request):
+    '''Returns a patient's heart rates, as GET /api/heart_rate/<patient_id>
+
+    Long lists and NDJSON streams are written a page at a time, and the
+    event loop serves other requests while each page is sent.
+    '''
+    patient_id = request.match_info["patient_id"]
+    if not any(key in request.query for key in server.HISTORY_ARGS):
+        patient = server.lookup_patient(patient_id, server.patient_db)
+        if patient is None:
+            return json_response(server.get_patient_heart_rates(
+                patient_id, server.patient_db))
+        if len(patient["series"]) <= server.HISTORY_PAGE:
+            return web.Response(body=server.heart_rates_json(patient) +
+                                b"\n", content_type="application/json")
+        return await stream_pieces(request,
+                                   server.iter_history_list(patient),
+                                   "application/json")
+    history = server.read_history_args(request.query)
+    if type(history) is str:
+        return text(history, 400)
+    patient = server.lookup_patient(patient_id, server.patient_db)
+    if patient is None:
+        return text("Patient not found", 400)
+    if history["format"] == "json":
+        return json_response(server.history_json_page(patient, history))
+    return await stream_pieces(request,
+                               server.iter_history_ndjson(patient, history),
+                               "application/x-ndjson")
+
+
+@routes.get("/api/heart_rate/average/{patient_id}")
+async def get_patient_avg_heart_rate(request):
+    '''Returns a patient's average heart rate'''
+    return json_response(server.get_patient_average_heart_rate(
+        request.match_info["patient_id"], server.patient_db))
+
+
+@routes.get("/api/heart_rate/summary/{patient_id}")
+async def get_patient_heart_rate_summary(request):
+    '''Returns a patient's heart rate aggregates'''
+    return result_response(server.get_patient_summary(
+        request.match_info["patient_id"], server.patient_db))
+
+
+@routes.get("/api/status/{patient_id}")
+async def get_status(request):
+    '''Returns a patient's status, with an ETag as in the Flask app'''
+    patient_id = request.match_info["patient_id"]
+    etag = None
+    if isinstance(server.patient_db, PatientStore) and \
+            patient_id in server.patient_db:
+        etag = server.make_etag(server.patient_db.version(patient_id))
+    return conditional_json(request, etag,
+                            lambda: server.get_patient_status(patient_id))
+
+
+@routes.post("/api/heart_rate/interval_average")
+async def post_interval_average(request):
+    '''Returns a patient's average heart rate since a time'''
+    in_dict = await read_json(request)
+    average_info = INTERVAL_AVERAGE(in_dict)
+    if type(average_info) is str:
+        return text(average_info, 400)
+    patient_id, time = average_info
+    patient = server.find_patient(patient_id, server.patient_db)
+    if type(patient) is not dict:
+        return result_response(patient)
+    with server.patient_lock(patient["patient_id"]):
+        index = server.find_first_time(time, patient["timestamp"])
+        if type(index) is not int:
+            return text(index, 400)
+        answer = patient["series"].average_since(to_epoch_ms(time))
+    return json_response(answer)
+
+
+@routes.get("/api/alerts/stats")
+async def get_alert_stats(request):
+    '''Returns the state of the tachycardia alert queue'''
+    return json_response(server.alert_dispatcher.stats())
+
+
+@routes.get("/api/patients/{attending_username}")
+async def get_patients_for_attending_username(request):
+    '''Returns an attendant's patient list, with an ETag'''
+    attending_username = request.match_info["attending_username"]
+    verify_attendant = server.verify_attendant_exists(attending_username)
+    if verify_attendant is not True:
+        return text(verify_attendant, 400)
+    etag = None
+    if isinstance(server.attendant_db, AttendantRegistry):
+        etag = server.make_etag(
+            server.attendant_db.version(attending_username))
+    return conditional_json(request, etag,
+                            lambda: server.get_roster(attending_username))
+
+
+@routes.get("/api/patients/{attending_username}/events")
+async def get_patient_events(request):
+    '''Streams patient changes for a physician's dashboard
+
+    The subscription wakes the handler through an asyncio.Event instead of
+    a blocked thread, so each open dashboard only costs a connection.
+    '''
+    attending_username = request.match_info["attending_username"]
+    verify_attendant = server.verify_attendant_exists(attending_username)
+    if verify_attendant is not True:
+        return text(verify_attendant, 400)
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscription = server.patient_events.subscribe(
+        attending_username, lambda: loop.call_soon_threadsafe(wakeup.set))
+    response = web.StreamResponse(
+        headers={"Content-Type": "text/event-stream",
+                 "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    try:
+        await response.prepare(request)
+        roster = server.get_roster(attending_username)
+        await response.write(b"event: roster\ndata: " +
+                             codec().dumps(roster) + b"\n\n")
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(),
+                                       server.EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+            wakeup.clear()
+            for row in subscription.pop_all(0):
+                await response.write(b"event: patient\ndata: " +
+                                     codec().dumps(row) + b"\n\n")
+    except ConnectionResetError:
+        pass
+    finally:
+        server.patient_events.unsubscribe(attending_username, subscription)
+    return response
+
+
+async def start_alerts(app):
+    '''Swaps in an AsyncAlertDispatcher while the app runs'''
+    session = aiohttp.ClientSession()
+    dispatcher = AsyncAlertDispatcher(
+        lambda email_dict: deliver_email(session, email_dict))
+    app[CLIENT_SESSION] = session
+    app[DISPATCHER] = server.alert_dispatcher
+    dispatcher.start()
+    server.alert_dispatcher = dispatcher
+    yield
+    server.alert_dispatcher = app[DISPATCHER]
+    await dispatcher.stop()
+    await session.close()
+
+
+def create_app():
+    '''Builds the asyncio version of the heart rate server
+
+    The app has the same routes and responses as heart_rate_server.app
+    and works on the same databases through the same helper functions,
+    but runs every request as a coroutine on one event loop, so thousands
+    of monitors and dashboards can stay connected without a thread each.
+    Tachycardia emails are posted by an AsyncAlertDispatcher with a
+    pooled aiohttp session.
+
+    :return: aiohttp Application
+    '''
+    app = web.Application()
+    app.add_routes(routes)
+    app.cleanup_ctx.append(start_alerts)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename="code_status.log", filemode='w',
+                        level=logging.DEBUG)
+    server.open_from_environment(os.environ)
+    web.run_app(create_app(), port=5000, backlog=4096)
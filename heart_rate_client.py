@@ -1,107 +1,989 @@
-import requests
+import argparse
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
 from datetime import datetime
 
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from binary_ingest import MIME_TYPE, pack_records
+from email_stub import start_stub, stub_stats
+from heart_rate_series import TIME_FORMAT, format_epoch_ms, to_epoch_ms
+from tachycardia import default_table
+
 server_name = "http://127.0.0.1:5000"
 
+# Answers that mean the server (or a proxy in front of it) could not take
+# the request right now, so it is worth sending again.
+RETRY_STATUSES = (429, 502, 503, 504)
+# Routes without a parameter in their path; any other path is reported by
+# its route with the last part (or the username of an event stream)
+# replaced by a placeholder.
+FIXED_PATHS = ("/api/new_patient", "/api/new_attending", "/api/heart_rate",
+               "/api/heart_rate/batch", "/api/heart_rate/stream",
+               "/api/heart_rate/binary", "/api/heart_rate/interval_average",
+               "/api/alerts/stats")
 
-def add_new_patient():
-    new_patient = {"patient_id": 1,
-                   "attending_username": "Duncan.C",
-                   "patient_age": 21}
-    r = requests.post(server_name+"/api/new_patient", json=new_patient)
-    print(r.text)
-    new_patient = {"patient_id": 2,
-                   "attending_username": "Therien.A",
-                   "patient_age": 21}
-    r = requests.post(server_name + "/api/new_patient", json=new_patient)
-    print(r.text)
-    new_patient = {"patient_id": 3,
-                   "attending_username": "Therien.A",
-                   "patient_age": 65}
-    r = requests.post(server_name + "/api/new_patient", json=new_patient)
-    print(r.text)
 
+def batch_timestamp(timestamp):
+    '''Writes a reading's timestamp the way the batch route reads it
 
-def add_heart_rate():
-    new_heart_rate = {"patient_id": 1, "heart_rate": 90}
-    new_heart_rate4 = {"patient_id": 2, "heart_rate": 60}
-    new_heart_rate2 = {"patient_id": 2, "heart_rate": 70}
-    new_heart_rate5 = {"patient_id": 2, "heart_rate": 65}
-    new_heart_rate3 = {"patient_id": 3, "heart_rate": 150}
-    r = requests.post(server_name+"/api/heart_rate", json=new_heart_rate)
-    print(r.text)
-    r = requests.post(server_name + "/api/heart_rate", json=new_heart_rate4)
-    print(r.text)
-    r = requests.post(server_name + "/api/heart_rate", json=new_heart_rate5)
+    :param timestamp: str in "%Y-%m-%d %H:%M:%S" format, datetime object,
+                      or int epoch milliseconds
+    :return: str in "%Y-%m-%d %H:%M:%S" format
+    '''
+    if isinstance(timestamp, datetime):
+        return datetime.strftime(timestamp, TIME_FORMAT)
+    if isinstance(timestamp, int):
+        return format_epoch_ms(timestamp)
+    return timestamp
+
+
+def route_of(method, path):
+    '''Names the route a request went to, for grouping latencies
+
+    :param method: str HTTP method
+    :param path: str path of the request
+    :return: str such as "GET /api/status/<id>"
+    '''
+    path = path.split("?")[0]
+    if path not in FIXED_PATHS:
+        head, _, tail = path.rpartition("/")
+        if tail == "events":
+            path = head.rpartition("/")[0] + "/<id>/events"
+        else:
+            path = head + "/<id>"
+    return method + " " + path
+
+
+class LatencyHistogram:
+    '''Counts latencies in buckets that grow by a fixed ratio
+
+    Bucket bounds run from smallest to largest seconds, each ratio times
+    the one before, so every percentile is known to within that ratio
+    with a fixed amount of memory however many latencies are recorded.
+    The default ratio of 2 ** (1/8) keeps percentiles within 9%.
+
+    :param smallest: float upper bound in seconds of the first bucket
+    :param largest: float seconds above which latencies share one bucket
+    :param ratio: float ratio between bucket bounds
+    '''
+
+    def __init__(self, smallest=1e-5, largest=100.0, ratio=2 ** 0.125):
+        self.bounds = [smallest]
+        while self.bounds[-1] < largest:
+            self.bounds.append(self.bounds[-1] * ratio)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def record(self, seconds):
+        '''Adds one latency
+
+        :param seconds: float latency in seconds
+        '''
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        '''Adds the latencies of a histogram with the same buckets
+
+        :param other: LatencyHistogram
+        '''
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.errors += other.errors
+
+    def percentile(self, percent):
+        '''Returns the latency below which a share of latencies fall
+
+        :param percent: float from 0 to 100
+        :return: float seconds, the upper bound of the bucket holding the
+                 percentile and no more than the largest latency, None if
+                 nothing was recorded
+        '''
+        if not self.count:
+            return None
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if i == len(self.bounds):
+            return self.max
+        return min(self.bounds[i], self.max)
+
+    def summary(self):
+        '''Returns the count, errors, mean, p50, p90, p99 and max
+
+        :return: dictionary of int counts and float seconds
+        '''
+        return {"count": self.count, "errors": self.errors,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "max": self.max if self.count else None}
+
+
+class HeartRateClient:
+    '''Client of the heart rate server over one pooled keep-alive session
+
+    Every request goes through request, which reuses the session's
+    connections and retries connection errors, timeouts and RETRY_STATUSES
+    answers up to retries more times, waiting backoff, 2 * backoff,
+    4 * backoff, ... seconds between attempts. Retried POSTs may store a
+    reading twice if the server stored it but its answer was lost.
+
+    The latency of every attempt is recorded in a LatencyHistogram for
+    its route, and attempts that failed to connect or timed out are
+    counted as errors; latency_report returns them.
+
+    Readings passed to add_reading are buffered and sent together through
+    the batch route, or the binary route if binary is True. A background
+    thread flushes the buffer every flush_interval seconds, and sooner once
+    batch_size readings are waiting. Readings that could not be sent stay
+    buffered for the next flush, up to max_buffered readings, after which
+    new readings are dropped.
+
+    :param server: str base URL of the server
+    :param batch_size: int most readings sent in one request
+    :param flush_interval: float seconds between background flushes
+    :param retries: int number of retries after a failed request
+    :param backoff: float seconds to wait before the first retry
+    :param timeout: float seconds to wait for each answer
+    :param pool_size: int most connections kept open to the server
+    :param binary: True to send readings as packed binary records
+    :param max_buffered: int most readings waiting to be sent
+    '''
+
+    def __init__(self, server=server_name, batch_size=500,
+                 flush_interval=1.0, retries=3, backoff=0.1, timeout=10,
+                 pool_size=10, binary=False, max_buffered=100000):
+        self.server = server.rstrip("/")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.binary = binary
+        self.max_buffered = max_buffered
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._counts = {"sent": 0, "stored": 0, "rejected": 0, "dropped": 0,
+                        "retried": 0, "failed": 0}
+        self.latency = dict()
+        self._set_up_session()
+
+    def _set_up_session(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._flusher = None
+
+    def request(self, method, path, **kwargs):
+        '''Sends a request, retrying transient failures
+
+        :param method: str HTTP method
+        :param path: str path of the route, such as "/api/status/1"
+        :param kwargs: json, data, params or headers for the request
+        :return: requests.Response, the last one if every attempt got a
+                 RETRY_STATUSES answer
+        :raises requests.RequestException: if the last attempt failed to
+                                           connect or timed out
+        '''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retried")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, self.server + path, timeout=self.timeout,
+                    **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record_latency(method, path, None)
+                if attempt == self.retries:
+                    raise
+                continue
+            self._record_latency(method, path,
+                                 time.perf_counter() - started)
+            if response.status_code not in RETRY_STATUSES:
+                break
+        return response
+
+    def add_attending(self, username, email, phone):
+        '''Adds an attending physician, as POST /api/new_attending'''
+        return self.request("POST", "/api/new_attending",
+                            json={"attending_username": username,
+                                  "attending_email": email,
+                                  "attending_phone": phone})
+
+    def add_patient(self, patient_id, username, age):
+        '''Adds a patient, as POST /api/new_patient'''
+        return self.request("POST", "/api/new_patient",
+                            json={"patient_id": patient_id,
+                                  "attending_username": username,
+                                  "patient_age": age})
+
+    def post_heart_rate(self, patient_id, heart_rate):
+        '''Stores one heart rate now, unbuffered, as POST /api/heart_rate'''
+        return self.request("POST", "/api/heart_rate",
+                            json={"patient_id": patient_id,
+                                  "heart_rate": heart_rate})
+
+    def heart_rates(self, patient_id, **params):
+        '''Gets heart rates, as GET /api/heart_rate/<patient_id>
+
+        :param params: history query parameters such as since or limit
+        '''
+        return self.request("GET", "/api/heart_rate/{}".format(patient_id),
+                            params=params)
+
+    def average(self, patient_id):
+        '''Gets the average heart rate of a patient'''
+        return self.request("GET",
+                            "/api/heart_rate/average/{}".format(patient_id))
+
+    def summary(self, patient_id):
+        '''Gets the heart rate summary of a patient'''
+        return self.request("GET",
+                            "/api/heart_rate/summary/{}".format(patient_id))
+
+    def status(self, patient_id, etag=None):
+        '''Gets the status of a patient, as GET /api/status/<patient_id>
+
+        :param etag: str ETag header of an earlier answer, to get a 304 if
+                     nothing changed since
+        '''
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.request("GET", "/api/status/{}".format(patient_id),
+                            headers=headers)
+
+    def interval_average(self, patient_id, since):
+        '''Gets the average heart rate of a patient since a timestamp'''
+        return self.request("POST", "/api/heart_rate/interval_average",
+                            json={"patient_id": patient_id,
+                                  "heart_rate_average_since":
+                                  batch_timestamp(since)})
+
+    def patients(self, username, etag=None):
+        '''Gets an attendant's patients, as GET /api/patients/<username>
+
+        :param etag: str ETag header of an earlier answer, to get a 304 if
+                     nothing changed since
+        '''
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.request("GET", "/api/patients/{}".format(username),
+                            headers=headers)
+
+    def alert_stats(self):
+        '''Gets the alert email statistics, as GET /api/alerts/stats'''
+        return self.request("GET", "/api/alerts/stats")
+
+    def add_reading(self, patient_id, heart_rate, timestamp=None):
+        '''Buffers a heart rate to be sent with the next flush
+
+        The reading keeps the time it was buffered, or the given timestamp,
+        however long it waits. The background flusher is started on the
+        first call.
+
+        :param patient_id: int containing patient ID
+        :param heart_rate: int heart rate
+        :param timestamp: str in "%Y-%m-%d %H:%M:%S" format, datetime
+                          object, or int epoch milliseconds, None for now
+        :return: True if the reading was buffered, False if the buffer is
+                 full and it was dropped
+        '''
+        if timestamp is None:
+            timestamp = datetime.now()
+        with self._lock:
+            if len(self._buffer) >= self.max_buffered:
+                self._counts["dropped"] += 1
+                return False
+            self._buffer.append((patient_id, heart_rate, timestamp))
+            full = len(self._buffer) >= self.batch_size
+        self.start()
+        if full:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        '''Starts the background flusher if it is not already running'''
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher,
+                                                 daemon=True,
+                                                 name="heart-rate-flusher")
+                self._flusher.start()
+
+    def flush(self):
+        '''Sends every buffered reading, batch_size readings per request
+
+        :return: int number of readings the server stored
+        :raises requests.RequestException: if a batch could not be sent;
+                                           its readings stay buffered
+        '''
+        stored = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return stored
+                path, kwargs = self._batch_request(batch)
+                try:
+                    response = self.request("POST", path, **kwargs)
+                except requests.RequestException:
+                    self._put_back(batch)
+                    raise
+                if response.status_code >= 500:
+                    self._put_back(batch)
+                    raise requests.HTTPError(
+                        "{} {}".format(response.status_code, response.text),
+                        response=response)
+                stored += self._record_result(batch, response.status_code,
+                                              response.text)
+
+    def close(self):
+        '''Stops the background flusher, flushes and closes the session
+
+        :raises requests.RequestException: if the last readings could not
+                                           be sent
+        '''
+        self._stopping.set()
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        try:
+            self.flush()
+        finally:
+            self.session.close()
+
+    def stats(self):
+        '''Returns counts of the readings handled by the client
+
+        :return: dictionary with buffered, sent, stored, rejected, dropped,
+                 retried (requests) and failed (flushes)
+        '''
+        with self._lock:
+            stats = dict(self._counts)
+            stats["buffered"] = len(self._buffer)
+        return stats
+
+    def latency_report(self):
+        '''Returns the latencies of the requests sent so far, by route
+
+        :return: dictionary from route name (see route_of) to the summary
+                 of its LatencyHistogram
+        '''
+        with self._lock:
+            return {route: histogram.summary() for route, histogram
+                    in sorted(self.latency.items())}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counts[key] += amount
+
+    def _record_latency(self, method, path, seconds):
+        route = route_of(method, path)
+        with self._lock:
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = LatencyHistogram()
+            if seconds is None:
+                histogram.errors += 1
+            else:
+                histogram.record(seconds)
+
+    def _take_batch(self):
+        with self._lock:
+            count = min(self.batch_size, len(self._buffer))
+            return [self._buffer.popleft() for i in range(count)]
+
+    def _put_back(self, batch):
+        self._count("failed")
+        with self._lock:
+            self._buffer.extendleft(reversed(batch))
+
+    def _batch_request(self, batch):
+        if self.binary:
+            return "/api/heart_rate/binary", {
+                "data": pack_records((patient_id, heart_rate,
+                                      to_epoch_ms(timestamp))
+                                     for patient_id, heart_rate, timestamp
+                                     in batch),
+                "headers": {"Content-Type": MIME_TYPE}}
+        return "/api/heart_rate/batch", {"json": [
+            {"patient_id": patient_id, "heart_rate": heart_rate,
+             "timestamp": batch_timestamp(timestamp)}
+            for patient_id, heart_rate, timestamp in batch]}
+
+    def _record_result(self, batch, status_code, body):
+        stored = 0
+        if status_code == 200:
+            stored = json.loads(body)["stored"]
+        else:
+            logging.warning("Heart rate batch refused: {}".format(body))
+        with self._lock:
+            self._counts["sent"] += len(batch)
+            self._counts["stored"] += stored
+            self._counts["rejected"] += len(batch) - stored
+        return stored
+
+    def _run_flusher(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except requests.RequestException as e:
+                logging.warning("Heart rate flush failed: {}".format(e))
+
+
+class AsyncHeartRateClient(HeartRateClient):
+    '''Client of the heart rate server for asyncio programs
+
+    This works like HeartRateClient, with the same routes, buffering,
+    retries and stats, but request and the route methods are coroutines
+    on an aiohttp session, and the flusher is a task on the running event
+    loop, so one gateway can feed thousands of patients without a thread
+    each. add_reading must be called from the event loop's thread. Answers
+    are aiohttp responses whose body has already been read, so status,
+    headers, text() and json() work after they are returned.
+
+    :param server: str base URL of the server
+    :param batch_size: int most readings sent in one request
+    :param flush_interval: float seconds between background flushes
+    :param retries: int number of retries after a failed request
+    :param backoff: float seconds to wait before the first retry
+    :param timeout: float seconds to wait for each answer
+    :param pool_size: int most connections kept open to the server
+    :param binary: True to send readings as packed binary records
+    :param max_buffered: int most readings waiting to be sent
+    '''
+
+    def _set_up_session(self):
+        self.session = None
+        self._flush_lock = None
+        self._wakeup = None
+        self._stopping = False
+        self._flusher = None
+
+    def _session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._flush_lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+        return self.session
+
+    async def request(self, method, path, **kwargs):
+        '''Sends a request, retrying transient failures
+
+        :param method: str HTTP method
+        :param path: str path of the route, such as "/api/status/1"
+        :param kwargs: json, data, params or headers for the request
+        :return: aiohttp response with its body read, the last one if
+                 every attempt got a RETRY_STATUSES answer
+        :raises aiohttp.ClientError: if the last attempt failed to connect
+        :raises asyncio.TimeoutError: if the last attempt timed out
+        '''
+        session = self._session()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retried")
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            started = time.perf_counter()
+            try:
+                async with session.request(method, self.server + path,
+                                           **kwargs) as response:
+                    await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self._record_latency(method, path, None)
+                if attempt == self.retries:
+                    raise
+                continue
+            self._record_latency(method, path,
+                                 time.perf_counter() - started)
+            if response.status not in RETRY_STATUSES:
+                break
+        return response
+
+    def add_reading(self, patient_id, heart_rate, timestamp=None):
+        self._session()
+        return super().add_reading(patient_id, heart_rate, timestamp)
+
+    def start(self):
+        '''Starts the flusher task if it is not already running'''
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._run_flusher())
+
+    async def flush(self):
+        '''Sends every buffered reading, batch_size readings per request
+
+        :return: int number of readings the server stored
+        :raises aiohttp.ClientError: if a batch could not be sent; its
+                                     readings stay buffered
+        '''
+        self._session()
+        stored = 0
+        async with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return stored
+                path, kwargs = self._batch_request(batch)
+                try:
+                    response = await self.request("POST", path, **kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    self._put_back(batch)
+                    raise
+                if response.status >= 500:
+                    self._put_back(batch)
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history,
+                        status=response.status, message=await response.text())
+                stored += self._record_result(batch, response.status,
+                                              await response.text())
+
+    async def close(self):
+        '''Stops the flusher task, flushes and closes the session
+
+        :raises aiohttp.ClientError: if the last readings could not be sent
+        '''
+        self._stopping = True
+        if self._flusher is not None:
+            self._wakeup.set()
+            await self._flusher
+        try:
+            await self.flush()
+        finally:
+            if self.session is not None:
+                await self.session.close()
+
+    async def __aenter__(self):
+        self._session()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _run_flusher(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning("Heart rate flush failed: {}".format(e))
+
+
+def heart_rate_walk(rng, age, rate, episodes=6.0, episode_seconds=30.0):
+    '''Makes the heart rates of one simulated patient
+
+    Heart rates wander around a resting rate below the tachycardia limit
+    for the patient's age. Tachycardic episodes start at random, episodes
+    times an hour on average, and keep the heart rate above the limit for
+    episode_seconds.
+
+    :param rng: random.Random
+    :param age: int age in years
+    :param rate: float readings per second
+    :param episodes: float tachycardic episodes per hour
+    :param episode_seconds: float seconds each episode lasts
+    :return: generator of (int heart rate, bool tachycardic) pairs
+    '''
+    limit = default_table.limit(age)
+    low, high = limit - 60, limit - 5
+    heart_rate = (low + high) // 2
+    start_chance = episodes / 3600 / rate
+    episode_left = 0
+    while True:
+        if not episode_left and rng.random() < start_chance:
+            episode_left = max(1, round(episode_seconds * rate))
+        if episode_left:
+            episode_left -= 1
+            yield rng.randint(limit + 5, limit + 40), True
+            continue
+        heart_rate = min(high, max(low, heart_rate + rng.randint(-3, 3)))
+        yield heart_rate, False
+
+
+async def run_monitor(client, patient_id, walk, rate, stop_at, mode, totals,
+                      sends, phase=0.0):
+    '''Sends one patient's heart rates at a fixed rate until stop_at
+
+    Readings are sent on schedule whether or not earlier ones have been
+    answered, as real monitors would, so a slow server shows up as
+    latency rather than as fewer readings. In "single" mode each reading
+    is its own POST /api/heart_rate; otherwise readings go through the
+    client's buffer.
+
+    :param client: AsyncHeartRateClient
+    :param patient_id: int containing patient ID
+    :param walk: generator made by heart_rate_walk
+    :param rate: float readings per second
+    :param stop_at: float time.monotonic() to stop at
+    :param mode: str "single", "batch" or "binary"
+    :param totals: dictionary of counts, updated in place
+    :param sends: set of pending send tasks, updated in place
+    :param phase: float seconds to wait before the first reading
+    '''
+    async def send(heart_rate):
+        try:
+            response = await client.post_heart_rate(patient_id, heart_rate)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            totals["failed"] += 1
+            return
+        if response.status != 200:
+            totals["rejected"] += 1
+
+    next_at = time.monotonic() + phase
+    while next_at < stop_at:
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -1 / rate:
+            totals["late"] += 1
+        heart_rate, tachycardic = next(walk)
+        totals["readings"] += 1
+        totals["tachycardic"] += tachycardic
+        if mode == "single":
+            task = asyncio.ensure_future(send(heart_rate))
+            sends.add(task)
+            task.add_done_callback(sends.discard)
+        elif not client.add_reading(patient_id, heart_rate):
+            totals["failed"] += 1
+        next_at += 1 / rate
+
+
+async def run_dashboard(client, username, interval, stop_at, totals,
+                        phase=0.0):
+    '''Polls an attendant's patient list with its ETag until stop_at
+
+    :param client: AsyncHeartRateClient
+    :param username: str attending username
+    :param interval: float seconds between polls
+    :param stop_at: float time.monotonic() to stop at
+    :param totals: dictionary of counts, updated in place
+    :param phase: float seconds to wait before the first poll
+    '''
+    etag = None
+    await asyncio.sleep(min(phase, max(0.0, stop_at - time.monotonic())))
+    while time.monotonic() < stop_at:
+        try:
+            response = await client.patients(username, etag)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            totals["failed"] += 1
+        else:
+            if response.status == 304:
+                totals["roster_unchanged"] += 1
+            elif response.status == 200:
+                totals["roster_changed"] += 1
+                etag = response.headers.get("ETag")
+        await asyncio.sleep(min(interval,
+                                max(0.0, stop_at - time.monotonic())))
+
+
+async def drain_alerts(client, timeout=10.0):
+    '''Waits for the server to finish sending its queued alert emails
+
+    Alerts are finished once sent or given up on, so emails still being
+    delivered after leaving the queue are waited for too.
+
+    :param client: AsyncHeartRateClient
+    :param timeout: float seconds to wait at most
+    :return: dictionary from GET /api/alerts/stats, None if unavailable
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await client.alert_stats()
+            stats = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+        handled = stats.get("sent", 0) + stats.get("failed", 0)
+        if handled >= stats.get("queued", 0) or \
+                time.monotonic() > deadline:
+            return stats
+        await asyncio.sleep(0.1)
+
+
+async def simulate_fleet(server=server_name, attendants=10, patients=100,
+                         rate=1.0, duration=10.0, mode="single",
+                         episodes=6.0, episode_seconds=30.0,
+                         dashboard_interval=5.0, pool_size=100,
+                         first_patient_id=100000, seed=1,
+                         email_stub_port=None):
+    '''Registers a fleet of attendants and patients and streams readings
+
+    Every patient gets a monitor sending heart rates from heart_rate_walk
+    at rate readings per second, and every attendant gets a dashboard
+    polling their patient list, all on one event loop over one pooled
+    AsyncHeartRateClient. Patients get random ages and are spread evenly
+    over the attendants. If email_stub_port is given the email stub (see
+    email_stub) runs in this process on that port, and the server should
+    have been started with HR_EMAIL_SERVER pointing at it.
+
+    :param server: str base URL of the server
+    :param attendants: int number of attending physicians
+    :param patients: int number of patients
+    :param rate: float readings per second per patient
+    :param duration: float seconds to stream readings for
+    :param mode: str "single", "batch" or "binary"
+    :param episodes: float tachycardic episodes per patient per hour
+    :param episode_seconds: float seconds each episode lasts
+    :param dashboard_interval: float seconds between dashboard polls, 0 for
+                               no dashboards
+    :param pool_size: int most connections open to the server
+    :param first_patient_id: int ID of the first patient
+    :param seed: int seed of the random ages, phases and heart rates
+    :param email_stub_port: int port of an email stub to run, None for none
+    :return: dictionary with the settings, counts, client stats, latency
+             by route, server alert stats and stub email counts
+    '''
+    rng = random.Random(seed)
+    stub = None
+    if email_stub_port is not None:
+        stub, _ = await start_stub(port=email_stub_port)
+    totals = dict.fromkeys(("registered", "not_registered", "readings",
+                            "tachycardic", "rejected", "failed", "late",
+                            "roster_changed", "roster_unchanged"), 0)
+    client = AsyncHeartRateClient(server, pool_size=pool_size,
+                                  flush_interval=0.5,
+                                  binary=mode == "binary")
+    usernames = ["Sim.{}".format(i) for i in range(attendants)]
+    ages = [rng.randrange(0, 90) for _ in range(patients)]
+    try:
+        async def register(request):
+            response = await request
+            key = "registered" if response.status == 200 else \
+                "not_registered"
+            totals[key] += 1
+
+        await asyncio.gather(*(register(client.add_attending(
+            username, username.lower() + "@example.com", "919-200-8973"))
+            for username in usernames))
+        await asyncio.gather(*(register(client.add_patient(
+            first_patient_id + i, usernames[i % attendants], age))
+            for i, age in enumerate(ages)))
+        started = time.monotonic()
+        stop_at = started + duration
+        sends = set()
+        work = [run_monitor(client, first_patient_id + i,
+                            heart_rate_walk(rng, age, rate, episodes,
+                                            episode_seconds),
+                            rate, stop_at, mode, totals, sends,
+                            rng.random() / rate)
+                for i, age in enumerate(ages)]
+        if dashboard_interval:
+            work += [run_dashboard(client, username, dashboard_interval,
+                                   stop_at, totals,
+                                   rng.random() * dashboard_interval)
+                     for username in usernames]
+        await asyncio.gather(*work)
+        await asyncio.gather(*sends)
+        await client.flush()
+        elapsed = time.monotonic() - started
+        alerts = await drain_alerts(client)
+    finally:
+        await client.close()
+        if stub is not None:
+            await stub.cleanup()
+    report = {"server": server, "mode": mode, "attendants": attendants,
+              "patients": patients, "rate": rate, "duration": duration,
+              "elapsed": elapsed, "totals": totals,
+              "client": client.stats(), "routes": client.latency_report(),
+              "alerts": alerts, "emails": None}
+    if stub is not None:
+        emails = stub_stats(stub)
+        report["emails"] = {key: emails[key] for key in
+                            ("received", "failed", "rejected")}
+    return report
+
+
+def format_report(report):
+    '''Writes a fleet simulation report as text
+
+    :param report: dictionary returned by simulate_fleet
+    :return: str report with a latency table by route
+    '''
+    totals = report["totals"]
+    lines = ["{} patients of {} attendants at {} readings/s each for "
+             "{:.1f} s ({} mode) against {}".format(
+                 report["patients"], report["attendants"], report["rate"],
+                 report["elapsed"], report["mode"], report["server"]),
+             "{} readings ({:.0f}/s), {} tachycardic, {} rejected, "
+             "{} failed, {} sent late".format(
+                 totals["readings"], totals["readings"] / report["elapsed"],
+                 totals["tachycardic"], totals["rejected"], totals["failed"],
+                 totals["late"]),
+             "{} registered ({} refused), dashboard polls: {} changed, "
+             "{} unchanged".format(
+                 totals["registered"], totals["not_registered"],
+                 totals["roster_changed"], totals["roster_unchanged"])]
+    if report["alerts"] is not None:
+        lines.append("Server alerts: {} queued, {} sent, {} failed, "
+                     "{} dropped".format(
+                         *(report["alerts"].get(key) for key in
+                           ("queued", "sent", "failed", "dropped"))))
+    if report["emails"] is not None:
+        lines.append("Email stub: {received} received, {failed} failed, "
+                     "{rejected} rejected".format(**report["emails"]))
+    lines.append("{:<40} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+        "route", "count", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for route, summary in report["routes"].items():
+        times = ["{:>9.2f}".format(1e3 * summary[key])
+                 if summary[key] is not None else "{:>9}".format("-")
+                 for key in ("p50", "p90", "p99", "max")]
+        lines.append("{:<40} {:>8} {:>6} ".format(
+            route, summary["count"], summary["errors"]) + " ".join(times))
+    return "\n".join(lines)
+
+
+def add_new_patient(client):
+    r = client.add_patient(1, "Duncan.C", 21)
     print(r.text)
-    r = requests.post(server_name + "/api/heart_rate", json=new_heart_rate2)
+    r = client.add_patient(2, "Therien.A", 21)
     print(r.text)
-    r = requests.post(server_name + "/api/heart_rate", json=new_heart_rate3)
+    r = client.add_patient(3, "Therien.A", 65)
     print(r.text)
 
 
-def add_heart_rate2():
-    new_heart_rate = {"patient_id": 1, "heart_rate": 90}
-    new_heart_rate2 = {"patient_id": 1, "heart_rate": 60}
-    r = requests.post(server_name+"/api/heart_rate", json=new_heart_rate)
-    print(r.text)
-    r = requests.post(server_name + "/api/heart_rate", json=new_heart_rate2)
-    print(r.text)
+def add_heart_rate(client):
+    for patient_id, heart_rate in ((1, 90), (2, 60), (2, 65), (2, 70),
+                                   (3, 150)):
+        r = client.post_heart_rate(patient_id, heart_rate)
+        print(r.text)
 
 
-def add_new_attendant():
-    new_attendant = {"attending_username": "Duncan.C",
-                     "attending_email": "c.duncan@duke.edu",
-                     "attending_phone": "919-265-9874",
-                     "patients": list()}
-    r = requests.post(server_name+"/api/new_attending", json=new_attendant)
+def add_heart_rate2(client):
+    client.add_reading(1, 90)
+    client.add_reading(1, 60)
+    print(client.flush())
+
+
+def add_new_attendant(client):
+    r = client.add_attending("Duncan.C", "c.duncan@duke.edu",
+                             "919-265-9874")
     print(r.text)
-    new_attendant = {"attending_username": "Therien.A",
-                     "attending_email": "a.therien@duke.edu",
-                     "attending_phone": "919-265-9874",
-                     "patients": list()}
-    r = requests.post(server_name + "/api/new_attending", json=new_attendant)
+    r = client.add_attending("Therien.A", "a.therien@duke.edu",
+                             "919-265-9874")
     print(r.text)
 
 
-def get_heart_rate():
-    r = requests.get(server_name+"/api/heart_rate/1")
+def get_heart_rate(client):
+    r = client.heart_rates(1)
     print(r.text)
 
 
-def get_avg_heart_rate():
-    r = requests.get(server_name + "/api/heart_rate/average/3")
+def get_avg_heart_rate(client):
+    r = client.average(3)
     print(r.text)
 
 
-def get_patient_status():
-    r = requests.get(server_name + "/api/status/3")
+def get_patient_status(client):
+    r = client.status(3)
     print(r.text)
-    r = requests.get(server_name + "/api/status/1")
+    r = client.status(1)
 
 
-def get_interval_avg_hr(time):
-    file = {"patient_id": 1,
-            "heart_rate_average_since": time
-            }
+def get_interval_avg_hr(client, time):
     print(time)
-    r = requests.post(server_name +
-                      "/api/heart_rate/interval_average", json=file)
+    r = client.interval_average(1, time)
     print(r.text)
 
 
-def get_patients_for_attending_username():
-    r = requests.get(server_name + "/api/patients/Therien.A")
+def get_patients_for_attending_username(client):
+    r = client.patients("Therien.A")
     print(r.text)
 
 
+def run_demo(server=server_name):
+    '''Runs the demo requests against a server
+
+    :param server: str base URL of the server
+    '''
+    with HeartRateClient(server) as client:
+        add_new_attendant(client)
+        add_new_patient(client)
+        add_heart_rate(client)
+        get_avg_heart_rate(client)
+        str_time = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+        get_patient_status(client)
+        add_heart_rate2(client)
+        get_patients_for_attending_username(client)
+        get_interval_avg_hr(client, str_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Heart rate server client: a short demo, or a fleet of "
+                    "simulated monitors for load tests")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("demo", help="run the demo requests (default)")
+    simulate = commands.add_parser(
+        "simulate", help="stream readings from simulated monitors")
+    simulate.add_argument("--server", default=server_name)
+    simulate.add_argument("--attendants", type=int, default=10)
+    simulate.add_argument("--patients", type=int, default=100)
+    simulate.add_argument("--rate", type=float, default=1.0,
+                          help="readings per second per patient")
+    simulate.add_argument("--duration", type=float, default=10.0,
+                          help="seconds to stream readings for")
+    simulate.add_argument("--mode", default="single",
+                          choices=("single", "batch", "binary"))
+    simulate.add_argument("--episodes", type=float, default=6.0,
+                          help="tachycardic episodes per patient per hour")
+    simulate.add_argument("--episode-seconds", type=float, default=30.0)
+    simulate.add_argument("--dashboard-interval", type=float, default=5.0,
+                          help="seconds between dashboard polls, 0 for "
+                               "none")
+    simulate.add_argument("--pool-size", type=int, default=100)
+    simulate.add_argument("--first-patient-id", type=int, default=100000)
+    simulate.add_argument("--seed", type=int, default=1)
+    simulate.add_argument("--email-stub-port", type=int,
+                          help="run the email stub on this port")
+    args = parser.parse_args()
+    if args.command != "simulate":
+        run_demo()
+        return
+    report = asyncio.run(simulate_fleet(
+        args.server, args.attendants, args.patients, args.rate,
+        args.duration, args.mode, args.episodes, args.episode_seconds,
+        args.dashboard_interval, args.pool_size, args.first_patient_id,
+        args.seed, args.email_stub_port))
+    print(format_report(report))
+
+
 if __name__ == '__main__':
-    add_new_attendant()
-    add_new_patient()
-    add_heart_rate()
-    get_avg_heart_rate()
-    str_time = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-    get_patient_status()
-    add_heart_rate2()
-    get_patients_for_attending_username()
-    get_interval_avg_hr(str_time)
+    main()
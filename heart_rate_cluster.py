@@ -0,0 +1,604 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from flask import Flask, Response, request, stream_with_context
+from werkzeug.serving import make_server
+
+from binary_ingest import MIME_TYPE, record_array
+from heart_rate_server import NdjsonSplitter
+from json_codec import CodecJSONProvider, get_codec
+
+FORWARDED_HEADERS = ("Content-Type", "If-None-Match")
+RETURNED_HEADERS = ("Content-Type", "ETag", "Cache-Control",
+                    "X-Accel-Buffering")
+EVENT_KEEPALIVE = 15
+COUNTED_STATS = ("queue_depth", "queued", "sent", "failed", "retried",
+                 "dropped")
+
+
+def partition_for(patient_id, partitions):
+    '''Returns the number of the worker that owns a patient
+
+    Numeric patient IDs are spread by their value modulo the number of
+    workers; anything else is hashed with CRC32 so that it still always
+    lands on the same worker.
+
+    :param patient_id: int or str containing patient ID
+    :param partitions: int number of workers
+    :return: int worker number from 0 to partitions - 1
+    '''
+    try:
+        return int(patient_id) % partitions
+    except (TypeError, ValueError):
+        return zlib.crc32(str(patient_id).encode("utf-8")) % partitions
+
+
+def split_batch(records, partitions):
+    '''Splits a heart rate batch into one batch per owning worker
+
+    Records that are not dictionaries or have no patient_id are sent to
+    worker 0, which reports the problem for them.
+
+    :param records: list of reading dictionaries
+    :param partitions: int number of workers
+    :return: dictionary from worker number to a list of the indexes of its
+             records and a list of the records
+    '''
+    parts = dict()
+    for i, record in enumerate(records):
+        worker = 0
+        if isinstance(record, dict) and "patient_id" in record:
+            worker = partition_for(record["patient_id"], partitions)
+        indexes, batch = parts.setdefault(worker, (list(), list()))
+        indexes.append(i)
+        batch.append(record)
+    return parts
+
+
+def merge_batch_results(count, parts):
+    '''Puts the results of per-worker batches back in the original order
+
+    :param count: int number of records in the original batch
+    :param parts: list of (indexes, results) pairs, one per worker
+    :return: list of result dictionaries
+    '''
+    results = [None] * count
+    for indexes, part_results in parts:
+        for i, result in zip(indexes, part_results):
+            results[i] = result
+    return results
+
+
+def split_binary(data, partitions):
+    '''Splits packed binary records into one run per owning worker
+
+    :param data: bytes-like object holding whole records
+    :param partitions: int number of workers
+    :return: dictionary from worker number to bytes of its records
+    :raises ValueError: if data is not a whole number of records
+    '''
+    records = record_array(data)
+    owners = records["patient_id"] % partitions
+    return {int(worker): records[owners == worker].tobytes()
+            for worker in np.unique(owners)}
+
+
+def merge_binary_results(results):
+    '''Adds up the answers of workers to parts of a binary upload
+
+    :param results: list of result dictionaries from the workers
+    :return: result dictionary for the whole upload
+    '''
+    merged = {"stored": 0, "rejected": 0, "tachycardic": 0,
+              "errors": list()}
+    for result in results:
+        for key in ("stored", "rejected", "tachycardic"):
+            merged[key] += result[key]
+        merged["errors"].extend(result["errors"])
+    merged["errors"].sort(key=lambda error: error["patient_id"])
+    return merged
+
+
+def split_ndjson_lines(lines, partitions, loads=json.loads):
+    '''Splits numbered NDJSON lines into one group per owning worker
+
+    Lines that are too long or not valid JSON cannot be routed and are
+    given their acknowledgement here. Readings that are not dictionaries
+    or have no patient_id are sent to worker 0, which reports the problem
+    for them.
+
+    :param lines: list of (line number, bytes line) pairs, with None for
+                  lines that were too long
+    :param partitions: int number of workers
+    :param loads: function that parses a line of JSON
+    :return: dictionary from worker number to a list of line numbers and
+             a list of the lines, and a dictionary from line number to
+             (message, status code) for the lines that were not routed
+    '''
+    parts = dict()
+    acks = dict()
+    for number, line in lines:
+        if line is None:
+            acks[number] = ("line is too long", 400)
+            continue
+        try:
+            reading = loads(line)
+        except ValueError:
+            acks[number] = ("line is not valid JSON", 400)
+            continue
+        worker = 0
+        if isinstance(reading, dict) and "patient_id" in reading:
+            worker = partition_for(reading["patient_id"], partitions)
+        numbers, group = parts.setdefault(worker, (list(), list()))
+        numbers.append(number)
+        group.append(line)
+    return parts, acks
+
+
+def merge_rosters(rosters):
+    '''Merges the roster rows that each worker holds for an attendant
+
+    :param rosters: list of lists of roster row dictionaries
+    :return: list of roster rows ordered by patient_id
+    '''
+    rows = [row for roster in rosters for row in roster]
+    return sorted(rows, key=lambda row: row["patient_id"])
+
+
+def merge_alert_stats(stats_list):
+    '''Adds up the email queue statistics of the workers
+
+    :param stats_list: list of dictionaries from GET /api/alerts/stats
+    :return: dictionary in the same format covering every worker
+    '''
+    merged = {key: sum(stats[key] for stats in stats_list)
+              for key in COUNTED_STATS}
+    merged["average_latency"] = None
+    if merged["sent"]:
+        merged["average_latency"] = sum(
+            stats["average_latency"] * stats["sent"]
+            for stats in stats_list if stats["sent"]) / merged["sent"]
+    latencies = [stats["last_latency"] for stats in stats_list
+                 if stats["last_latency"] is not None]
+    merged["last_latency"] = max(latencies) if latencies else None
+    return merged
+
+
+def iter_sse_events(lines):
+    '''Reads Server-Sent Events from the lines of a response
+
+    Comment lines (such as keep-alives) are skipped.
+
+    :param lines: iterable of str lines without line endings
+    :return: generator of (event, data) pairs
+    '''
+    event = "message"
+    data = list()
+    for line in lines:
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event = "message"
+            data = list()
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].lstrip())
+
+
+def create_router(worker_urls, timeout=30, codec=None):
+    '''Builds the Flask app that spreads the server routes over workers
+
+    Each worker is a separate heart_rate_server process that owns the
+    patients whose IDs partition_for assigns to it. Routes about one
+    patient are forwarded to the owning worker: by the patient_id in the
+    URL, or in the JSON body for POST routes. New attendants are sent to
+    every worker, since each one checks and emails attendants itself; if
+    only some of the workers store one, the response is a 502 naming the
+    workers that did not.
+    Heart rate batches are split by owner and sent in parallel, and the
+    lines of an NDJSON stream are split the same way each time a chunk of
+    the body arrives, with each worker's lines forwarded to its own
+    stream route and the acknowledgements put back in order. The attendant
+    patient list, its event stream and the alert statistics are gathered
+    from every worker and merged.
+
+    :param worker_urls: list of str base URLs of the workers, in
+                        partition order
+    :param timeout: float seconds to wait for a worker to respond
+    :param codec: JSON codec object (see json_codec) for the stream
+                  acknowledgements, None for the fastest one installed
+    :return: Flask app
+    '''
+    router = Flask(__name__)
+    router.json = CodecJSONProvider(router, codec)
+    dumps = router.json.codec.dumps
+    loads = router.json.codec.loads
+    local = threading.local()
+    pool = ThreadPoolExecutor(max_workers=max(4, 2 * len(worker_urls)))
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def call(worker, method, path, body=None, headers=None, stream=False):
+        return session().request(method, worker_urls[worker] + path,
+                                 data=body, headers=headers or {},
+                                 stream=stream, timeout=timeout)
+
+    def incoming_headers():
+        return {key: request.headers[key] for key in FORWARDED_HEADERS
+                if key in request.headers}
+
+    def relay(response):
+        headers = {key: response.headers[key] for key in RETURNED_HEADERS
+                   if key in response.headers}
+        relayed = Response(response.iter_content(65536),
+                           status=response.status_code, headers=headers)
+        relayed.call_on_close(response.close)
+        return relayed
+
+    def forward(worker):
+        path = request.full_path if request.query_string else request.path
+        response = call(worker, request.method, path, request.get_data(),
+                        incoming_headers(), stream=True)
+        return relay(response)
+
+    def owner_of_body():
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and "patient_id" in body:
+            return partition_for(body["patient_id"], len(worker_urls))
+        return 0
+
+    def gather(method, path, body=None, headers=None):
+        futures = [pool.submit(call, worker, method, path, body, headers)
+                   for worker in range(len(worker_urls))]
+        return [future.result() for future in futures]
+
+    @router.route("/api/new_attending", methods=["POST"])
+    def post_new_attending():
+        futures = [pool.submit(call, worker, "POST", "/api/new_attending",
+                               request.get_data(), incoming_headers())
+                   for worker in range(len(worker_urls))]
+        responses = list()
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except requests.RequestException:
+                responses.append(None)
+        failed = [worker for worker, response in enumerate(responses)
+                  if response is None or response.status_code != 200]
+        if not failed or (len(failed) == len(responses) and
+                          responses[0] is not None):
+            return relay(responses[0])
+        return ("Attendant information not stored on workers " +
+                ", ".join(str(worker) for worker in failed), 502)
+
+    @router.route("/api/new_patient", methods=["POST"])
+    @router.route("/api/heart_rate", methods=["POST"])
+    @router.route("/api/heart_rate/interval_average", methods=["POST"])
+    def post_patient_route():
+        return forward(owner_of_body())
+
+    @router.route("/api/heart_rate/<patient_id>", methods=["GET"])
+    @router.route("/api/heart_rate/average/<patient_id>", methods=["GET"])
+    @router.route("/api/heart_rate/summary/<patient_id>", methods=["GET"])
+    @router.route("/api/status/<patient_id>", methods=["GET"])
+    def get_patient_route(patient_id):
+        return forward(partition_for(patient_id, len(worker_urls)))
+
+    @router.route("/api/heart_rate/batch", methods=["POST"])
+    def post_heart_rate_batch():
+        records = request.get_json(silent=True)
+        if type(records) is dict:
+            records = records.get("readings")
+        if type(records) is not list:
+            return forward(0)
+        parts = split_batch(records, len(worker_urls))
+        futures = [(indexes, pool.submit(
+            call, worker, "POST", "/api/heart_rate/batch",
+            json.dumps(batch), {"Content-Type": "application/json"}))
+            for worker, (indexes, batch) in parts.items()]
+        merged = list()
+        for indexes, future in futures:
+            response = future.result()
+            if response.status_code != 200:
+                return relay(response)
+            merged.append((indexes, response.json()["results"]))
+        results = merge_batch_results(len(records), merged)
+        stored = sum(1 for result in results if result["stored"])
+        return Response(json.dumps({"stored": stored,
+                                    "rejected": len(results) - stored,
+                                    "results": results}),
+                        mimetype="application/json")
+
+    @router.route("/api/heart_rate/binary", methods=["POST"])
+    def post_heart_rate_binary():
+        try:
+            parts = split_binary(request.get_data(), len(worker_urls))
+        except ValueError:
+            return forward(0)
+        if request.mimetype != MIME_TYPE or not parts:
+            return forward(0)
+        futures = [pool.submit(call, worker, "POST",
+                               "/api/heart_rate/binary", records,
+                               {"Content-Type": MIME_TYPE})
+                   for worker, records in parts.items()]
+        results = list()
+        for future in futures:
+            response = future.result()
+            if response.status_code != 200:
+                return relay(response)
+            results.append(response.json())
+        return Response(json.dumps(merge_binary_results(results)),
+                        mimetype="application/json")
+
+    def forward_lines(lines):
+        parts, acks = split_ndjson_lines(lines, len(worker_urls), loads)
+        futures = [(numbers, pool.submit(
+            call, worker, "POST", "/api/heart_rate/stream",
+            b"\n".join(group) + b"\n",
+            {"Content-Type": "application/x-ndjson"}))
+            for worker, (numbers, group) in parts.items()]
+        for numbers, future in futures:
+            response = future.result()
+            if response.status_code != 200:
+                for number in numbers:
+                    acks[number] = (response.text, response.status_code)
+                continue
+            replies = [loads(reply)
+                       for reply in response.content.splitlines()]
+            for number, reply in zip(numbers, replies):
+                acks[number] = (reply["message"], reply["status_code"])
+        return sorted(acks.items())
+
+    @router.route("/api/heart_rate/stream", methods=["POST"])
+    def post_heart_rate_stream():
+        stream = request.stream
+
+        def generate():
+            splitter = NdjsonSplitter()
+            number = 0
+            stored = 0
+            rejected = 0
+            while True:
+                chunk = stream.read(65536)
+                lines = list()
+                for line in (splitter.feed(chunk) if chunk
+                             else splitter.close()):
+                    number += 1
+                    if line is None or line.strip():
+                        lines.append((number, line))
+                for line_number, (message, code) in forward_lines(lines):
+                    if code == 200:
+                        stored += 1
+                    else:
+                        rejected += 1
+                    yield dumps({"line": line_number, "status_code": code,
+                                 "message": message}) + b"\n"
+                if not chunk:
+                    break
+            yield dumps({"stored": stored, "rejected": rejected}) + b"\n"
+
+        return Response(stream_with_context(generate()),
+                        mimetype="application/x-ndjson")
+
+    @router.route("/api/alerts/stats", methods=["GET"])
+    def get_alert_stats():
+        responses = gather("GET", "/api/alerts/stats")
+        merged = merge_alert_stats([response.json()
+                                    for response in responses])
+        return Response(json.dumps(merged), mimetype="application/json")
+
+    @router.route("/api/patients/<attending_username>", methods=["GET"])
+    def get_patients_for_attending_username(attending_username):
+        path = "/api/patients/" + attending_username
+        tags = [None] * len(worker_urls)
+        if request.if_none_match:
+            tags = combined_tags(request.headers["If-None-Match"])
+        futures = list()
+        for worker, tag in enumerate(tags):
+            headers = {"If-None-Match": '"' + tag + '"'} if tag else None
+            futures.append(pool.submit(call, worker, "GET", path, None,
+                                       headers))
+        responses = [future.result() for future in futures]
+        for response in responses:
+            if response.status_code not in (200, 304):
+                return relay(response)
+        etag = ".".join(response.headers.get("ETag", "").strip('"')
+                        for response in responses)
+        if all(response.status_code == 304 for response in responses):
+            result = Response(status=304)
+            result.set_etag(etag)
+            return result
+        rosters = list()
+        for worker, response in enumerate(responses):
+            if response.status_code == 304:
+                response = call(worker, "GET", path)
+            rosters.append(response.json())
+        result = Response(json.dumps(merge_rosters(rosters)),
+                          mimetype="application/json")
+        result.set_etag(etag)
+        return result
+
+    def combined_tags(header):
+        tag = header.split(",")[0].strip().strip('"')
+        tags = tag.split(".")
+        if len(tags) != len(worker_urls):
+            return [None] * len(worker_urls)
+        return tags
+
+    @router.route("/api/patients/<attending_username>/events",
+                  methods=["GET"])
+    def get_patient_events(attending_username):
+        path = "/api/patients/" + attending_username + "/events"
+        futures = [pool.submit(call, worker, "GET", path, stream=True)
+                   for worker in range(len(worker_urls))]
+        responses = [future.result() for future in futures]
+        for response in responses:
+            if response.status_code != 200:
+                for other in responses:
+                    other.close()
+                return relay(response)
+        events = [iter_sse_events(response.iter_lines(
+            decode_unicode=True)) for response in responses]
+        rosters = [json.loads(next(stream)[1]) for stream in events]
+        updates = queue.Queue()
+
+        def pump(stream):
+            try:
+                for event in stream:
+                    updates.put(event)
+            except Exception:
+                pass
+
+        for stream in events:
+            threading.Thread(target=pump, args=(stream,),
+                             daemon=True).start()
+
+        def generate():
+            try:
+                yield "event: roster\ndata: " + \
+                    json.dumps(merge_rosters(rosters)) + "\n\n"
+                while True:
+                    try:
+                        event, data = updates.get(timeout=EVENT_KEEPALIVE)
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"
+                        continue
+                    yield "event: " + event + "\ndata: " + data + "\n\n"
+            finally:
+                for response in responses:
+                    response.close()
+
+        return Response(generate(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
+
+    return router
+
+
+def worker_environment(environ, index):
+    '''Returns the HR_ settings of a worker
+
+    Every worker gets the same settings except that HR_DATA_DIR and
+    HR_SEGMENT_DIR point to a worker-<index> directory inside the given
+    ones, so workers never share files, and HR_BINARY_PORT is left out, as
+    binary records reach the workers through the router.
+
+    :param environ: dictionary of environment variables
+    :param index: int worker number
+    :return: dictionary of environment variables for the worker
+    '''
+    environ = dict(environ)
+    environ.pop("HR_BINARY_PORT", None)
+    for key in ("HR_DATA_DIR", "HR_SEGMENT_DIR"):
+        if environ.get(key):
+            environ[key] = os.path.join(environ[key],
+                                        "worker-{}".format(index))
+    return environ
+
+
+def serve_worker(index, host, port, environ):
+    '''Runs one worker: a heart_rate_server on its own port
+
+    :param index: int worker number
+    :param host: str host to listen on
+    :param port: int port to listen on
+    :param environ: dictionary of HR_ settings, as for
+                    heart_rate_server.open_from_environment
+    '''
+    import heart_rate_server
+    heart_rate_server.open_from_environment(
+        worker_environment(environ, index))
+    make_server(host, port, heart_rate_server.app,
+                threaded=True).serve_forever()
+
+
+def start_workers(count, host="127.0.0.1", base_port=5101, environ=None):
+    '''Starts worker processes
+
+    :param count: int number of workers
+    :param host: str host the workers listen on
+    :param base_port: int port of worker 0; worker i uses base_port + i
+    :param environ: dictionary of HR_ settings, os.environ if None
+    :return: list of processes and list of str worker base URLs
+    '''
+    if environ is None:
+        environ = dict(os.environ)
+    context = multiprocessing.get_context("spawn")
+    processes = list()
+    urls = list()
+    for index in range(count):
+        process = context.Process(target=serve_worker, daemon=True,
+                                  args=(index, host, base_port + index,
+                                        environ))
+        process.start()
+        processes.append(process)
+        urls.append("http://{}:{}".format(host, base_port + index))
+    return processes, urls
+
+
+def wait_for_workers(urls, timeout=30):
+    '''Waits until every worker answers requests
+
+    :param urls: list of str worker base URLs
+    :param timeout: float seconds to wait in total
+    :return: True if every worker answered, False if the time ran out
+    '''
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                requests.get(url + "/api/alerts/stats", timeout=1)
+                break
+            except requests.exceptions.RequestException:
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(0.1)
+    return True
+
+
+def run_cluster(workers, host="127.0.0.1", port=5000, base_port=5101):
+    '''Starts the workers and serves the router until interrupted
+
+    :param workers: int number of worker processes
+    :param host: str host to listen on
+    :param port: int port of the router
+    :param base_port: int port of worker 0
+    '''
+    processes, urls = start_workers(workers, "127.0.0.1", base_port)
+    try:
+        if not wait_for_workers(urls):
+            raise RuntimeError("workers did not start")
+        codec = get_codec(os.environ.get("HR_JSON_CODEC"))
+        make_server(host, port, create_router(urls, codec=codec),
+                    threaded=True).serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Runs the heart rate server as several worker "
+                    "processes behind a router")
+    parser.add_argument("--workers", type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--base-port", type=int, default=5101)
+    args = parser.parse_args()
+    run_cluster(args.workers, args.host, args.port, args.base_port)
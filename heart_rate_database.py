@@ -0,0 +1,430 @@
+import threading
+
+from heart_rate_series import attach_series
+
+
+def normalize_id(patient_id):
+    '''Converts a numeric string patient ID into an int
+
+    Patient IDs arrive from the routes either as ints (JSON bodies) or as
+    strings (variable URLs). Everything stored in the database uses ints,
+    so numeric strings are converted before lookups.
+
+    :param patient_id: int or str containing patient ID
+    :return: int patient ID if input is numeric, input unchanged otherwise
+    '''
+    if type(patient_id) == str and patient_id.isdigit():
+        return int(patient_id)
+    return patient_id
+
+
+class LockStripes:
+    '''Fixed set of reentrant locks shared out by key
+
+    Keys are hashed onto one of the stripes, so any number of patients can
+    be locked individually with a bounded number of locks. Two keys may
+    share a stripe, which only costs some parallelism.
+
+    :param stripes: int number of locks
+    '''
+
+    def __init__(self, stripes=64):
+        self._locks = [threading.RLock() for i in range(stripes)]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def lock_for(self, key):
+        '''Returns the lock of a key
+
+        :param key: hashable key, such as a patient ID
+        :return: threading.RLock
+        '''
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class PatientStore(list):
+    '''List of patient dictionaries with a hash index on patient_id
+
+    The server has always kept patients as a list of dictionaries and the
+    helper functions and unit tests rely on that (appending dictionaries,
+    iterating, comparing). This class keeps that contract by subclassing
+    list, and every method that adds or removes entries also keeps a
+    dictionary from patient_id to patient dictionary up to date so that
+    lookups do not have to walk the whole list.
+
+    When the same patient_id appears more than once the first dictionary
+    wins, which matches the result of a front-to-back scan.
+
+    Patient dictionaries added with plain "heart_rate" and "timestamp"
+    lists have them moved into a HeartRateSeries (see attach_series).
+
+    Each patient_id also has a version counter, bumped with bump_version
+    whenever the patient's data changes, which the routes use as ETags.
+    Versions only ever go up, even across removals, so an old ETag never
+    matches newer data.
+
+    The store is safe to share between threads. Adding or removing
+    patients and bumping versions take a lock on the store, while changes
+    to a single patient's data are guarded by that patient's lock from
+    lock_for, so writes to different patients run in parallel. Lookups
+    take no lock.
+
+    :param patients: list of patient dictionaries
+    :param stripes: int number of patient locks
+    '''
+
+    def __init__(self, patients=(), stripes=64):
+        super().__init__(patients)
+        self._lock = threading.RLock()
+        self.locks = LockStripes(stripes)
+        self._index = dict()
+        self._versions = dict()
+        self._reindex()
+
+    def _reindex(self):
+        index = dict()
+        for patient in self:
+            attach_series(patient)
+            index.setdefault(patient["patient_id"], patient)
+        self._index = index
+
+    def _add_to_index(self, patient):
+        attach_series(patient)
+        self._index.setdefault(patient["patient_id"], patient)
+
+    def get(self, patient_id):
+        '''Returns the patient dictionary for a patient ID
+
+        :param patient_id: int or numeric str containing patient ID
+        :return: patient dictionary if found, None otherwise
+        '''
+        return self._index.get(normalize_id(patient_id))
+
+    def lock_for(self, patient_id):
+        '''Returns the lock that guards a patient's data
+
+        :param patient_id: int or numeric str containing patient ID
+        :return: threading.RLock
+        '''
+        return self.locks.lock_for(normalize_id(patient_id))
+
+    def version(self, patient_id):
+        '''Returns the version counter of a patient
+
+        :param patient_id: int or numeric str containing patient ID
+        :return: int version, 0 if the patient's data never changed
+        '''
+        return self._versions.get(normalize_id(patient_id), 0)
+
+    def bump_version(self, patient_id):
+        '''Increments the version counter of a patient
+
+        :param patient_id: int or numeric str containing patient ID
+        :return: int new version
+        '''
+        patient_id = normalize_id(patient_id)
+        with self._lock:
+            version = self._versions.get(patient_id, 0) + 1
+            self._versions[patient_id] = version
+        return version
+
+    def __contains__(self, item):
+        if isinstance(item, dict):
+            return super().__contains__(item)
+        return normalize_id(item) in self._index
+
+    def append(self, patient):
+        with self._lock:
+            super().append(patient)
+            self._add_to_index(patient)
+
+    def extend(self, patients):
+        patients = list(patients)
+        with self._lock:
+            super().extend(patients)
+            for patient in patients:
+                self._add_to_index(patient)
+
+    def __iadd__(self, patients):
+        self.extend(patients)
+        return self
+
+    def insert(self, position, patient):
+        with self._lock:
+            super().insert(position, patient)
+            self._reindex()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self._reindex()
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._reindex()
+
+    def pop(self, *args):
+        with self._lock:
+            patient = super().pop(*args)
+            self._reindex()
+        return patient
+
+    def remove(self, patient):
+        with self._lock:
+            super().remove(patient)
+            self._reindex()
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._index = dict()
+
+
+def lookup_patient(patient_id, db):
+    '''Finds a patient dictionary in a patient database
+
+    Uses the patient_id index when the database is a PatientStore and
+    falls back to scanning when a plain list of dictionaries is given.
+
+    :param patient_id: int or numeric str containing patient ID
+    :param db: PatientStore or list of patient dictionaries
+    :return: patient dictionary if found, None otherwise
+    '''
+    if isinstance(db, PatientStore):
+        return db.get(patient_id)
+    for patient in db:
+        if str(patient["patient_id"]) == str(patient_id):
+            return patient
+    return None
+
+
+class AttendantRegistry(list):
+    '''List of attendant dictionaries with username and patient indexes
+
+    Like PatientStore this keeps the list-of-dictionaries contract used by
+    the helpers and tests. Two indexes are maintained alongside the list:
+    attending_username to attendant dictionary, and patient_id to the
+    attendant whose "patients" list holds that patient. Patients should be
+    assigned through add_patient so the reverse index stays current; the
+    "patients" list of each attendant is left as a plain list so the JSON
+    output of the routes does not change.
+
+    As with a front-to-back scan, the first attendant with a given username
+    or patient wins.
+
+    Like PatientStore, each username has a version counter. add_patient
+    bumps it, and the server bumps it whenever one of the attendant's
+    patients changes, so it covers the whole patient list of the
+    attendant.
+
+    The registry also keeps each attendant's roster: one row per patient
+    (patient_id, last_heart_rate, last_time and status) that the server
+    updates with update_roster_row as readings arrive, so listing an
+    attendant's patients takes time proportional to their patients only.
+    Rows are never changed once stored: an update stores a new row in the
+    old one's place, so readers can hold on to rows without locking.
+
+    Changes to the registry take a lock; lookups and roster reads do not.
+    '''
+
+    def __init__(self, attendants=()):
+        super().__init__(attendants)
+        self._lock = threading.RLock()
+        self._by_username = dict()
+        self._by_patient = dict()
+        self._versions = dict()
+        self._rosters = dict()
+        self._reindex()
+
+    def _reindex(self):
+        by_username = dict()
+        by_patient = dict()
+        for attendant in self:
+            by_username.setdefault(attendant["attending_username"],
+                                   attendant)
+            for patient_id in attendant["patients"]:
+                by_patient.setdefault(patient_id, attendant)
+        self._by_username = by_username
+        self._by_patient = by_patient
+
+    def _add_to_index(self, attendant):
+        self._by_username.setdefault(attendant["attending_username"],
+                                     attendant)
+        for patient_id in attendant["patients"]:
+            self._by_patient.setdefault(patient_id, attendant)
+
+    def get(self, attending_username):
+        '''Returns the attendant dictionary for a username
+
+        :param attending_username: str containing attendant username
+        :return: attendant dictionary if found, None otherwise
+        '''
+        return self._by_username.get(attending_username)
+
+    def attendant_for_patient(self, patient_id):
+        '''Returns the attendant dictionary that a patient is assigned to
+
+        :param patient_id: int or numeric str containing patient ID
+        :return: attendant dictionary if found, None otherwise
+        '''
+        return self._by_patient.get(normalize_id(patient_id))
+
+    def version(self, attending_username):
+        '''Returns the version counter of an attendant
+
+        :param attending_username: str containing attendant username
+        :return: int version, 0 if the attendant's data never changed
+        '''
+        return self._versions.get(attending_username, 0)
+
+    def bump_version(self, attending_username):
+        '''Increments the version counter of an attendant
+
+        :param attending_username: str containing attendant username
+        :return: int new version
+        '''
+        with self._lock:
+            version = self._versions.get(attending_username, 0) + 1
+            self._versions[attending_username] = version
+        return version
+
+    def roster(self, attending_username):
+        '''Returns the roster rows of an attendant
+
+        :param attending_username: str containing attendant username
+        :return: list of row dictionaries in the order the patients were
+                 added, which must not be modified
+        '''
+        return list(self._rosters.get(attending_username, {}).values())
+
+    def roster_row(self, attending_username, patient_id):
+        '''Returns the roster row of one of an attendant's patients
+
+        :param attending_username: str containing attendant username
+        :param patient_id: int containing patient ID
+        :return: row dictionary, which must not be modified, None if there
+                 is no row for the patient
+        '''
+        return self._rosters.get(attending_username, {}).get(patient_id)
+
+    def update_roster_row(self, attending_username, row):
+        '''Adds or updates the roster row of one of an attendant's patients
+
+        An existing row is replaced by a copy with the new fields, keeping
+        its position in the roster.
+
+        :param attending_username: str containing attendant username
+        :param row: dictionary with the patient_id and the fields to set
+        :return: the stored row dictionary, None if the attendant is not
+                 in the registry
+        '''
+        if attending_username not in self._by_username:
+            return None
+        with self._lock:
+            rows = self._rosters.setdefault(attending_username, dict())
+            stored = dict(rows.get(row["patient_id"], ()))
+            stored.update(row)
+            rows[row["patient_id"]] = stored
+        return stored
+
+    def add_patient(self, attending_username, patient_id):
+        '''Assigns a patient ID to an attendant
+
+        :param attending_username: str containing attendant username
+        :param patient_id: int containing patient ID
+        :return: attendant dictionary if found, None otherwise
+        '''
+        attendant = self.get(attending_username)
+        if attendant is None:
+            return None
+        with self._lock:
+            attendant["patients"].append(patient_id)
+            self._by_patient.setdefault(patient_id, attendant)
+            self.bump_version(attending_username)
+        return attendant
+
+    def __contains__(self, item):
+        if isinstance(item, dict):
+            return super().__contains__(item)
+        return item in self._by_username
+
+    def append(self, attendant):
+        with self._lock:
+            super().append(attendant)
+            self._add_to_index(attendant)
+
+    def extend(self, attendants):
+        attendants = list(attendants)
+        with self._lock:
+            super().extend(attendants)
+            for attendant in attendants:
+                self._add_to_index(attendant)
+
+    def __iadd__(self, attendants):
+        self.extend(attendants)
+        return self
+
+    def insert(self, position, attendant):
+        with self._lock:
+            super().insert(position, attendant)
+            self._reindex()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self._reindex()
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._reindex()
+
+    def pop(self, *args):
+        with self._lock:
+            attendant = super().pop(*args)
+            self._reindex()
+        return attendant
+
+    def remove(self, attendant):
+        with self._lock:
+            super().remove(attendant)
+            self._reindex()
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._by_username = dict()
+            self._by_patient = dict()
+            self._rosters = dict()
+
+
+def lookup_attendant(attending_username, db):
+    '''Finds an attendant dictionary in an attendant database
+
+    :param attending_username: str containing attendant username
+    :param db: AttendantRegistry or list of attendant dictionaries
+    :return: attendant dictionary if found, None otherwise
+    '''
+    if isinstance(db, AttendantRegistry):
+        return db.get(attending_username)
+    for attendant in db:
+        if attendant["attending_username"] == attending_username:
+            return attendant
+    return None
+
+
+def lookup_patient_attendant(patient_id, db):
+    '''Finds the attendant dictionary a patient is assigned to
+
+    :param patient_id: int containing patient ID
+    :param db: AttendantRegistry or list of attendant dictionaries
+    :return: attendant dictionary if found, None otherwise
+    '''
+    if isinstance(db, AttendantRegistry):
+        return db.attendant_for_patient(patient_id)
+    for attendant in db:
+        if patient_id in attendant["patients"]:
+            return attendant
+    return None
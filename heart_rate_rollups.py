@@ -0,0 +1,248 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+
+
+class RollupTable:
+    '''Heart rate aggregates over fixed-width time buckets
+
+    Each bucket keeps the count, sum, minimum and maximum of the heart
+    rates whose timestamps fall in [start, start + width). Buckets are kept
+    in parallel arrays sorted by start time, so old buckets are dropped by
+    cutting the front of the arrays.
+
+    :param width: int bucket width in milliseconds
+    '''
+
+    def __init__(self, width):
+        self.width = width
+        self.starts = array('q')
+        self.counts = array('q')
+        self.totals = array('q')
+        self.minimums = array('H')
+        self.maximums = array('H')
+        self.count = 0
+        self.total = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, count, total, minimum, maximum):
+        '''Merges aggregates into the bucket that holds a start time
+
+        :param start: int epoch milliseconds inside the bucket
+        :param count: int number of heart rates
+        :param total: int sum of the heart rates
+        :param minimum: int smallest heart rate
+        :param maximum: int largest heart rate
+        '''
+        start -= start % self.width
+        i = bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            self.counts[i] += count
+            self.totals[i] += total
+            self.minimums[i] = min(self.minimums[i], minimum)
+            self.maximums[i] = max(self.maximums[i], maximum)
+        else:
+            self.starts.insert(i, start)
+            self.counts.insert(i, count)
+            self.totals.insert(i, total)
+            self.minimums.insert(i, minimum)
+            self.maximums.insert(i, maximum)
+        self.count += count
+        self.total += total
+
+    def add_readings(self, rates, times):
+        '''Adds heart rates to the buckets of their timestamps
+
+        :param rates: list or array of ints containing heart rates
+        :param times: list or array of ints containing epoch milliseconds
+        '''
+        readings = zip(times, rates)
+        for start, bucket in groupby(readings,
+                                     lambda r: r[0] - r[0] % self.width):
+            bucket = [rate for time, rate in bucket]
+            self.add(start, len(bucket), sum(bucket), min(bucket),
+                     max(bucket))
+
+    def add_buckets(self, buckets):
+        '''Adds buckets from a finer table
+
+        :param buckets: list of (start, count, total, minimum, maximum)
+                        tuples
+        '''
+        for bucket in buckets:
+            self.add(*bucket)
+
+    def expire_before(self, cutoff):
+        '''Removes the buckets that end at or before a time
+
+        :param cutoff: int epoch milliseconds
+        :return: list of (start, count, total, minimum, maximum) tuples of
+                 the removed buckets
+        '''
+        n = bisect_right(self.starts, cutoff - self.width)
+        buckets = list(zip(self.starts[:n], self.counts[:n],
+                           self.totals[:n], self.minimums[:n],
+                           self.maximums[:n]))
+        for column in (self.starts, self.counts, self.totals,
+                       self.minimums, self.maximums):
+            del column[:n]
+        self.count -= sum(bucket[1] for bucket in buckets)
+        self.total -= sum(bucket[2] for bucket in buckets)
+        return buckets
+
+    def since(self, epoch_ms):
+        '''Returns the count and sum of the buckets starting at or after a
+        time
+
+        :param epoch_ms: int epoch milliseconds
+        :return: int count and int sum of heart rates
+        '''
+        i = bisect_left(self.starts, epoch_ms)
+        if i == 0:
+            return self.count, self.total
+        return sum(self.counts[i:]), sum(self.totals[i:])
+
+    def rows(self):
+        '''Returns the buckets as lists, oldest first
+
+        :return: list of [start, count, total, minimum, maximum] lists
+        '''
+        return [list(bucket) for bucket in zip(
+            self.starts, self.counts, self.totals, self.minimums,
+            self.maximums)]
+
+
+class Rollups:
+    '''Per-minute and per-hour aggregates of a patient's older heart rates
+
+    Heart rates dropped from a HeartRateSeries by a RetentionPolicy end up
+    here. count, total and since cover both tables, so averages can add
+    them to the heart rates the series still holds.
+    '''
+
+    def __init__(self):
+        self.minutes = RollupTable(MINUTE_MS)
+        self.hours = RollupTable(HOUR_MS)
+
+    @property
+    def count(self):
+        '''Number of heart rates in the rollups'''
+        return self.minutes.count + self.hours.count
+
+    @property
+    def total(self):
+        '''Sum of the heart rates in the rollups'''
+        return self.minutes.total + self.hours.total
+
+    def extremes(self):
+        '''Returns the smallest and largest heart rate in the rollups
+
+        :return: int minimum and int maximum, both None if there are no
+                 buckets
+        '''
+        minimums = list(self.minutes.minimums) + list(self.hours.minimums)
+        maximums = list(self.minutes.maximums) + list(self.hours.maximums)
+        if not minimums:
+            return None, None
+        return min(minimums), max(maximums)
+
+    def since(self, epoch_ms):
+        '''Returns the count and sum of the buckets starting at or after a
+        time
+
+        :param epoch_ms: int epoch milliseconds
+        :return: int count and int sum of heart rates
+        '''
+        minute_count, minute_total = self.minutes.since(epoch_ms)
+        hour_count, hour_total = self.hours.since(epoch_ms)
+        return minute_count + hour_count, minute_total + hour_total
+
+    def to_dict(self):
+        '''Returns the rollups as a JSON serializable dictionary
+
+        :return: dictionary with "minutes" and "hours" bucket lists
+        '''
+        return {"minutes": self.minutes.rows(), "hours": self.hours.rows()}
+
+    @classmethod
+    def from_dict(cls, rows):
+        '''Builds rollups from the dictionary made by to_dict
+
+        :param rows: dictionary with "minutes" and "hours" bucket lists
+        :return: Rollups
+        '''
+        rollups = cls()
+        rollups.minutes.add_buckets(rows["minutes"])
+        rollups.hours.add_buckets(rows["hours"])
+        return rollups
+
+
+class RetentionPolicy:
+    '''Rolls older heart rates into per-minute and per-hour aggregates
+
+    Heart rates more than raw_age older than a patient's latest reading are
+    dropped from the series and added to per-minute buckets, and minute
+    buckets more than minute_age old are merged into per-hour buckets. Ages
+    are measured from the patient's latest reading, so the policy follows
+    the data rather than the wall clock. Cutoffs are rounded down to whole
+    minutes (and hours), so each bucket is complete once rolled up.
+
+    Raw heart rates are dropped oldest first. Sealed segments are only
+    dropped as a whole, once their newest heart rate is past the cutoff,
+    which costs a file deletion; until then their heart rates stay raw.
+
+    :param raw_age: int milliseconds of raw heart rates to keep
+    :param minute_age: int milliseconds of minute buckets to keep, None to
+                       keep them all
+    '''
+
+    def __init__(self, raw_age, minute_age=None):
+        self.raw_age = raw_age
+        self.minute_age = minute_age
+
+    def raw_cutoff(self, series):
+        '''Returns the time before which a series' raw heart rates expire
+
+        :param series: HeartRateSeries
+        :return: int epoch milliseconds, None if the series is empty
+        '''
+        if not len(series):
+            return None
+        cutoff = series.time_at(-1) - self.raw_age
+        return cutoff - cutoff % MINUTE_MS
+
+    def maybe_apply(self, series):
+        '''Applies the policy if the oldest raw heart rate has expired
+
+        :param series: HeartRateSeries
+        :return: int number of raw heart rates rolled up
+        '''
+        cutoff = self.raw_cutoff(series)
+        if cutoff is None or series.time_at(0) >= cutoff:
+            return 0
+        return self.apply(series)
+
+    def apply(self, series):
+        '''Rolls a series' expired heart rates and minute buckets up
+
+        :param series: HeartRateSeries
+        :return: int number of raw heart rates rolled up
+        '''
+        cutoff = self.raw_cutoff(series)
+        if cutoff is None:
+            return 0
+        if series.rollups is None:
+            series.rollups = Rollups()
+        rates, times = series.expire_before(cutoff)
+        series.rollups.minutes.add_readings(rates, times)
+        if self.minute_age is not None:
+            hour_cutoff = series.time_at(-1) - self.minute_age
+            hour_cutoff -= hour_cutoff % HOUR_MS
+            series.rollups.hours.add_buckets(
+                series.rollups.minutes.expire_before(hour_cutoff))
+        return len(rates)
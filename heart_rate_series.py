@@ -0,0 +1,574 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from history_segments import SealedSegment
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH = datetime(1970, 1, 1)
+ONE_MS = timedelta(milliseconds=1)
+
+
+def to_epoch_ms(timestamp):
+    '''Converts a timestamp into integer milliseconds since the epoch
+
+    Timestamps are stored as naive wall-clock times, the same as the
+    strings the server has always produced, so no time zone conversion
+    is done.
+
+    :param timestamp: str in "%Y-%m-%d %H:%M:%S" format, datetime object,
+                      or int already in epoch milliseconds
+    :return: int containing epoch milliseconds
+    '''
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp, TIME_FORMAT)
+    if isinstance(timestamp, datetime):
+        return (timestamp - EPOCH) // ONE_MS
+    return int(timestamp)
+
+
+def format_epoch_ms(epoch_ms):
+    '''Turns epoch milliseconds back into a timestamp string
+
+    :param epoch_ms: int containing epoch milliseconds
+    :return: str of timestamp in "%Y-%m-%d %H:%M:%S" format
+    '''
+    return (EPOCH + epoch_ms * ONE_MS).strftime(TIME_FORMAT)
+
+
+class HeartRateSeries:
+    '''Compact heart rate history of a single patient
+
+    Heart rates are kept in an unsigned 16 bit array and timestamps in a
+    signed 64 bit array of epoch milliseconds, so a reading costs 10 bytes
+    instead of a Python int plus a timestamp string. Both arrays grow with
+    amortized appends. Timestamp strings are only built when they are read
+    back out, which keeps the JSON produced by the routes unchanged.
+
+    Readings are kept sorted by timestamp and a running prefix sum of the
+    heart rates is maintained, so the average over any run of readings
+    that ends with the latest one is found with one binary search and a
+    subtraction. The running minimum and maximum are updated on every
+    append, so the count, sum, average, extremes and latest reading are
+    all available without looking at the history. appended counts every
+    reading ever added, which gives each reading a sequence number that
+    the storage engine uses to replay its log without duplicates.
+
+    The oldest readings can be moved out of memory with seal, which writes
+    them to a memory-mapped SealedSegment. Every method keeps working on
+    the whole series: indexes below sealed are read from the segments and
+    the rest from the arrays in memory. A late reading older than the
+    newest sealed one loads the segments it belongs in back into memory.
+
+    expire_before drops the oldest readings, and rollups (set by a
+    RetentionPolicy) holds aggregates of the dropped readings. average,
+    average_since and summary include the rollups; the other methods only
+    see the readings still held.
+    '''
+
+    def __init__(self, heart_rates=(), timestamps=()):
+        self._rates = array('H')
+        self._times = array('q')
+        self._prefix = array('q', [0])
+        self.minimum = None
+        self.maximum = None
+        self.appended = 0
+        self.sealed = 0
+        self._segments = list()
+        self._starts = list()
+        self.rollups = None
+        if len(heart_rates) != len(timestamps):
+            raise ValueError("heart_rate and timestamp lists differ in length")
+        for heart_rate, timestamp in zip(heart_rates, timestamps):
+            self.append(heart_rate, timestamp)
+
+    def __len__(self):
+        return self.sealed + len(self._rates)
+
+    @property
+    def resident(self):
+        '''Number of readings held in memory rather than in segments'''
+        return len(self._rates)
+
+    @classmethod
+    def from_columns(cls, rates, times, appended=None):
+        '''Builds a series straight from heart rate and timestamp columns
+
+        Used when loading stored data: the columns are taken as they are,
+        so they must already be in time order.
+
+        :param rates: array('H') of heart rates
+        :param times: array('q') of epoch milliseconds
+        :param appended: int number of readings ever appended, defaults to
+                         the number of readings
+        :return: HeartRateSeries
+        '''
+        if len(rates) != len(times):
+            raise ValueError("heart_rate and timestamp lists differ in length")
+        series = cls()
+        series._rates = array('H', rates)
+        series._times = array('q', times)
+        series._prefix.extend(accumulate(series._rates))
+        if len(series._rates):
+            series.minimum = min(series._rates)
+            series.maximum = max(series._rates)
+        series.appended = len(rates) if appended is None else appended
+        return series
+
+    def columns(self):
+        '''Returns copies of the heart rate and timestamp columns
+
+        :return: array('H') of heart rates, array('q') of epoch
+                 milliseconds, and int number of readings ever appended
+        '''
+        rates = array('H')
+        times = array('q')
+        for segment in self._segments:
+            rates.frombytes(segment.rates.tobytes())
+            times.frombytes(segment.times.tobytes())
+        rates.extend(self._rates)
+        times.extend(self._times)
+        return rates, times, self.appended
+
+    def seal(self, path, count):
+        '''Moves the oldest readings held in memory into a segment file
+
+        :param path: str path of the segment file to write
+        :param count: int number of readings to seal
+        :return: SealedSegment written, None if there was nothing to seal
+        '''
+        count = min(count, len(self._rates))
+        if count <= 0:
+            return None
+        segment = SealedSegment.write(path, self._rates[:count],
+                                      self._times[:count],
+                                      self._prefix[:count + 1])
+        segment.start = self.sealed
+        self._segments.append(segment)
+        self._starts.append(segment.start)
+        del self._rates[:count]
+        del self._times[:count]
+        del self._prefix[:count]
+        self.sealed += count
+        return segment
+
+    def _unseal_last(self):
+        segment = self._segments.pop()
+        self._starts.pop()
+        rates = array('H')
+        rates.frombytes(segment.rates.tobytes())
+        times = array('q')
+        times.frombytes(segment.times.tobytes())
+        prefix = array('q')
+        prefix.frombytes(segment.prefix[:-1].tobytes())
+        self._rates = rates + self._rates
+        self._times = times + self._times
+        self._prefix = prefix + self._prefix
+        self.sealed -= len(segment)
+        segment.discard()
+
+    def expire_before(self, epoch_ms):
+        '''Drops the oldest readings taken before a time
+
+        Sealed segments are dropped whole, and only once their newest
+        reading is before the time, so dropping them costs a file deletion.
+        Readings in memory are only dropped once no segment is left.
+
+        :param epoch_ms: int epoch milliseconds
+        :return: array('H') of the dropped heart rates and array('q') of
+                 their epoch milliseconds, oldest first
+        '''
+        rates = array('H')
+        times = array('q')
+        while self._segments and self._segments[0].last_time < epoch_ms:
+            segment = self._segments.pop(0)
+            rates.frombytes(segment.rates.tobytes())
+            times.frombytes(segment.times.tobytes())
+            self.sealed -= len(segment)
+            for later in self._segments:
+                later.start -= len(segment)
+            self._starts = [later.start for later in self._segments]
+            segment.discard()
+        if not self._segments:
+            count = bisect_left(self._times, epoch_ms)
+            rates.extend(self._rates[:count])
+            times.extend(self._times[:count])
+            del self._rates[:count]
+            del self._times[:count]
+            del self._prefix[:count]
+        return rates, times
+
+    def _segment_for(self, index):
+        return self._segments[bisect_right(self._starts, index) - 1]
+
+    def append(self, heart_rate, timestamp):
+        '''Adds a reading to the series
+
+        Readings normally arrive in time order and are appended. A reading
+        older than the latest one (for example after a clock change) is
+        inserted in time order instead, which costs a copy of the readings
+        after it.
+
+        :param heart_rate: int containing heart rate
+        :param timestamp: str, datetime or int epoch milliseconds
+        '''
+        epoch_ms = to_epoch_ms(timestamp)
+        if len(self) and epoch_ms < self.time_at(-1):
+            while self._segments and \
+                    epoch_ms < self._segments[-1].last_time:
+                self._unseal_last()
+            self._insert(bisect_right(self._times, epoch_ms),
+                         heart_rate, epoch_ms)
+            return
+        try:
+            self._rates.append(heart_rate)
+        except (TypeError, OverflowError):
+            raise ValueError("heart_rate value is not a valid heart rate")
+        self._times.append(epoch_ms)
+        self._prefix.append(self._prefix[-1] + heart_rate)
+        self._update_extremes(heart_rate)
+        self.appended += 1
+
+    def attach_rollups(self, rollups):
+        '''Sets the rollups of heart rates dropped before the series was
+        loaded
+
+        The rolled up minimum and maximum are folded into the series' own,
+        so summary still covers every heart rate.
+
+        :param rollups: Rollups, for example from Rollups.from_dict
+        '''
+        self.rollups = rollups
+        for extreme in rollups.extremes():
+            if extreme is not None:
+                self._update_extremes(extreme)
+
+    def _update_extremes(self, heart_rate):
+        if self.minimum is None or heart_rate < self.minimum:
+            self.minimum = heart_rate
+        if self.maximum is None or heart_rate > self.maximum:
+            self.maximum = heart_rate
+
+    def extend(self, heart_rates, timestamps):
+        '''Adds many readings to the series at once
+
+        When the readings are in time order and no older than the latest
+        stored reading, the columns and prefix sums are extended in bulk.
+        Otherwise each reading is added with append. Either way no reading
+        is stored if any heart rate does not fit the heart rate column.
+
+        :param heart_rates: list of ints containing heart rates
+        :param timestamps: list of str, datetime or int epoch milliseconds
+        '''
+        if len(heart_rates) != len(timestamps):
+            raise ValueError("heart_rate and timestamp lists differ in length")
+        try:
+            rates = array('H', heart_rates)
+        except (TypeError, OverflowError):
+            raise ValueError("heart_rate value is not a valid heart rate")
+        times = array('q', [to_epoch_ms(t) for t in timestamps])
+        if not len(rates):
+            return
+        in_order = all(times[i] <= times[i + 1]
+                       for i in range(len(times) - 1))
+        if not in_order or (len(self) and times[0] < self.time_at(-1)):
+            for heart_rate, epoch_ms in zip(rates, times):
+                self.append(heart_rate, epoch_ms)
+            return
+        self._rates.extend(rates)
+        self._times.extend(times)
+        running = accumulate(rates, initial=self._prefix[-1])
+        next(running)
+        self._prefix.extend(running)
+        self._update_extremes(min(rates))
+        self._update_extremes(max(rates))
+        self.appended += len(rates)
+
+    def _insert(self, index, heart_rate, epoch_ms):
+        try:
+            self._rates.insert(index, heart_rate)
+        except (TypeError, OverflowError):
+            raise ValueError("heart_rate value is not a valid heart rate")
+        self._times.insert(index, epoch_ms)
+        self.appended += 1
+        del self._prefix[index + 1:]
+        total = self._prefix[index]
+        for rate in self._rates[index:]:
+            total += rate
+            self._prefix.append(total)
+        self._update_extremes(heart_rate)
+
+    def index_at_or_after(self, epoch_ms):
+        '''Finds the first reading taken at or after a time
+
+        :param epoch_ms: int containing epoch milliseconds
+        :return: int index of the reading, equal to the length of the
+                 series if every reading is older
+        '''
+        for segment in self._segments:
+            if epoch_ms <= segment.last_time:
+                return segment.start + bisect_left(segment.times, epoch_ms)
+        return self.sealed + bisect_left(self._times, epoch_ms)
+
+    def _prefix_at(self, index):
+        if index >= self.sealed:
+            return self._prefix[index - self.sealed]
+        segment = self._segment_for(index)
+        return segment.prefix[index - segment.start]
+
+    def sum_range(self, start=0, stop=None):
+        '''Returns the sum of a run of heart rates from the prefix sums
+
+        :param start: int index of first reading
+        :param stop: int index after last reading, None for the end
+        :return: int containing the sum of the heart rates
+        '''
+        if stop is None:
+            stop = len(self)
+        return self._prefix_at(stop) - self._prefix_at(start)
+
+    @property
+    def total(self):
+        '''Sum of every heart rate held in the series'''
+        return self._prefix[-1] - self._prefix_at(0)
+
+    def average(self):
+        '''Returns the average of every heart rate in the series
+
+        Heart rates rolled up by a retention policy are included.
+
+        :return: float average heart rate, None if the series is empty
+        '''
+        count = len(self)
+        total = self.total
+        if self.rollups is not None:
+            count += self.rollups.count
+            total += self.rollups.total
+        if not count:
+            return None
+        return total / count
+
+    def average_since(self, epoch_ms):
+        '''Returns the average heart rate from a time onwards
+
+        Rolled up heart rates count when their bucket starts at or after
+        the time, so the result is exact whenever the time is on a bucket
+        boundary or after the rollups.
+
+        :param epoch_ms: int epoch milliseconds
+        :return: float average heart rate, None if there are no heart
+                 rates from the time onwards
+        '''
+        start = self.index_at_or_after(epoch_ms)
+        count = len(self) - start
+        total = self.sum_range(start)
+        if self.rollups is not None:
+            rolled_count, rolled_total = self.rollups.since(epoch_ms)
+            count += rolled_count
+            total += rolled_total
+        if not count:
+            return None
+        return total / count
+
+    def last_reading(self):
+        '''Returns the latest heart rate and its timestamp string
+
+        :return: tuple of int heart rate and str timestamp, (None, None)
+                 if the series is empty
+        '''
+        if not len(self):
+            return None, None
+        return self.rate_at(-1), format_epoch_ms(self.time_at(-1))
+
+    def summary(self):
+        '''Returns the running aggregates of the series
+
+        :return: dictionary with the count, average, min, max,
+                 last_heart_rate and last_time of the series
+        '''
+        last_heart_rate, last_time = self.last_reading()
+        count = len(self)
+        if self.rollups is not None:
+            count += self.rollups.count
+        return {"count": count, "average": self.average(),
+                "min": self.minimum, "max": self.maximum,
+                "last_heart_rate": last_heart_rate, "last_time": last_time}
+
+    def average_from(self, start):
+        '''Returns the average heart rate from an index to the end
+
+        :param start: int index of first reading
+        :return: float average heart rate, None if there are no readings
+                 at or after the index
+        '''
+        count = len(self) - start
+        if count <= 0:
+            return None
+        return self.sum_range(start) / count
+
+    def rate_at(self, index):
+        '''Returns the heart rate at an index of the series
+
+        :param index: int index, negative values count from the end
+        :return: int containing heart rate
+        '''
+        return self._column_at("rates", index)
+
+    def time_at(self, index):
+        '''Returns the epoch millisecond timestamp at an index of the series
+
+        :param index: int index, negative values count from the end
+        :return: int containing epoch milliseconds
+        '''
+        return self._column_at("times", index)
+
+    def _column_at(self, column, index):
+        if index < 0:
+            index += len(self)
+        if index >= self.sealed:
+            return getattr(self, "_" + column)[index - self.sealed]
+        if index < 0:
+            raise IndexError("series index out of range")
+        segment = self._segment_for(index)
+        return getattr(segment, column)[index - segment.start]
+
+    def _column_chunks(self, column, start, stop):
+        start, stop, step = slice(start, stop).indices(len(self))
+        for segment in self._segments:
+            if start >= stop:
+                return
+            end = segment.start + len(segment)
+            if start < end:
+                yield getattr(segment, column)[
+                    start - segment.start:min(stop, end) - segment.start]
+                start = min(stop, end)
+        if start < stop:
+            yield getattr(self, "_" + column)[
+                start - self.sealed:stop - self.sealed]
+
+    def _column_slice(self, column, start, stop):
+        values = list()
+        for chunk in self._column_chunks(column, start, stop):
+            values.extend(chunk.tolist())
+        return values
+
+    def rates(self, start=0, stop=None):
+        '''Returns a slice of the heart rates as a list
+
+        :param start: int index of first reading
+        :param stop: int index after last reading, None for the end
+        :return: list of ints containing heart rates
+        '''
+        return self._column_slice("rates", start, stop)
+
+    def times(self, start=0, stop=None):
+        '''Returns a slice of the timestamps as epoch milliseconds
+
+        :param start: int index of first reading
+        :param stop: int index after last reading, None for the end
+        :return: list of ints containing epoch milliseconds
+        '''
+        return self._column_slice("times", start, stop)
+
+    def rate_chunks(self, start=0, stop=None):
+        '''Returns a slice of the heart rates as runs of fixed-width ints
+
+        Sealed heart rates come as memoryviews over their segment and the
+        rest as a copy of the in-memory array, so no Python int is made
+        per heart rate. The chunks must be used while holding the
+        patient's lock, as sealing or rolling up the series may unmap
+        the segments.
+
+        :param start: int index of first reading
+        :param stop: int index after last reading, None for the end
+        :return: generator of memoryviews and array('H') slices
+        '''
+        return self._column_chunks("rates", start, stop)
+
+    @property
+    def heart_rate(self):
+        '''Read-only list-like view of the heart rates'''
+        return HeartRateView(self)
+
+    @property
+    def timestamp(self):
+        '''Read-only list-like view of the timestamps as strings'''
+        return TimestampView(self)
+
+
+class _SeriesView(Sequence):
+    '''Base class for the list-like views over a HeartRateSeries'''
+
+    def __init__(self, series):
+        self.series = series
+
+    def __len__(self):
+        return len(self.series)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._slice(start, stop)
+            return [self._item(i) for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("series index out of range")
+        return self._item(index)
+
+    def __iter__(self):
+        return iter(self._slice(0, len(self)))
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, _SeriesView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class HeartRateView(_SeriesView):
+    '''List-like view of the heart rates of a HeartRateSeries'''
+
+    def _item(self, index):
+        return self.series.rate_at(index)
+
+    def _slice(self, start, stop):
+        return self.series.rates(start, stop)
+
+
+class TimestampView(_SeriesView):
+    '''List-like view of the timestamps of a HeartRateSeries
+
+    Items are formatted into "%Y-%m-%d %H:%M:%S" strings as they are read.
+    '''
+
+    def _item(self, index):
+        return format_epoch_ms(self.series.time_at(index))
+
+    def _slice(self, start, stop):
+        return [format_epoch_ms(t) for t in self.series.times(start, stop)]
+
+
+def attach_series(patient):
+    '''Moves a patient dictionary's heart rate lists into a HeartRateSeries
+
+    Patient dictionaries built from plain lists are converted in place: the
+    series is stored under "series" and the "heart_rate" and "timestamp"
+    keys are replaced by views over it. Dictionaries that already have a
+    series are left alone.
+
+    :param patient: patient dictionary
+    :return: the patient's HeartRateSeries
+    '''
+    series = patient.get("series")
+    if series is None:
+        series = HeartRateSeries(patient.get("heart_rate", ()),
+                                 patient.get("timestamp", ()))
+        patient["series"] = series
+        patient["heart_rate"] = series.heart_rate
+        patient["timestamp"] = series.timestamp
+    return series
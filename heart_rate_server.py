@@ -1,12 +1,54 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from datetime import datetime
+from bisect import bisect_left
 import requests
 import logging
-
-patient_db = list()
-attendant_db = list()
+import os
+import threading
+import numpy as np
+from alert_dispatcher import AlertDispatcher
+from patient_events import EventBroker
+from heart_rate_database import (PatientStore, AttendantRegistry,
+                                 lookup_patient, lookup_attendant,
+                                 lookup_patient_attendant)
+from heart_rate_series import (HeartRateSeries, TimestampView, to_epoch_ms,
+                               format_epoch_ms)
+from storage_engine import StorageEngine
+from history_segments import HistoryArchive
+from heart_rate_rollups import RetentionPolicy
+from tachycardia import TachycardiaTable, parse_bands
+from request_schemas import (NEW_ATTENDING, NEW_PATIENT, HEART_RATE,
+                             INTERVAL_AVERAGE)
+from json_codec import CodecJSONProvider, get_codec, iter_int_array
+from binary_ingest import (BinaryIngestServer, SERVER_TIME, MIME_TYPE,
+                           decode_records, group_by_patient)
+
+patient_db = PatientStore()
+attendant_db = AttendantRegistry()
+
+storage = None
+history_archive = None
+retention_policy = None
+binary_listener = None
+tachycardia_table = TachycardiaTable()
+
+patient_events = EventBroker()
+EVENT_KEEPALIVE = 15
+
+HISTORY_PAGE = 1000
+MAX_HISTORY_PAGE = 10000
+HISTORY_ARGS = ("since", "until", "limit", "cursor", "format")
+
+ETAG_PREFIX = os.urandom(4).hex()
+
+fallback_lock = threading.RLock()
+
+EMAIL_SERVER = os.environ.get("HR_EMAIL_SERVER",
+                              "http://vcm-7631.vm.duke.edu:5007/hrss/"
+                              "send_email")
 
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)
 
 
 def is_tachycardic(age, hr):
@@ -15,26 +57,15 @@ def is_tachycardic(age, hr):
     Tachycardia is a heart condition in which the heart beats abnormally
     fast. The conditions for diagnosing tachycardia that were employed in
     this function were taken from "https://en.wikipedia.org/wiki/Tachycardia"
+    and are held by tachycardia_table (see tachycardia.TACHYCARDIA_BANDS),
+    which covers every age.
 
     :param age: int containing patient's age
     :param hr: int containin patient's heart rate
 
     :return: True if tachycardic and False if not tachycardic
     '''
-    if 1 <= age <= 2 and hr > 151:
-        return True
-    elif 3 < age <= 4 and hr > 137:
-        return True
-    elif 5 < age <= 7 and hr > 133:
-        return True
-    elif 8 < age <= 11 and hr > 130:
-        return True
-    elif 12 < age <= 15 and hr > 119:
-        return True
-    elif 15 < age and hr > 100:
-        return True
-    else:
-        return False
+    return tachycardia_table.is_tachycardic(age, hr)
 
 
 def check_bad_input(input):
@@ -98,19 +129,45 @@ def read_patient(in_dict):
     return [patient, user, age]
 
 
+def patient_lock(patient_id):
+    '''Returns the lock that guards changes to a patient's data
+
+    Writers hold the lock while they add heart rates and set the status,
+    so a patient's readings, version, roster row and status always change
+    together. Patients share a fixed set of striped locks (see
+    LockStripes), so different patients are mostly written in parallel.
+    The locks are reentrant, so a caller holding one can call the helpers
+    that take it again.
+
+    :param patient_id: int or numeric str containing patient ID
+    :return: lock usable in a with statement
+    '''
+    if isinstance(patient_db, PatientStore):
+        return patient_db.lock_for(patient_id)
+    return fallback_lock
+
+
 def add_patient_to_db(info):
     '''Creates a patient dictionary and adds it to database
 
     Patient info is input as a list and dictionary is created
     containing all the required keys specified on GitHub which
-    is then added to the global patient database variable
+    is then added to the global patient database variable. The
+    heart rate and timestamp keys are list-like views of a compact
+    HeartRateSeries kept under the "series" key.
 
     :param info: list containing patient info
     '''
+    series = HeartRateSeries()
     new_patient_dict = {"patient_id": info[0], "attending_username": info[1],
-                        "patient_age": info[2], "heart_rate": list(),
-                        "timestamp": list(), "status": ""}
+                        "patient_age": info[2],
+                        "heart_rate": series.heart_rate,
+                        "timestamp": series.timestamp, "status": "",
+                        "series": series}
     patient_db.append(new_patient_dict)
+    refresh_roster_row(new_patient_dict)
+    if storage is not None:
+        storage.log_patient(info[0], info[1], info[2])
 
 
 def add_attendant_to_db(info, db):
@@ -128,28 +185,32 @@ def add_attendant_to_db(info, db):
                           "attending_phone": info[2],
                           "patients": list()}
     db.append(new_attendant_dict)
+    if storage is not None and db is attendant_db:
+        storage.log_attendant(info[0], info[1], info[2])
     return db
 
 
 def add_patient_to_attendant_db(info, db):
     '''Adds patient ID to corresponding attendant's list of patients
 
-    This method looks through the list of attendant dictionaries for
-    the input patient's attendant. If the attendant is found the patient's
-    ID is appended to the attendant's list of patients.
+    This method looks up the input patient's attendant. If the attendant
+    is found the patient's ID is appended to the attendant's list of
+    patients.
 
     :param info: list of patient info
-    :param db: list of attendant dictionaries
+    :param db: AttendantRegistry or list of attendant dictionaries
     :return: False if patient's attendant is found, True if patients's
              attendant not found
     '''
     patient_id = info[0]
     attendant_name = info[1]
-    for attendant in db:
-        if attendant["attending_username"] == attendant_name:
-            attendant["patients"].append(patient_id)
-            return False
-    return True
+    if isinstance(db, AttendantRegistry):
+        return db.add_patient(attendant_name, patient_id) is None
+    attendant = lookup_attendant(attendant_name, db)
+    if attendant is None:
+        return True
+    attendant["patients"].append(patient_id)
+    return False
 
 
 def find_first_time(time_input, data):
@@ -157,24 +218,30 @@ def find_first_time(time_input, data):
 
     This method is used for the interval average route. The first index of the
     heart rate data list that occurs at or after the input timestamp
-    must be found. This function finds that index.
-
-    :param time_input: datetime object containing input timestamp
-    :param data: list of patient heart rate timestamps
-
-    :return: int containing first index of interval
-    '''
-    ref_time = datetime.strptime(time_input, "%Y-%m-%d %H:%M:%S")
-    count = 0
-    for time in data:
-        temp = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
-        delta = ref_time-temp
-        if delta.total_seconds() <= 0:
-            return count
-        elif count == len(data):
-            return "Time out of bounds"
-        else:
-            count = count + 1
+    must be found. This function finds that index with a binary search,
+    so the timestamps must be in time order. For a patient's
+    TimestampView the search runs over the stored epoch milliseconds. A
+    plain list of timestamp strings is searched directly because the
+    fixed-width "%Y-%m-%d %H:%M:%S" format sorts in time order.
+
+    :param time_input: str containing input timestamp
+    :param data: list or TimestampView of patient heart rate timestamps
+
+    :return: int containing first index of interval, str "Time out of
+             bounds" if every timestamp is before the input, str
+             explaining the expected format if the input can't be parsed
+    '''
+    try:
+        ref_time = datetime.strptime(time_input, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return "heart_rate_average_since must be in %Y-%m-%d %H:%M:%S format"
+    if isinstance(data, TimestampView):
+        index = data.series.index_at_or_after(to_epoch_ms(ref_time))
+    else:
+        index = bisect_left(data, current_time(ref_time))
+    if index == len(data):
+        return "Time out of bounds"
+    return index
 
 
 def get_patient_heart_rates(patient_id, db):
@@ -184,14 +251,207 @@ def get_patient_heart_rates(patient_id, db):
     outputs the list of the specified patient's heart rate data.
 
     :param patient_id: int containing patient ID
-    :param db: list of patient dictionaries
+    :param db: PatientStore or list of patient dictionaries
     :return: list of patient heart rate data, str "Patient not found" and
              error 400 if not found
     '''
-    for patient in db:
-        if patient_id == str(patient["patient_id"]):
-            return patient["heart_rate"]
-    return "Patient not found", 400
+    patient = lookup_patient(patient_id, db)
+    if patient is None:
+        return "Patient not found", 400
+    with patient_lock(patient["patient_id"]):
+        return list(patient["heart_rate"])
+
+
+def read_history_args(args):
+    '''Reads the query parameters of the heart rate history route
+
+    since and until are timestamps in "%Y-%m-%d %H:%M:%S" format (since
+    inclusive, until exclusive), limit is the number of readings to return
+    and cursor is the next_cursor of a previous page, which takes the place
+    of since. format is "json" (default) or "ndjson". A json page holds at
+    most MAX_HISTORY_PAGE readings, HISTORY_PAGE by default; an ndjson
+    stream holds every reading in range unless a limit is given.
+
+    :param args: dictionary of query parameters
+    :return: dictionary with since, skip, until (epoch milliseconds or
+             None), limit and format, str describing the problem if a
+             parameter is not valid
+    '''
+    history = {"since": 0, "skip": 0, "until": None,
+               "format": args.get("format", "json")}
+    if history["format"] not in ("json", "ndjson"):
+        return "format must be json or ndjson"
+    try:
+        if "since" in args:
+            history["since"] = to_epoch_ms(args["since"])
+        if "until" in args:
+            history["until"] = to_epoch_ms(args["until"])
+    except ValueError:
+        return "since and until must be in %Y-%m-%d %H:%M:%S format"
+    if "cursor" in args:
+        try:
+            since, skip = args["cursor"].rsplit("-", 1)
+            history["since"], history["skip"] = int(since), int(skip)
+        except ValueError:
+            return "cursor is not valid"
+    limit = args.get("limit")
+    if limit is None:
+        limit = HISTORY_PAGE if history["format"] == "json" else None
+    elif not limit.isdigit() or not 0 < int(limit) <= MAX_HISTORY_PAGE:
+        return "limit must be between 1 and " + str(MAX_HISTORY_PAGE)
+    history["limit"] = None if limit is None else int(limit)
+    return history
+
+
+def history_page_bounds(series, since, skip, until, limit):
+    '''Finds the indexes of a page of readings in a time range
+
+    :param series: HeartRateSeries of the patient
+    :param since: int epoch milliseconds of the first reading
+    :param skip: int number of readings at since to leave out
+    :param until: int epoch milliseconds to stop before, None for no end
+    :param limit: int maximum number of readings, None for no limit
+    :return: int index of the first reading, int index after the last
+             reading and str cursor of the next page (see
+             read_history_page), None if the range is finished
+    '''
+    start = series.index_at_or_after(since) + skip
+    end = len(series)
+    if until is not None:
+        end = series.index_at_or_after(until)
+    stop = end if limit is None else min(end, start + limit)
+    cursor = None
+    if start < stop < end:
+        next_time = series.time_at(stop)
+        cursor = "{}-{}".format(next_time,
+                                stop - series.index_at_or_after(next_time))
+    return start, stop, cursor
+
+
+def read_history_page(series, since, skip, until, limit):
+    '''Reads a page of readings in a time range from a patient's series
+
+    Pages are addressed by time rather than by index, so a cursor stays
+    valid while readings are added or rolled up. A cursor is the timestamp
+    of the next reading and the number of readings with that same
+    timestamp that were already returned, written as "<epoch_ms>-<skip>".
+
+    :param series: HeartRateSeries of the patient
+    :param since: int epoch milliseconds of the first reading
+    :param skip: int number of readings at since to leave out
+    :param until: int epoch milliseconds to stop before, None for no end
+    :param limit: int maximum number of readings, None for no limit
+    :return: list of heart rates, list of epoch milliseconds and str
+             cursor of the next page, None if the range is finished
+    '''
+    start, stop, cursor = history_page_bounds(series, since, skip, until,
+                                              limit)
+    if start >= stop:
+        return [], [], None
+    return series.rates(start, stop), series.times(start, stop), cursor
+
+
+def history_rows(rates, times):
+    '''Pairs heart rates with their timestamp strings
+
+    :param rates: list of ints containing heart rates
+    :param times: list of ints containing epoch milliseconds
+    :return: list of dictionaries with heart_rate and timestamp
+    '''
+    return [{"heart_rate": rate, "timestamp": format_epoch_ms(time)}
+            for rate, time in zip(rates, times)]
+
+
+def heart_rates_json(patient):
+    '''Serializes a patient's heart rates as a JSON list
+
+    The list is written by the JSON codec straight from the series'
+    arrays, without making a Python list of the heart rates.
+
+    :param patient: patient dictionary
+    :return: bytes of the JSON list
+    '''
+    with patient_lock(patient["patient_id"]):
+        return b"".join(iter_int_array(app.json.codec,
+                                       patient["series"].rate_chunks()))
+
+
+def iter_history_list(patient):
+    '''Writes the JSON list of a patient's heart rates a page at a time
+
+    Each page of HISTORY_PAGE heart rates is read and serialized while
+    holding the patient's lock, and pages follow each other by timestamp,
+    so readings added or rolled up while the list is sent do not shift
+    it.
+
+    :param patient: patient dictionary
+    :return: generator of bytes pieces of the JSON list
+    '''
+    series = patient["series"]
+    lock = patient_lock(patient["patient_id"])
+    since, skip, opening = 0, 0, b"["
+    while True:
+        with lock:
+            start, stop, cursor = history_page_bounds(series, since, skip,
+                                                      None, HISTORY_PAGE)
+            items = b",".join(app.json.codec.int_items(chunk) for chunk
+                              in series.rate_chunks(start, stop)
+                              if len(chunk))
+        if items:
+            yield opening + items
+            opening = b","
+        if cursor is None:
+            break
+        since, skip = [int(part) for part in cursor.rsplit("-", 1)]
+    yield (b"[" if opening == b"[" else b"") + b"]\n"
+
+
+def history_json_page(patient, history):
+    '''Reads one page of a patient's readings for the history route
+
+    :param patient: patient dictionary
+    :param history: dictionary made by read_history_args
+    :return: dictionary with patient_id, readings and next_cursor
+    '''
+    with patient_lock(patient["patient_id"]):
+        rates, times, cursor = read_history_page(
+            patient["series"], history["since"], history["skip"],
+            history["until"], history["limit"])
+    return {"patient_id": patient["patient_id"],
+            "readings": history_rows(rates, times),
+            "next_cursor": cursor}
+
+
+def iter_history_ndjson(patient, history):
+    '''Writes a patient's readings in a time range as NDJSON lines
+
+    Readings are read HISTORY_PAGE at a time, each page while holding the
+    patient's lock, and a {"next_cursor": "..."} line ends the stream if
+    the limit cut the range short.
+
+    :param patient: patient dictionary
+    :param history: dictionary made by read_history_args
+    :return: generator of bytes lines
+    '''
+    series = patient["series"]
+    lock = patient_lock(patient["patient_id"])
+    since, skip = history["since"], history["skip"]
+    remaining = history["limit"]
+    while remaining is None or remaining > 0:
+        page = HISTORY_PAGE
+        if remaining is not None:
+            page = min(page, remaining)
+            remaining -= page
+        with lock:
+            rates, times, cursor = read_history_page(
+                series, since, skip, history["until"], page)
+        dumps = app.json.codec.dumps
+        for row in history_rows(rates, times):
+            yield dumps(row) + b"\n"
+        if cursor is None:
+            return
+        since, skip = [int(part) for part in cursor.rsplit("-", 1)]
+    yield app.json.codec.dumps({"next_cursor": cursor}) + b"\n"
 
 
 def find_patient(patient_id, db):
@@ -201,32 +461,66 @@ def find_patient(patient_id, db):
     outputs the dictionary containing the specified patient's info.
 
     :param patient_id: int containing patient ID
-    :param db: list of patient dictionaries
+    :param db: PatientStore or list of patient dictionaries
     :return: dictionary of patient data, str "Patient not found" and
              error 400 if patient not found
     '''
-    for patient in db:
-        if patient["patient_id"] == patient_id:
-            return patient
-    return "Patient not found", 400
+    patient = lookup_patient(patient_id, db)
+    if patient is None:
+        return "Patient not found", 400
+    return patient
 
 
 def get_patient_average_heart_rate(patient_id, db):
     '''Returns the average of the patient's heart rate data
 
     This method takes in the patient ID and patient database and
-    outputs the specified patient's average heart rate.
+    outputs the specified patient's average heart rate. Patients with a
+    HeartRateSeries keep a running sum of their heart rates, so the
+    average comes from that instead of summing the history.
 
     :param patient_id: int containing patient ID
-    :param db: list of patient dictionaries
+    :param db: PatientStore or list of patient dictionaries
     :return: int containing patient's average heart rate data,
-             str "Patient not found" and error 400 if not found
+             str "Patient not found" and error 400 if not found,
+             str "No heart rate data for patient" and error 400 if the
+             patient has no readings
     '''
-    data = get_patient_heart_rates(patient_id, db)
-    if type(data) is not list:
+    patient = lookup_patient(patient_id, db)
+    if patient is None:
         return "Patient not found", 400
+    if "series" in patient:
+        with patient_lock(patient["patient_id"]):
+            average = patient["series"].average()
     else:
-        return sum(data) / len(data)
+        data = patient["heart_rate"]
+        average = sum(data) / len(data) if len(data) else None
+    if average is None:
+        return "No heart rate data for patient", 400
+    return average
+
+
+def get_patient_summary(patient_id, db):
+    '''Returns the running heart rate aggregates of a patient
+
+    Builds a dictionary of the following format from the patient's
+    HeartRateSeries without looking at the heart rate history:
+    {"patient_id": 1, "count": 3, "average": 80.0, "min": 70,
+     "max": 90, "last_heart_rate": 90,
+     "last_time": "2020-03-09 11:00:38"}
+
+    :param patient_id: int or str containing patient ID
+    :param db: PatientStore of patient dictionaries
+    :return: dictionary of patient aggregates, str "Patient not found"
+             and error 400 if not found
+    '''
+    patient = lookup_patient(patient_id, db)
+    if patient is None:
+        return "Patient not found", 400
+    summary = {"patient_id": patient["patient_id"]}
+    with patient_lock(patient["patient_id"]):
+        summary.update(patient["series"].summary())
+    return summary
 
 
 def read_heart_rate_info(in_dict):
@@ -257,17 +551,12 @@ def add_heart_rate_to_patient_db(hr_info, timestamp):
     :param timestamp: str containing timestamp following format on GitHub
 
     :return: True if patient found and info added,
-             str "Error in adding hear rate info to database" otherwise
+             str "Error in adding hear rate info to database" if patient
+             not found, str describing the problem if the heart rate
+             cannot be stored
     '''
-    pat_id = hr_info[0]
-    pat_hr = hr_info[1]
-    global patient_db
-    for patient in patient_db:
-        if patient['patient_id'] == pat_id:
-            patient['heart_rate'].append(pat_hr)
-            patient['timestamp'].append(timestamp)
-            return True
-    return "Error in adding heart rate info to database"
+    return add_heart_rates_to_patient_db(hr_info[0], [hr_info[1]],
+                                         [timestamp])
 
 
 def current_time(time_input):
@@ -288,26 +577,21 @@ def find_physician_email(patient_id):
     :return: str containing attendant email if attendant found,
              False otherwise
     '''
-    for attendant in attendant_db:
-        if patient_id in attendant["patients"]:
-            return attendant["attending_email"]
-    return False
+    attendant = lookup_patient_attendant(patient_id, attendant_db)
+    if attendant is None:
+        return False
+    return attendant["attending_email"]
 
 
-def send_email(hr_info, timestamp):
-    '''Sends email using server to attendant if patient is tachycardic
-
-    If a tachycardic event occurs to a patient, this method creates and
-    sends an email to that patient's attendant saying they have tachycardia.
+def build_email(hr_info, timestamp):
+    '''Creates the tachycardia email for a patient's attendant
 
     :param hr_info: list containing patient ID and heart rate data point
     :param timestamp: str containing timestamp
 
-    :return: str containing email text if email sent,
-             str "Physician not in database" error 400 otherwise
+    :return: dictionary in the format taken by the email server,
+             False if the patient's physician is not in the database
     '''
-    # this email will make the POST request to email the physician
-    server = "http://vcm-7631.vm.duke.edu:5007/hrss/send_email"
     email_content = ("Your patient with the patient_id number {} "
                      "had a tachycardic heart rate of {}"
                      " at the date/time {}".format(hr_info[0],
@@ -315,71 +599,545 @@ def send_email(hr_info, timestamp):
                                                    timestamp))
     physician_email = find_physician_email(hr_info[0])
     if physician_email is False:
-        return "Physician not in database", 400
+        return False
     email_dict = {"from_email": "warning@hrsentinalserver.com",
                   "to_email": physician_email,
                   "subject": "PATIENT {} HAS TACHYCARDIA".format(hr_info[0]),
                   "content": email_content}
-    r = requests.post(server, json=email_dict)
+    return email_dict
+
+
+def send_email(hr_info, timestamp):
+    '''Sends email using server to attendant if patient is tachycardic
+
+    If a tachycardic event occurs to a patient, this method creates and
+    sends an email to that patient's attendant saying they have tachycardia.
+    The request to the email server is made before returning; the
+    heart rate route queues the email with queue_email instead.
+
+    :param hr_info: list containing patient ID and heart rate data point
+    :param timestamp: str containing timestamp
+
+    :return: str containing email text if email sent,
+             str "Physician not in database" error 400 otherwise
+    '''
+    email_dict = build_email(hr_info, timestamp)
+    if email_dict is False:
+        return "Physician not in database", 400
+    r = requests.post(EMAIL_SERVER, json=email_dict)
     return r.text
 
 
+def deliver_email(email_dict):
+    '''Posts an email to the email server for the alert dispatcher
+
+    Connection problems and server errors raise an exception so that the
+    alert dispatcher retries the email. If the email server rejects the
+    email it is logged and not retried.
+
+    :param email_dict: dictionary made by build_email
+    :return: True if the email server accepted the email, False otherwise
+    '''
+    r = requests.post(EMAIL_SERVER, json=email_dict, timeout=10)
+    if r.status_code >= 500:
+        r.raise_for_status()
+    logging.info("Email server response for " + email_dict["to_email"] +
+                 ": " + r.text + "\n")
+    return r.ok
+
+
+alert_dispatcher = AlertDispatcher(deliver_email)
+
+
+def queue_email(hr_info, timestamp):
+    '''Queues the tachycardia email to a patient's attendant
+
+    The email is handed to alert_dispatcher, whose worker threads post it
+    to the email server, so the caller does not wait on the email server.
+
+    :param hr_info: list containing patient ID and heart rate data point
+    :param timestamp: str containing timestamp
+
+    :return: str saying the alert was queued and for whom,
+             str "Physician not in database" if the physician is unknown,
+             str "Alert queue is full" if the alert could not be queued
+    '''
+    email_dict = build_email(hr_info, timestamp)
+    if email_dict is False:
+        return "Physician not in database"
+    if not alert_dispatcher.enqueue(email_dict):
+        return "Alert queue is full"
+    return "Tachycardia alert queued for " + email_dict["to_email"]
+
+
 def check_heart_rate(hr_info, timestamp):
     '''Checks heart rate and sends email if tachycardic
 
     Checks heart rate for tachyrcardia by callin is_tachycardic function
-    and send email by calling send_email function.
+    and queues an email by calling queue_email function.
 
     :param hr_info: list containing int patient ID and
                     int heart rate data point
     :param timestamp: str containing timestamp
-    :return: str of email text if email sent,
+    :return: str from queue_email if tachycardic,
              True otherwise
     '''
     age = 1
-    for patient in patient_db:
-        if patient['patient_id'] == hr_info[0]:
-            age = patient['patient_age']
+    patient = lookup_patient(hr_info[0], patient_db)
+    if patient is not None:
+        age = patient['patient_age']
+    tachycardic = is_tachycardic(age, hr_info[1])
+    if patient is not None:
+        update_patient_status(patient, tachycardic)
+    if tachycardic:
+        return queue_email(hr_info, timestamp)
+    return True
+
+
+def patient_row(patient):
+    '''Builds the attendant roster row of a patient
+
+    :param patient: patient dictionary
+    :return: dictionary with the patient's patient_id, last_heart_rate,
+             last_time and status
+    '''
+    last_heart_rate, last_time = patient["series"].last_reading()
+    return {"patient_id": patient["patient_id"],
+            "last_heart_rate": last_heart_rate,
+            "last_time": last_time,
+            "status": patient["status"]}
+
+
+def bump_patient_version(patient):
+    '''Bumps the version counters of a patient and their attendant
+
+    Called whenever a patient's heart rates or status change, so the
+    ETags of the status route and of the attendant's roster change too.
+
+    :param patient: patient dictionary
+    '''
+    if isinstance(patient_db, PatientStore):
+        patient_db.bump_version(patient["patient_id"])
+    if isinstance(attendant_db, AttendantRegistry):
+        attendant_db.bump_version(patient["attending_username"])
+
+
+def refresh_roster_row(patient):
+    '''Brings a patient's row in their attendant's roster up to date
+
+    :param patient: patient dictionary
+    '''
+    if isinstance(attendant_db, AttendantRegistry):
+        attendant_db.update_roster_row(patient["attending_username"],
+                                       patient_row(patient))
+
+
+def make_etag(version):
+    '''Builds an ETag from a version counter
+
+    The ETag includes ETAG_PREFIX, which is picked at random when the
+    server starts, so ETags from before a restart never match.
+
+    :param version: int version counter
+    :return: str ETag (without quotes)
+    '''
+    return "{}-{}".format(ETAG_PREFIX, version)
+
+
+def conditional_json(etag, build):
+    '''Answers a GET request with JSON or, if the ETag matches, a 304
+
+    The payload is only built when the client's If-None-Match header
+    does not hold the ETag.
+
+    :param etag: str ETag of the current data, None for no ETag
+    :param build: function returning the JSON serializable payload
+    :return: flask Response
+    '''
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def update_patient_status(patient, tachycardic):
+    '''Sets a patient's status after a new heart rate and announces it
+
+    The patient's new roster row is published to the subscribers of the
+    patient's attendant on patient_events (the dashboards listening on
+    GET /api/patients/<attending_username>/events).
+
+    :param patient: patient dictionary
+    :param tachycardic: bool, True if the latest heart rate is tachycardic
+    '''
+    with patient_lock(patient["patient_id"]):
+        if tachycardic:
+            patient["status"] = "tachycardic"
+        else:
             patient["status"] = "not tachycardic"
-    if is_tachycardic(age, hr_info[1]):
-        message_sent = send_email(hr_info, timestamp)
-        for patient in patient_db:
-            if patient['patient_id'] == hr_info[0]:
-                patient["status"] = "tachycardic"
-        return message_sent
+        row = patient_row(patient)
+        if isinstance(attendant_db, AttendantRegistry):
+            attendant_db.update_roster_row(patient["attending_username"],
+                                           row)
+        bump_patient_version(patient)
+    topic = patient["attending_username"]
+    if patient_events.subscriber_count(topic):
+        patient_events.publish(topic, patient["patient_id"], row)
+
+
+def process_heart_rate(in_dict, timestamp):
+    '''Verifies, stores and checks one heart rate reading
+
+    This is the pipeline behind the heart rate route: the input
+    dictionary is verified and read with request_schemas.HEART_RATE,
+    added with add_heart_rate_to_patient_db and
+    checked with check_heart_rate. Tachycardic heart rates are logged.
+    The patient's lock is held while the reading is stored and checked,
+    so concurrent readings cannot leave a status that disagrees with the
+    latest heart rate.
+
+    :param in_dict: dictionary containing patient_id and heart_rate
+    :param timestamp: str containing timestamp of the reading
+    :return: str message and int status code for the client
+    '''
+    if type(in_dict) != dict:
+        return "reading is not a dictionary", 400
+    hr_info = HEART_RATE(in_dict)
+    if type(hr_info) is str:
+        return hr_info, 400
+    with patient_lock(hr_info[0]):
+        add_heart_rate = add_heart_rate_to_patient_db(hr_info,
+                                                      timestamp)
+        if add_heart_rate is not True:
+            return add_heart_rate, 400
+        check_tachycardic = check_heart_rate(hr_info, timestamp)
+    if check_tachycardic is not True:
+        patient = find_patient(hr_info[0], patient_db)
+        logging.info("Tachycardic Heart Beat Detected..." +
+                     "Patient ID: " + str(hr_info[0]) + ", " +
+                     "Heart Rate: " + str(hr_info[1]) + ", " +
+                     "Attending Physician: " +
+                     patient["attending_username"] + "\n")
+        return check_tachycardic, 200
+    return "Heart rate information is stored", 200
+
+
+class NdjsonSplitter:
+    '''Splits chunks of an NDJSON body into lines as they arrive
+
+    Complete lines are returned as soon as the chunk that ends them is fed
+    in, so a long-lived request body is never held in memory. A line
+    longer than max_line bytes is discarded and None is returned in its
+    place, so it can be reported as a bad reading rather than growing the
+    buffer without bound.
+
+    :param max_line: int longest line in bytes that is kept
+    '''
+
+    def __init__(self, max_line=65536):
+        self.max_line = max_line
+        self._buffer = b""
+        self._discarding = False
+
+    def feed(self, chunk):
+        '''Adds a chunk of the body
+
+        :param chunk: bytes read from the body
+        :return: list of bytes lines without their line endings, None for
+                 each line that was too long
+        '''
+        found = list()
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            if self._discarding:
+                self._discarding = False
+            elif len(line) > self.max_line:
+                found.append(None)
+            else:
+                found.append(line.rstrip(b"\r"))
+        if len(self._buffer) > self.max_line:
+            if not self._discarding:
+                found.append(None)
+            self._buffer = b""
+            self._discarding = True
+        return found
+
+    def close(self):
+        '''Ends the body
+
+        :return: list holding the last line if the body did not end with a
+                 line ending, empty list otherwise
+        '''
+        buffer, self._buffer = self._buffer, b""
+        if buffer and not self._discarding:
+            return [buffer.rstrip(b"\r")]
+        return []
+
+
+def iter_ndjson_lines(stream, chunk_size=65536, max_line=65536):
+    '''Splits a binary stream into lines as it is read
+
+    The stream is read chunk_size bytes at a time and passed through an
+    NdjsonSplitter.
+
+    :param stream: binary file-like object such as request.stream
+    :param chunk_size: int number of bytes read at a time
+    :param max_line: int longest line in bytes that is kept
+    :return: generator of bytes lines without their line endings, None
+             for each line that was too long
+    '''
+    splitter = NdjsonSplitter(max_line)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+
+def process_ndjson_line(line, timestamp):
+    '''Stores and checks the reading on one line of an NDJSON stream
+
+    :param line: bytes line, None if the line was too long
+    :param timestamp: str containing timestamp of the reading
+    :return: str message and int status code, as for process_heart_rate
+    '''
+    if line is None:
+        return "line is too long", 400
+    try:
+        return process_heart_rate(app.json.codec.loads(line), timestamp)
+    except ValueError:
+        return "line is not valid JSON", 400
+
+
+def read_heart_rate_batch(records, timestamp):
+    '''Verifies the readings of a heart rate batch and groups them by patient
+
+    Each record is a dictionary in the format taken by the heart rate
+    route, with an optional "timestamp" key in "%Y-%m-%d %H:%M:%S" format.
+    Records without a timestamp are given the input timestamp. Records
+    that fail verification are given an error result and left out of the
+    groups.
+
+    :param records: list of reading dictionaries
+    :param timestamp: str containing timestamp for records without one
+    :return: dictionary of patient ID to list of (record index, heart rate,
+             timestamp) tuples, and a list with an error result dictionary
+             for each bad record and None for each good one
+    '''
+    groups = dict()
+    results = [None] * len(records)
+    for i, record in enumerate(records):
+        if type(record) != dict:
+            results[i] = {"stored": False,
+                          "error": "reading is not a dictionary"}
+            continue
+        hr_info = HEART_RATE(record)
+        if type(hr_info) is str:
+            results[i] = {"stored": False, "error": hr_info}
+            continue
+        pat_id, pat_hr = hr_info
+        if type(pat_hr) != int or not 0 <= pat_hr <= 0xFFFF:
+            results[i] = {"stored": False, "patient_id": pat_id,
+                          "error": "heart_rate value is not a valid "
+                                   "heart rate"}
+            continue
+        reading_time = record.get("timestamp", timestamp)
+        try:
+            reading_time = current_time(
+                datetime.strptime(reading_time, "%Y-%m-%d %H:%M:%S"))
+        except (TypeError, ValueError):
+            results[i] = {"stored": False, "patient_id": pat_id,
+                          "error": "timestamp must be in "
+                                   "%Y-%m-%d %H:%M:%S format"}
+            continue
+        groups.setdefault(pat_id, list()).append((i, pat_hr, reading_time))
+    return groups, results
+
+
+def add_heart_rates_to_patient_db(pat_id, heart_rates, timestamps):
+    '''Adds many heart rates of one patient to database at once
+
+    The bulk version of add_heart_rate_to_patient_db: the patient is
+    looked up once and the readings are added to the patient's series
+    together.
+
+    :param pat_id: int containing patient ID
+    :param heart_rates: list of ints containing heart rates
+    :param timestamps: list of str containing timestamps
+
+    :return: True if patient found and info added,
+             str "Error in adding heart rate info to database" if patient
+             not found, str describing the problem if the heart rates
+             cannot be stored
+    '''
+    patient = lookup_patient(pat_id, patient_db)
+    if patient is None:
+        return "Error in adding heart rate info to database"
+    series = patient['series']
+    with patient_lock(pat_id):
+        first_seq = series.appended
+        try:
+            series.extend(heart_rates, timestamps)
+        except ValueError as e:
+            return str(e)
+        if storage is not None:
+            storage.log_readings(pat_id, first_seq, heart_rates,
+                                 [to_epoch_ms(t) for t in timestamps])
+        refresh_roster_row(patient)
+        bump_patient_version(patient)
+        if retention_policy is not None:
+            retention_policy.maybe_apply(series)
+        if history_archive is not None:
+            history_archive.maybe_seal(pat_id, series)
     return True
 
 
+def check_heart_rates(pat_id, heart_rates, timestamps):
+    '''Checks many heart rates of one patient and queues at most one email
+
+    The bulk version of check_heart_rate. Every heart rate is classified,
+    the patient's status is set from their latest stored heart rate, and
+    if any of the heart rates is tachycardic a single email is queued for
+    the most recent tachycardic one.
+
+    :param pat_id: int containing patient ID
+    :param heart_rates: list of ints containing heart rates
+    :param timestamps: list of str containing timestamps or of int epoch
+                       milliseconds
+    :return: list of bools, True for each tachycardic heart rate, and the
+             str from queue_email (None if no email was queued)
+    '''
+    age = 1
+    patient = lookup_patient(pat_id, patient_db)
+    if patient is not None:
+        age = patient['patient_age']
+    flags = tachycardia_table.classify_batch(age, heart_rates).tolist()
+    if patient is not None and len(patient['series']):
+        latest = patient['series'].rate_at(-1)
+        update_patient_status(patient, is_tachycardic(age, latest))
+    message = None
+    tachycardic = [i for i, flag in enumerate(flags) if flag]
+    if tachycardic:
+        last = max(tachycardic, key=lambda i: timestamps[i])
+        when = timestamps[last]
+        if type(when) is int:
+            when = format_epoch_ms(when)
+        message = queue_email([pat_id, heart_rates[last]], when)
+    return flags, message
+
+
+def ingest_heart_rate_batch(records, timestamp):
+    '''Stores and checks a batch of heart rate readings
+
+    Readings are verified and grouped by patient with
+    read_heart_rate_batch, then each patient's readings are added with
+    add_heart_rates_to_patient_db and classified with check_heart_rates
+    while holding that patient's lock.
+
+    :param records: list of reading dictionaries
+    :param timestamp: str containing timestamp for records without one
+    :return: list of result dictionaries in the same order as the records
+    '''
+    groups, results = read_heart_rate_batch(records, timestamp)
+    for pat_id, readings in groups.items():
+        readings.sort(key=lambda reading: reading[2])
+        indexes = [reading[0] for reading in readings]
+        heart_rates = [reading[1] for reading in readings]
+        timestamps = [reading[2] for reading in readings]
+        with patient_lock(pat_id):
+            added = add_heart_rates_to_patient_db(pat_id, heart_rates,
+                                                  timestamps)
+            if added is not True:
+                for i in indexes:
+                    results[i] = {"stored": False, "patient_id": pat_id,
+                                  "error": added}
+                continue
+            flags, message = check_heart_rates(pat_id, heart_rates,
+                                               timestamps)
+        for i, hr, time, flag in zip(indexes, heart_rates, timestamps,
+                                     flags):
+            results[i] = {"stored": True, "patient_id": pat_id,
+                          "heart_rate": hr, "timestamp": time,
+                          "tachycardic": flag}
+        if message is not None:
+            last = max((i for i, flag in zip(indexes, flags) if flag),
+                       key=lambda i: results[i]["timestamp"])
+            results[last]["alert"] = message
+    return results
+
+
+def ingest_binary_records(data, timestamp):
+    '''Stores and checks heart rates sent as packed binary records
+
+    The records (see binary_ingest) are read in place, grouped by patient
+    and put in time order, then each patient's readings go through
+    add_heart_rates_to_patient_db and check_heart_rates while holding that
+    patient's lock, the same as a JSON batch.
+
+    :param data: bytes-like object holding whole records
+    :param timestamp: str containing timestamp for records whose device
+                      timestamp is SERVER_TIME
+    :return: dictionary with the numbers of readings stored, rejected and
+             found tachycardic, and an error dictionary for each patient
+             whose readings were rejected
+    :raises ValueError: if data is not a whole number of records
+    '''
+    patient_ids, heart_rates, timestamps = decode_records(data)
+    timestamps = np.where(timestamps == SERVER_TIME, to_epoch_ms(timestamp),
+                          timestamps)
+    stored = tachycardic = 0
+    errors = list()
+    for pat_id, indexes in group_by_patient(patient_ids, timestamps):
+        rates = heart_rates[indexes].tolist()
+        times = timestamps[indexes].tolist()
+        with patient_lock(pat_id):
+            added = add_heart_rates_to_patient_db(pat_id, rates, times)
+            if added is not True:
+                errors.append({"patient_id": pat_id, "readings": len(rates),
+                               "error": added})
+                continue
+            flags, message = check_heart_rates(pat_id, rates, times)
+        stored += len(rates)
+        tachycardic += sum(flags)
+    return {"stored": stored, "rejected": len(patient_ids) - stored,
+            "tachycardic": tachycardic, "errors": errors}
+
+
 def get_patient_status(patient_id):
     '''Outputs dictionary containing patient status
 
     This function takes in a patinent ID, finds them in the patient
     database, and builds a containing the status information which
-    is then output.
+    is then output. When the patient has a row in their attendant's
+    roster the information comes from that row, which is replaced as a
+    whole on every change, so it is read without locking and the heart
+    rate, timestamp and status always belong together.
 
     :param patient_id: int containing patient ID
     :return: dictionary of patient status if patient found,
              str "Patient not found" if patient not found
     '''
-    patient_id = int(patient_id)
-    for patient in patient_db:
-        if patient["patient_id"] == patient_id:
-            heart_rate = patient['heart_rate']
-            if len(heart_rate) == 1:
-                heart_rate = heart_rate[0]
-            else:
-                heart_rate = heart_rate[-1]
-            status = patient['status']
-            timestamp = patient['timestamp']
-            if len(timestamp) == 1:
-                timestamp = timestamp[0]
-            else:
-                timestamp = timestamp[-1]
-            status_dict = {"heart_rate": heart_rate,
-                           "status": status,
-                           "timestamp": timestamp}
-            return status_dict
-    return "Patient not found"
+    patient = lookup_patient(int(patient_id), patient_db)
+    if patient is None:
+        return "Patient not found"
+    if isinstance(attendant_db, AttendantRegistry):
+        row = attendant_db.roster_row(patient["attending_username"],
+                                      patient["patient_id"])
+        if row is not None:
+            return {"heart_rate": row["last_heart_rate"],
+                    "status": row["status"],
+                    "timestamp": row["last_time"]}
+    heart_rate, timestamp = patient['series'].last_reading()
+    status = patient['status']
+    status_dict = {"heart_rate": heart_rate,
+                   "status": status,
+                   "timestamp": timestamp}
+    return status_dict
 
 
 def get_patient_id_list(attending_username):
@@ -388,9 +1146,9 @@ def get_patient_id_list(attending_username):
     :param attending_username: str containing attendant username
     :return: list of ints containing patient IDs
     '''
-    for attendant in attendant_db:
-        if attendant["attending_username"] == attending_username:
-            return attendant["patients"]
+    attendant = lookup_attendant(attending_username, attendant_db)
+    if attendant is not None:
+        return attendant["patients"]
 
 
 def patients_for_attending_username(patient_id_list):
@@ -408,36 +1166,50 @@ def patients_for_attending_username(patient_id_list):
              in the above format
     '''
     patients_list = list()
-    for patient in patient_db:
-        if patient["patient_id"] in patient_id_list:
-            last_heart_rate = patient["heart_rate"]
-            if len(last_heart_rate) == 1:
-                last_heart_rate = last_heart_rate[0]
-            else:
-                last_heart_rate = last_heart_rate[-1]
-            last_time = patient["timestamp"]
-            if len(last_time) == 1:
-                last_time = last_time[0]
-            else:
-                last_time = last_time[-1]
-            temp_dict = {"patient_id": patient["patient_id"],
-                         "last_heart_rate": last_heart_rate,
-                         "last_time": last_time,
-                         "status": patient["status"]}
-            patients_list.append(temp_dict)
+    for patient_id in patient_id_list:
+        patient = lookup_patient(patient_id, patient_db)
+        if patient is not None:
+            patients_list.append(patient_row(patient))
     return patients_list
 
 
+def get_roster(attending_username):
+    '''Returns the roster rows of an attendant's patients
+
+    With an AttendantRegistry this copies the attendant's materialized
+    roster, which is kept up to date as readings arrive, so the time
+    taken depends only on the number of the attendant's patients. Rows
+    are built first for any of the attendant's patients that have none,
+    such as patients put straight into patient_db with append. A plain
+    list of attendants falls back to patients_for_attending_username.
+
+    :param attending_username: str containing attendant username
+    :return: list of dictionaries in the format of patient_row
+    '''
+    if isinstance(attendant_db, AttendantRegistry):
+        for patient_id in get_patient_id_list(attending_username) or ():
+            if attendant_db.roster_row(attending_username,
+                                       patient_id) is not None:
+                continue
+            patient = lookup_patient(patient_id, patient_db)
+            if patient is not None:
+                with patient_lock(patient_id):
+                    attendant_db.update_roster_row(attending_username,
+                                                   patient_row(patient))
+        return attendant_db.roster(attending_username)
+    return patients_for_attending_username(
+        get_patient_id_list(attending_username))
+
+
 # Verification functions under this line
 def verify_new_attending(in_dict):
     """
     This function verifies the input information for post_new_attending()
 
     This function receives the dictionary containing the input
-    from the function post_new_attending(). The function uses a for
-    loop to check if the key strings are the same as the expected
-    key strings and that the value types are the same as
-    the expected value types. If the keys are incorrect, then a
+    from the function post_new_attending(). The checks are built
+    from request_schemas.NEW_ATTENDING, which the route calls directly to
+    get the values in the same pass. If a key is missing, then a
     string notifying the client that a key is missing is returned.
     If a value type is incorrect, then a string is returned
     to the patient saying that a specific value is of the wrong type.
@@ -447,14 +1219,9 @@ def verify_new_attending(in_dict):
     types and a string explaining why the dictionary is wrong
     otherwise.
     """
-    expected_keys = ("attending_username", "attending_email",
-                     "attending_phone")
-    expected_values = (str, str, str)
-    for key, ty in zip(expected_keys, expected_values):
-        if key not in in_dict.keys():
-            return "{} key not found in input".format(key)
-        if type(in_dict[key]) != ty:
-            return "{} value is not the correct type".format(key)
+    result = NEW_ATTENDING(in_dict)
+    if type(result) is str:
+        return result
     return True
 
 
@@ -462,27 +1229,21 @@ def verify_internal_average(in_dict):
     """This function verifies the input information for post_interval_average()
 
     This function receives the dictionary containing the input
-    from the function post_interval_average(). The function uses a for
-    loop to check if the key strings are the same as the expected
-    key strings and that the value types are the same as
-    the expected value types. If the keys are incorrect, then a
+    from the function post_interval_average(). The checks are built
+    from request_schemas.INTERVAL_AVERAGE, which the route calls directly to
+    get the values in the same pass. If a key is missing, then a
     string notifying the client that a key is missing is returned.
-    If a value type is incorrect, then the function
-    check_if_bad_input() is called to see if a value contains a
-    numeric string. If this too fails, then a string is returned
+    Integer values may also be strings of digits. If a value type is
+    incorrect, then a string is returned
     to the patient saying that a specific value is of the wrong type.
     If nothing is wrong, then this function returns True.
     :param in_dict: a dictionary sent from the client
     :return: True if the dictionary has the correct keys and value
     types and a string explaining why the dictionary is wrong
     otherwise."""
-    expected_keys = ("patient_id", "heart_rate_average_since")
-    expected_values = (int, str)
-    for key, ty in zip(expected_keys, expected_values):
-        if key not in in_dict.keys():
-            return "{} key not found in input".format(key)
-        if type(in_dict[key]) != ty and check_bad_input(in_dict[key]):
-            return "{} value is not the correct type".format(key)
+    result = INTERVAL_AVERAGE(in_dict)
+    if type(result) is str:
+        return result
     return True
 
 
@@ -492,8 +1253,8 @@ def verify_attendant_exists(attending_username):
     attending_username exists in attending_db
 
     This function receives the attending_username as
-    input and uses a for loop to see if any of the stored
-    physician information in the attending_db has the
+    input and looks it up in the attending_db to see if any of
+    the stored physician information has the
     attending_username sent as the input. If there is one,
     Then this function returns true. If not, then this function
     returns a string notifying the client.
@@ -501,9 +1262,8 @@ def verify_attendant_exists(attending_username):
     :return: True if a dictionary exists that has the
     attending_username, or a string explaining otherwise
     """
-    for attendant in attendant_db:
-        if attendant["attending_username"] == attending_username:
-            return True
+    if lookup_attendant(attending_username, attendant_db) is not None:
+        return True
     return "The physician does not exist in database"
 
 
@@ -511,27 +1271,21 @@ def verify_heart_rate_post(in_dict):
     """This function verifies the input information for post_heart_rate()
 
     This function receives the dictionary containing the input
-    from the function post_heart_rate(). The function uses a for
-    loop to check if the key strings are the same as the expected
-    key strings and that the value types are the same as
-    the expected value types. If the keys are incorrect, then a
+    from the function post_heart_rate(). The checks are built
+    from request_schemas.HEART_RATE, which the route calls directly to
+    get the values in the same pass. If a key is missing, then a
     string notifying the client that a key is missing is returned.
-    If a value type is incorrect, then the function
-    check_if_bad_input() is called to see if a value contains a
-    numeric string. If this too fails, then a string is returned
+    Integer values may also be strings of digits. If a value type is
+    incorrect, then a string is returned
     to the patient saying that a specific value is of the wrong type.
     If nothing is wrong, then this function returns True.
     :param in_dict: a dictionary sent from the client
     :return: True if the dictionary has the correct keys and value
     types and a string explaining why the dictionary is wrong
     otherwise."""
-    expected_keys = ("patient_id", "heart_rate")
-    expected_values = (int, int)
-    for key, ty in zip(expected_keys, expected_values):
-        if key not in in_dict.keys():
-            return "{} key not found in input".format(key)
-        if type(in_dict[key]) != ty and check_bad_input(in_dict[key]):
-            return "{} value is not the correct type".format(key)
+    result = HEART_RATE(in_dict)
+    if type(result) is str:
+        return result
     return True
 
 
@@ -539,30 +1293,238 @@ def verify_new_patient_info(in_dict):
     """This function verifies the input information for post_new_patient()
 
     This function receives the dictionary containing the input
-    from the function post_new_patient(). The function uses a for
-    loop to check if the key strings are the same as the expected
-    key strings and that the value types are the same as
-    the expected value types. If the keys are incorrect, then a
+    from the function post_new_patient(). The checks are built
+    from request_schemas.NEW_PATIENT, which the route calls directly to
+    get the values in the same pass. If a key is missing, then a
     string notifying the client that a key is missing is returned.
-    If a value type is incorrect, then the function
-    check_if_bad_input() is called to see if a value contains a
-    numeric string. If this too fails, then a string is returned
+    Integer values may also be strings of digits. If a value type is
+    incorrect, then a string is returned
     to the patient saying that a specific value is of the wrong type.
     If nothing is wrong, then this function returns True.
     :param in_dict: a dictionary sent from the client
     :return: True if the dictionary has the correct keys and value
     types and a string explaining why the dictionary is wrong
     otherwise."""
-    expected_keys = ("patient_id", "attending_username", "patient_age")
-    expected_values = (int, str, int)
-    for key, ty in zip(expected_keys, expected_values):
-        if key not in in_dict.keys():
-            return "{} key not found in input".format(key)
-        if type(in_dict[key]) != ty and check_bad_input(in_dict[key]):
-            return "{} value is not the correct type".format(key)
+    result = NEW_PATIENT(in_dict)
+    if type(result) is str:
+        return result
     return True
 
 
+def apply_storage_event(kind, values):
+    '''Applies an event recovered by the storage engine to the databases
+
+    Events that are already present are skipped, so a patient or heart
+    rate found in both a snapshot and the log after it is only added once.
+    Heart rates are matched by their sequence number in the patient's
+    series.
+
+    :param kind: str "attendant", "patient" or "readings"
+    :param values: tuple of values, see StorageEngine.recover
+    '''
+    if kind == "attendant":
+        if values[0] not in attendant_db:
+            add_attendant_to_db(list(values), attendant_db)
+    elif kind == "patient":
+        patient_id, username, age, status, series = values
+        if patient_id in patient_db:
+            return
+        if series is None:
+            series = HeartRateSeries()
+        patient_db.append({"patient_id": patient_id,
+                           "attending_username": username,
+                           "patient_age": age,
+                           "heart_rate": series.heart_rate,
+                           "timestamp": series.timestamp,
+                           "status": status or "", "series": series})
+        attendant_db.add_patient(username, patient_id)
+    elif kind == "readings":
+        patient_id, first_seq, rates, times = values
+        patient = lookup_patient(patient_id, patient_db)
+        if patient is None:
+            return
+        skip = patient["series"].appended - first_seq
+        if skip < len(rates):
+            patient["series"].extend(rates[max(skip, 0):],
+                                     times[max(skip, 0):])
+
+
+def rescore_patients():
+    '''Sets every patient's status from their latest heart rate
+
+    The latest heart rates and ages of all patients are classified in one
+    call to tachycardia_table.classify_batch. A patient who gets a new
+    heart rate meanwhile keeps the status that heart rate gave them.
+
+    :return: int number of patients whose status was set
+    '''
+    patients = [patient for patient in list(patient_db)
+                if len(patient["series"])]
+    seen = [patient["series"].appended for patient in patients]
+    flags = tachycardia_table.classify_batch(
+        [patient["patient_age"] for patient in patients],
+        [patient["series"].rate_at(-1) for patient in patients])
+    for patient, appended, flag in zip(patients, seen, flags.tolist()):
+        with patient_lock(patient["patient_id"]):
+            if patient["series"].appended != appended:
+                continue
+            if flag:
+                patient["status"] = "tachycardic"
+            else:
+                patient["status"] = "not tachycardic"
+            refresh_roster_row(patient)
+            bump_patient_version(patient)
+    return len(patients)
+
+
+def set_tachycardia_bands(bands):
+    '''Replaces the tachycardia age bands and re-scores every patient
+
+    :param bands: sequence of (first age, limit) pairs, see
+                  tachycardia.TachycardiaTable
+    :return: the new TachycardiaTable
+    '''
+    global tachycardia_table
+    tachycardia_table = TachycardiaTable(bands)
+    rescore_patients()
+    return tachycardia_table
+
+
+def open_storage(directory, **options):
+    '''Recovers the databases from disk and logs every later change
+
+    The newest snapshot and the log after it are loaded into patient_db
+    and attendant_db, the status of each patient is set from their latest
+    heart rate by rescore_patients, and from then on new attendants,
+    patients and heart rates are written to the log of a StorageEngine.
+    Snapshots copy each patient while holding their patient_lock, like
+    every other multi-step read of a patient's series.
+
+    :param directory: str path of the data directory
+    :param options: keyword arguments passed on to StorageEngine
+    :return: the StorageEngine
+    '''
+    global storage
+    engine = StorageEngine(directory, **options)
+    engine.recover(apply_storage_event)
+    rescore_patients()
+    for patient in patient_db:
+        refresh_roster_row(patient)
+    engine.snapshot_source = lambda: (attendant_db, patient_db)
+    engine.snapshot_lock_for = patient_lock
+    storage = engine
+    return engine
+
+
+def open_history(directory, **options):
+    '''Starts sealing older heart rates into memory-mapped segment files
+
+    Patients already in patient_db are sealed straight away, and from then
+    on each patient's series is checked after new heart rates are added.
+
+    :param directory: str path of the directory for segment files
+    :param options: keyword arguments passed on to HistoryArchive
+    :return: the HistoryArchive
+    '''
+    global history_archive
+    archive = HistoryArchive(directory, **options)
+    for patient in patient_db:
+        with patient_lock(patient["patient_id"]):
+            archive.maybe_seal(patient["patient_id"], patient["series"])
+    history_archive = archive
+    return archive
+
+
+def open_retention(raw_age, minute_age=None):
+    '''Starts rolling older heart rates into minute and hour aggregates
+
+    The policy is applied to every patient already in patient_db and from
+    then on after new heart rates are added.
+
+    :param raw_age: int milliseconds of raw heart rates to keep
+    :param minute_age: int milliseconds of minute aggregates to keep, None
+                       to keep them all
+    :return: the RetentionPolicy
+    '''
+    global retention_policy
+    policy = RetentionPolicy(raw_age, minute_age)
+    for patient in patient_db:
+        with patient_lock(patient["patient_id"]):
+            policy.apply(patient["series"])
+    retention_policy = policy
+    return policy
+
+
+def open_binary_listener(host="127.0.0.1", port=5050):
+    '''Starts taking packed binary records over TCP
+
+    The listener runs on a background thread and every run of records it
+    receives is stored with ingest_binary_records.
+
+    :param host: str host to listen on
+    :param port: int port to listen on, 0 for any free port
+    :return: the BinaryIngestServer
+    '''
+    global binary_listener
+
+    def ingest(data):
+        return ingest_binary_records(data, current_time(datetime.now()))
+
+    listener = BinaryIngestServer((host, port), ingest)
+    threading.Thread(target=listener.serve_forever, daemon=True).start()
+    binary_listener = listener
+    return listener
+
+
+def set_json_codec(name=None):
+    '''Picks the JSON codec used by every route
+
+    :param name: str codec name ("orjson" or "json"), None for the fastest
+                 one installed
+    :return: the codec object
+    :raises ValueError: if the codec is unknown or not installed
+    '''
+    app.json.codec = get_codec(name)
+    return app.json.codec
+
+
+def open_from_environment(environ):
+    '''Opens storage, segments and retention as set by HR_ variables
+
+    HR_JSON_CODEC picks the JSON codec, HR_TACHYCARDIA_BANDS
+    ("age:limit,age:limit,...") sets the tachycardia age bands,
+    HR_DATA_DIR, HR_FSYNC and HR_SNAPSHOT_EVERY set up
+    open_storage, HR_SEGMENT_DIR, HR_SEGMENT_SIZE and HR_RESIDENT_READINGS
+    set up open_history, and HR_RAW_RETENTION and HR_MINUTE_RETENTION (in
+    seconds) set up open_retention, and HR_BINARY_PORT and HR_BINARY_HOST
+    set up open_binary_listener. Anything not set is left off.
+
+    :param environ: dictionary of environment variables
+    '''
+    if environ.get("HR_JSON_CODEC"):
+        set_json_codec(environ["HR_JSON_CODEC"])
+    if environ.get("HR_TACHYCARDIA_BANDS"):
+        set_tachycardia_bands(parse_bands(environ["HR_TACHYCARDIA_BANDS"]))
+    if environ.get("HR_DATA_DIR"):
+        open_storage(environ["HR_DATA_DIR"],
+                     fsync=environ.get("HR_FSYNC", "interval"),
+                     snapshot_every=int(environ.get("HR_SNAPSHOT_EVERY",
+                                                    100000)))
+    if environ.get("HR_SEGMENT_DIR"):
+        open_history(environ["HR_SEGMENT_DIR"],
+                     segment_size=int(environ.get("HR_SEGMENT_SIZE",
+                                                  65536)),
+                     keep=int(environ.get("HR_RESIDENT_READINGS", 4096)),
+                     max_open=int(environ.get("HR_OPEN_SEGMENTS", 256)))
+    if environ.get("HR_RAW_RETENTION"):
+        minute_age = environ.get("HR_MINUTE_RETENTION")
+        open_retention(int(environ["HR_RAW_RETENTION"]) * 1000,
+                       int(minute_age) * 1000 if minute_age else None)
+    if environ.get("HR_BINARY_PORT"):
+        open_binary_listener(environ.get("HR_BINARY_HOST", "127.0.0.1"),
+                             int(environ["HR_BINARY_PORT"]))
+
+
 # Put all of the route functions below this line
 @app.route("/api/new_patient", methods=["POST"])
 def post_new_patient():
@@ -586,15 +1548,13 @@ def post_new_patient():
     there was an error and a corresponding status code
     """
     in_dict = request.get_json()
-    verify_input = verify_new_patient_info(in_dict)
-    if verify_input is not True:
-        return verify_input, 400
-    patient_info = read_patient(in_dict)
+    patient_info = NEW_PATIENT(in_dict)
+    if type(patient_info) is str:
+        return patient_info, 400
     flag = add_patient_to_attendant_db(patient_info, attendant_db)
     if flag:
         return "Attendant does not exist", 400
     add_patient_to_db(patient_info)
-    print(patient_db)
     logging.info("New patient added... " + "Patient ID: " +
                  str(in_dict["patient_id"]) + "\n")
     return "Patient information stored", 200
@@ -622,10 +1582,10 @@ def post_new_attending():
      status code
     """
     in_dict = request.get_json()
-    verify_input = verify_new_attending(in_dict)
-    if verify_input is not True:
-        return verify_input, 400
-    print(add_attendant_to_db(read_attending(in_dict), attendant_db))
+    attendant_info = NEW_ATTENDING(in_dict)
+    if type(attendant_info) is str:
+        return attendant_info, 400
+    add_attendant_to_db(attendant_info, attendant_db)
     logging.info("New attendant added... Username: " +
                  in_dict["attending_username"] + ", email: " +
                  in_dict["attending_email"] + "\n")
@@ -648,36 +1608,123 @@ def post_heart_rate():
     the dictionary with the corresponding patient_id. If there is no
     such patient_id then an error is returned. Then this function
     calls the function check_heart_rate(). If the heart_rate is
-    tachycardic then the function check_heart_rate() will trigger
-    an email being sent to the patient's attending physician, and
-    a string will be returned to the client notifying them of this.
+    tachycardic then the function check_heart_rate() will queue
+    an email to the patient's attending physician, and a string will
+    be returned to the client notifying them of this. The email is sent
+    in the background so the response does not wait for the email
+    server.
 
     :return: A string signaling if the heart rate is
      properly added to the database. If the heart rate is tachycardic,
-     then a string signaling that an email was sent to the physician is
+     then a string signaling that an email was queued for the physician is
      returned.
     """
     in_dict = request.get_json()
-    verify_input = verify_heart_rate_post(in_dict)
-    if verify_input is not True:
-        return verify_input, 400
-    hr_info = read_heart_rate_info(in_dict)
+    return process_heart_rate(in_dict, current_time(datetime.now()))
+
+
+@app.route("/api/heart_rate/stream", methods=["POST"])
+def post_heart_rate_stream():
+    """
+    This function stores a stream of heart rates sent as NDJSON
+
+    This function receives a request body of newline-delimited JSON,
+    with one dictionary in the format taken by post_heart_rate() on
+    each line, and usually sent with chunked transfer encoding so a
+    monitor can keep one request open and write readings as they are
+    taken. The body is read a chunk at a time and each reading is
+    stored and checked by process_heart_rate() as soon as its line is
+    complete, so the whole body is never held in memory. The response
+    is streamed back as NDJSON too: one acknowledgement per reading
+    with the line number, status code and message that
+    post_heart_rate() would have returned, and a final line with the
+    number of readings stored and rejected.
+
+    :return: A streamed NDJSON response of acknowledgements
+    """
+    stream = request.stream
+    dumps = app.json.codec.dumps
+
+    def generate():
+        stored = 0
+        rejected = 0
+        for number, line in enumerate(iter_ndjson_lines(stream), 1):
+            if line is not None and not line.strip():
+                continue
+            message, code = process_ndjson_line(
+                line, current_time(datetime.now()))
+            if code == 200:
+                stored += 1
+            else:
+                rejected += 1
+            yield dumps({"line": number, "status_code": code,
+                         "message": message}) + b"\n"
+        yield dumps({"stored": stored, "rejected": rejected}) + b"\n"
+
+    return Response(stream_with_context(generate()),
+                    mimetype="application/x-ndjson")
+
+
+@app.route("/api/heart_rate/batch", methods=["POST"])
+def post_heart_rate_batch():
+    """
+    This function stores a batch of heart rates for many patients
+
+    This function receives either a list of reading dictionaries or a
+    dictionary with the list under the key "readings". Each reading has
+    the same keys as the input of post_heart_rate() plus an optional
+    "timestamp" in "%Y-%m-%d %H:%M:%S" format; readings without a
+    timestamp get the current time. The readings are grouped by
+    patient, each patient's readings are added to the database together
+    and classified once, and at most one email is queued per patient.
+    Bad readings are reported without stopping the rest of the batch.
+
+    :return: A dictionary with the number of readings stored and
+     rejected and a list with a result dictionary for each reading, in
+     the order they were sent
+    """
+    in_data = request.get_json()
+    if type(in_data) == dict:
+        if "readings" not in in_data.keys():
+            return "readings key not found in input", 400
+        in_data = in_data["readings"]
+    if type(in_data) != list:
+        return "readings value is not the correct type", 400
     timestamp = current_time(datetime.now())
-    add_heart_rate = add_heart_rate_to_patient_db(hr_info,
-                                                  timestamp)
-    if add_heart_rate is not True:
-        return add_heart_rate, 400
-    check_tachycardic = check_heart_rate(hr_info, timestamp)
-    if check_tachycardic is not True:
-        patient = find_patient(hr_info[0], patient_db)
-        logging.info("Tachycardic Heart Beat Detected..." +
-                     "Patient ID: " + str(hr_info[0]) + ", " +
-                     "Heart Rate: " + str(hr_info[1]) + ", " +
-                     "Attending Physician: " +
-                     patient["attending_username"] + "\n")
-        return check_tachycardic, 200
-    print(patient_db)
-    return "Heart rate information is stored", 200
+    results = ingest_heart_rate_batch(in_data, timestamp)
+    stored = sum(1 for result in results if result["stored"])
+    logging.info("Heart rate batch stored... " + str(stored) + " of " +
+                 str(len(results)) + " readings\n")
+    return jsonify({"stored": stored, "rejected": len(results) - stored,
+                    "results": results})
+
+
+@app.route("/api/heart_rate/binary", methods=["POST"])
+def post_heart_rate_binary():
+    """
+    This function stores heart rates sent as packed binary records
+
+    The body is a run of fixed-width records, application/octet-stream,
+    as described in binary_ingest: patient_id, heart_rate and the device
+    timestamp in epoch milliseconds, or 0 for the current time. The
+    readings go through the same storage and tachycardia checks as a
+    JSON batch.
+
+    :return: A dictionary with the number of readings stored, rejected
+     and tachycardic and an error dictionary for each patient whose
+     readings were rejected
+    """
+    if request.mimetype != MIME_TYPE:
+        return "Content-Type must be " + MIME_TYPE, 400
+    try:
+        result = ingest_binary_records(request.get_data(),
+                                       current_time(datetime.now()))
+    except ValueError as e:
+        return str(e), 400
+    logging.info("Binary heart rates stored... " + str(result["stored"]) +
+                 " of " + str(result["stored"] + result["rejected"]) +
+                 " readings\n")
+    return jsonify(result)
 
 
 @app.route("/api/heart_rate/<patient_id>", methods=["GET"])
@@ -686,14 +1733,47 @@ def get_patient_heart_data(patient_id):
     This function returns a list of heart rates for a patient.
 
     This function is for a GET request and receives a patient_id
-    as part of a variable URL. The function gets the list of
-    heart_rate for the corresponding patient_id and sends it to a
-    client in a JSON format.
+    as part of a variable URL. Without query parameters the function
+    gets the list of heart_rate for the corresponding patient_id and
+    sends it to a client in a JSON format. Lists longer than
+    HISTORY_PAGE are streamed a page at a time, so the whole list is
+    never built in memory. Each page is read while holding the patient's
+    lock, and pages follow each other by timestamp, so readings added or
+    rolled up while the list is sent do not shift it.
+
+    With any of the since, until, limit, cursor or format query
+    parameters (see read_history_args) the readings in the time range
+    are returned with their timestamps. As JSON the response is one page:
+    {"patient_id": 1, "readings": [{"heart_rate": 70,
+    "timestamp": "2018-03-09 11:00:36"}, ...], "next_cursor": "..."},
+    where next_cursor is passed back as cursor to get the next page and
+    is None after the last page. As NDJSON each reading is sent on its
+    own line as it is read from the series, followed by a
+    {"next_cursor": "..."} line if a limit cut the range short.
 
     :param patient_id: a number corresponding to a patient in patient_db
-    :return: list of heart rates for that patient
+    :return: list of heart rates for that patient, or a page or stream of
+             readings
     """
-    return jsonify(get_patient_heart_rates(patient_id, patient_db))
+    if not any(key in request.args for key in HISTORY_ARGS):
+        patient = lookup_patient(patient_id, patient_db)
+        if patient is None:
+            return jsonify(get_patient_heart_rates(patient_id, patient_db))
+        if len(patient["series"]) <= HISTORY_PAGE:
+            return Response(heart_rates_json(patient) + b"\n",
+                            mimetype="application/json")
+        return Response(iter_history_list(patient),
+                        mimetype="application/json")
+    history = read_history_args(request.args)
+    if type(history) is str:
+        return history, 400
+    patient = lookup_patient(patient_id, patient_db)
+    if patient is None:
+        return "Patient not found", 400
+    if history["format"] == "json":
+        return jsonify(history_json_page(patient, history))
+    return Response(iter_history_ndjson(patient, history),
+                    mimetype="application/x-ndjson")
 
 
 @app.route("/api/heart_rate/average/<patient_id>", methods=["GET"])
@@ -711,6 +1791,27 @@ def get_patient_avg_heart_rate(patient_id):
     return jsonify(get_patient_average_heart_rate(patient_id, patient_db))
 
 
+@app.route("/api/heart_rate/summary/<patient_id>", methods=["GET"])
+def get_patient_heart_rate_summary(patient_id):
+    """
+    This function returns the heart rate aggregates of a patient
+
+    This function is for a GET request and receives a patient_id
+    as part of a variable URL. The function returns a dictionary
+    containing the number of readings, the average, minimum and
+    maximum heart_rate, and the most recent heart_rate and timestamp
+    for the corresponding patient_id. These are kept up to date as
+    heart rates are added, so the history is not read.
+    :param patient_id: a number corresponding to a patient in patient_db
+    :return: a dictionary containing the heart rate aggregates, or an
+    error string and status code 400 if the patient is not found
+    """
+    summary = get_patient_summary(patient_id, patient_db)
+    if type(summary) is not dict:
+        return summary
+    return jsonify(summary)
+
+
 @app.route("/api/status/<patient_id>", methods=["GET"])
 def get_status(patient_id):
     """
@@ -720,12 +1821,17 @@ def get_status(patient_id):
     as part of a variable URL. The function returns a dictionary
     containing the most recent heart_rate, timestamp, and the
     status for the corresponding patient_id and sends it to a
-    client in a JSON format.
+    client in a JSON format. The response carries an ETag built from
+    the patient's version counter, and a request whose If-None-Match
+    header holds that ETag gets an empty 304 response instead.
     :param patient_id: a number corresponding to a patient in patient_db
     :return: a dictionary containing the most recent heart_rate,
     timestamp, and the status
     """
-    return jsonify(get_patient_status(patient_id))
+    etag = None
+    if isinstance(patient_db, PatientStore) and patient_id in patient_db:
+        etag = make_etag(patient_db.version(patient_id))
+    return conditional_json(etag, lambda: get_patient_status(patient_id))
 
 
 @app.route("/api/heart_rate/interval_average", methods=["POST"])
@@ -739,25 +1845,45 @@ def post_interval_average():
     first verifies that the keys and values are correct, and
     returns an error string if not. Then this function calls
     the function find_patient() which returns patient info for
-    the patient_id. The function then finds the average heart_rate
-    for all readings from the time specified by the input dictionary.
+    the patient_id. The function then finds the first reading at or
+    after the time specified by the input dictionary and takes the
+    average of the readings from there on out of the patient's running
+    heart rate sums, adding any minute or hour aggregates that start at
+    or after the time. If the patient is not found, or no reading is at
+    or after the time, an error string and status code 400 are returned.
     :return: a float giving the average heart_rate since the time specified
     """
     in_dict = request.get_json()
-    verify_input = verify_internal_average(in_dict)
-    if verify_input is not True:
-        return verify_input, 400
-    print(in_dict)
-    patient_id = in_dict["patient_id"]
-    print(patient_id)
-    time = in_dict["heart_rate_average_since"]
-    patient = find_patient(int(patient_id), patient_db)
-    index = find_first_time(time, patient["timestamp"])
-    answer = sum(patient["heart_rate"]
-                 [index:]) / len(patient["heart_rate"][index:])
+    average_info = INTERVAL_AVERAGE(in_dict)
+    if type(average_info) is str:
+        return average_info, 400
+    patient_id, time = average_info
+    patient = find_patient(patient_id, patient_db)
+    if type(patient) is not dict:
+        return patient
+    with patient_lock(patient["patient_id"]):
+        index = find_first_time(time, patient["timestamp"])
+        if type(index) is not int:
+            return index, 400
+        answer = patient["series"].average_since(to_epoch_ms(time))
     return jsonify(answer)
 
 
+@app.route("/api/alerts/stats", methods=["GET"])
+def get_alert_stats():
+    """
+    This function returns the state of the tachycardia alert queue
+
+    This function is for a GET request. Tachycardia emails are queued
+    and sent in the background, and this route returns a dictionary
+    with the number of emails waiting (queue_depth), the number
+    queued, sent, failed, retried and dropped because the queue was
+    full, and the average and most recent delivery latency in seconds.
+    :return: a dictionary of alert queue statistics
+    """
+    return jsonify(alert_dispatcher.stats())
+
+
 @app.route("/api/patients/<attending_username>", methods=["GET"])
 def get_patients_for_attending_username(attending_username):
     """
@@ -772,18 +1898,69 @@ def get_patients_for_attending_username(attending_username):
     the list of patient_id for the attending_username. For each
     patient_id, a dictionary is stored in a list that contains the
     patient_id, last_heart_rate, last_time, and status. This list
-    of patient dictionaries is then returned to the client.
+    of patient dictionaries is then returned to the client. As with
+    the status route, the response carries an ETag (from the
+    attendant's version counter) and a matching If-None-Match header
+    gets an empty 304 response.
     :param attending_username: the username used by a physician
     :return: a list containing dictionaries of patient information
     """
     verify_attendant = verify_attendant_exists(attending_username)
     if verify_attendant is not True:
         return verify_attendant, 400
-    patient_id_list = get_patient_id_list(attending_username)
-    return jsonify(patients_for_attending_username(patient_id_list))
+    etag = None
+    if isinstance(attendant_db, AttendantRegistry):
+        etag = make_etag(attendant_db.version(attending_username))
+    return conditional_json(etag, lambda: get_roster(attending_username))
+
+
+@app.route("/api/patients/<attending_username>/events", methods=["GET"])
+def get_patient_events(attending_username):
+    """
+    This function streams patient changes for a physician's dashboard
+
+    This function is for a GET request and receives an attending_username
+    as part of a variable URL. If the attending_username is not in the
+    database then a string is returned notifying the client. Otherwise
+    a Server-Sent Events stream is returned. The first event, "roster",
+    holds the same list as GET /api/patients/<attending_username>. After
+    that a "patient" event is pushed with the new patient_id,
+    last_heart_rate, last_time and status of a patient whenever one of
+    the physician's patients gets a heart rate, so dashboards do not
+    need to poll. If several updates for a patient arrive before they
+    are sent only the latest is sent. A comment line is sent every
+    EVENT_KEEPALIVE seconds when nothing changes to keep the connection
+    open.
+    :param attending_username: the username used by a physician
+    :return: a text/event-stream response of patient changes
+    """
+    verify_attendant = verify_attendant_exists(attending_username)
+    if verify_attendant is not True:
+        return verify_attendant, 400
+    subscription = patient_events.subscribe(attending_username)
+    roster = get_roster(attending_username)
+
+    def generate():
+        try:
+            yield b"event: roster\ndata: " + app.json.codec.dumps(roster) + \
+                b"\n\n"
+            while True:
+                rows = subscription.pop_all(EVENT_KEEPALIVE)
+                if not rows:
+                    yield b": keep-alive\n\n"
+                for row in rows:
+                    yield b"event: patient\ndata: " + \
+                        app.json.codec.dumps(row) + b"\n\n"
+        finally:
+            patient_events.unsubscribe(attending_username, subscription)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
 
 
 if __name__ == '__main__':
     logging.basicConfig(filename="code_status.log", filemode='w',
                         level=logging.DEBUG)
-    app.run()
+    open_from_environment(os.environ)
+    app.run(threaded=True)
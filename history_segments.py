@@ -0,0 +1,241 @@
+import itertools
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+SEGMENT_MAGIC = b"HRSEG001"
+SEGMENT_HEADER = struct.Struct("=8sQ")
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+class SegmentMaps:
+    '''Bounded set of the segments that are mapped
+
+    Every mapping holds a file descriptor, so at most limit segments stay
+    mapped and the others are mapped again when next read. Segments are
+    unmapped oldest mapped first, except that a segment read since it was
+    last considered gets a second chance (the clock approximation of least
+    recently used), so reads only set a flag and take no lock. Unmapping
+    only drops the segment's references to its mapping: readers still
+    holding one of its memoryviews keep it open until they let go.
+
+    :param limit: int number of segments kept mapped at most
+    '''
+
+    def __init__(self, limit=256):
+        self.limit = limit
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._segments)
+
+    def add(self, segment):
+        '''Tracks a segment that was just mapped, unmapping others beyond
+        the limit
+
+        :param segment: SealedSegment that is mapped
+        '''
+        with self._lock:
+            self._segments[segment] = None
+            while len(self._segments) > max(self.limit, 1):
+                oldest, _ = self._segments.popitem(last=False)
+                if oldest._used or oldest is segment:
+                    oldest._used = False
+                    self._segments[oldest] = None
+                else:
+                    oldest._columns = None
+
+    def forget(self, segment):
+        '''Stops tracking a segment
+
+        :param segment: SealedSegment
+        '''
+        with self._lock:
+            self._segments.pop(segment, None)
+
+
+segment_maps = SegmentMaps()
+
+
+class SealedSegment:
+    '''Read-only run of heart rates kept in a memory-mapped file
+
+    The file holds fixed-width columns: the heart rates as unsigned 16 bit
+    ints, the timestamps as signed 64 bit epoch milliseconds and the running
+    heart rate sum before each reading (count + 1 entries, starting with the
+    sum of every older reading of the series). rates, times and prefix are
+    memoryviews straight over the mapping, so reading them copies nothing
+    and the pages are only brought into memory when they are read; the
+    operating system can drop them again under memory pressure.
+
+    The file is mapped when a column is first read, and segment_maps
+    unmaps the least recently read segments, so the open file descriptors
+    stay bounded however many segments there are. The length and the first
+    and last timestamps are kept without the mapping.
+
+    :param path: str path of a segment file written by write
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._columns = None
+        self._discarded = False
+        self._used = False
+        rates, times, prefix = self._map()
+        self._count = len(rates)
+        self.first_time = times[0] if len(times) else None
+        self.last_time = times[-1] if len(times) else None
+        self.start = 0
+        self._columns = rates, times, prefix
+        segment_maps.add(self)
+
+    def _map(self):
+        with open(self.path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = SEGMENT_HEADER.unpack_from(mapping)
+        if magic != SEGMENT_MAGIC:
+            mapping.close()
+            raise ValueError("not a heart rate segment file")
+        view = memoryview(mapping)
+        offset = SEGMENT_HEADER.size
+        rates = view[offset:offset + 2 * count].cast('H')
+        offset += _padded(2 * count)
+        times = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        prefix = view[offset:offset + 8 * (count + 1)].cast('q')
+        return rates, times, prefix
+
+    def _mapped(self):
+        columns = self._columns
+        if columns is None:
+            columns = self._columns = self._map()
+            if not self._discarded:
+                segment_maps.add(self)
+        self._used = True
+        return columns
+
+    @property
+    def rates(self):
+        '''memoryview of the heart rates'''
+        return self._mapped()[0]
+
+    @property
+    def times(self):
+        '''memoryview of the epoch millisecond timestamps'''
+        return self._mapped()[1]
+
+    @property
+    def prefix(self):
+        '''memoryview of the running heart rate sums'''
+        return self._mapped()[2]
+
+    def __len__(self):
+        return self._count
+
+    @classmethod
+    def write(cls, path, rates, times, prefix):
+        '''Writes columns to a segment file and maps it
+
+        :param path: str path of the file to write
+        :param rates: array('H') of heart rates
+        :param times: array('q') of epoch milliseconds
+        :param prefix: array('q') of running sums, one longer than rates
+        :return: SealedSegment over the new file
+        '''
+        if len(rates) != len(times) or len(prefix) != len(rates) + 1:
+            raise ValueError("segment columns differ in length")
+        rate_bytes = rates.tobytes()
+        with open(path + ".tmp", "wb") as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(rates)))
+            f.write(rate_bytes)
+            f.write(bytes(_padded(len(rate_bytes)) - len(rate_bytes)))
+            f.write(times.tobytes())
+            f.write(prefix.tobytes())
+        os.replace(path + ".tmp", path)
+        return cls(path)
+
+    def discard(self):
+        '''Deletes the segment file but leaves it mapped
+
+        Readers that still hold the segment keep working, as the segment is
+        no longer unmapped by segment_maps; the mapping is released once
+        the last reference to the segment goes away.
+        '''
+        self._mapped()
+        self._discarded = True
+        segment_maps.forget(self)
+        os.remove(self.path)
+
+    def close(self, remove=False):
+        '''Unmaps the segment
+
+        Readers still holding one of its memoryviews keep the mapping open
+        until they let go.
+
+        :param remove: bool, True to also delete the file
+        '''
+        segment_maps.forget(self)
+        self._columns = None
+        if remove:
+            os.remove(self.path)
+
+
+class HistoryArchive:
+    '''Decides when patients' older heart rates are sealed into segments
+
+    Once more than segment_size + keep heart rates of a patient are held
+    in memory, all but the newest keep are written to a SealedSegment in
+    directory. The series keeps answering every read through the same
+    methods, reading the sealed part from the mapped files, so memory use
+    follows the recent readings rather than the whole history.
+
+    Segments are a cache of the in-memory data rather than a copy that
+    survives restarts (the storage engine does that), so any segment files
+    left in the directory by an earlier run are removed. For the same
+    reason a segment that cannot be written (a full disk, or no file
+    descriptors left) is logged and the heart rates simply stay in memory.
+
+    :param directory: str path of the directory for segment files
+    :param segment_size: int minimum number of heart rates in a segment
+    :param keep: int number of newest heart rates kept in memory
+    :param max_open: int number of segments kept mapped at most (see
+                     SegmentMaps), None to leave the limit as it is
+    '''
+
+    def __init__(self, directory, segment_size=65536, keep=4096,
+                 max_open=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.keep = keep
+        if max_open is not None:
+            segment_maps.limit = max_open
+        self._numbers = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".seg") or name.endswith(".seg.tmp"):
+                os.remove(os.path.join(directory, name))
+
+    def maybe_seal(self, patient_id, series):
+        '''Seals a series' older heart rates if enough are in memory
+
+        :param patient_id: int containing patient ID
+        :param series: HeartRateSeries of the patient
+        :return: SealedSegment written, None if nothing was sealed
+        '''
+        if series.resident < self.segment_size + self.keep:
+            return None
+        path = os.path.join(self.directory, "{}-{:012d}.seg".format(
+            patient_id, next(self._numbers)))
+        try:
+            return series.seal(path, series.resident - self.keep)
+        except OSError as e:
+            logging.warning("Could not seal heart rates of patient {}: "
+                            "{}".format(patient_id, e))
+            return None
@@ -0,0 +1,138 @@
+import json
+
+import numpy as np
+from flask import Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibCodec:
+    '''JSON codec on the standard library json module
+
+    The output matches Flask's jsonify: sorted keys and no spaces.
+    '''
+
+    name = "json"
+
+    def dumps(self, obj):
+        '''Serializes an object
+
+        :param obj: JSON serializable object
+        :return: bytes of JSON
+        '''
+        return json.dumps(obj, sort_keys=True,
+                          separators=(",", ":")).encode()
+
+    def loads(self, data):
+        '''Parses JSON
+
+        :param data: str or bytes of JSON
+        :return: the decoded object
+        :raises ValueError: if the data is not valid JSON
+        '''
+        return json.loads(data)
+
+    def int_items(self, column):
+        '''Serializes a run of fixed-width ints as JSON array items
+
+        :param column: array or memoryview of ints
+        :return: bytes of the comma separated ints, without brackets
+        '''
+        return ",".join(map(str, column)).encode()
+
+
+class OrjsonCodec(StdlibCodec):
+    '''JSON codec on orjson, used when it is installed
+
+    Runs of ints are handed to orjson as NumPy arrays over the same
+    memory, so they are written without making a Python int for each.
+    '''
+
+    name = "orjson"
+    OPTIONS = 0
+    if orjson is not None:
+        OPTIONS = (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS |
+                   orjson.OPT_SERIALIZE_NUMPY)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=self.OPTIONS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def int_items(self, column):
+        values = np.frombuffer(column, dtype=memoryview(column).format)
+        return orjson.dumps(values, option=self.OPTIONS)[1:-1]
+
+
+CODECS = {"json": StdlibCodec, "orjson": OrjsonCodec}
+
+
+def available_codecs():
+    '''Returns the names of the codecs that can be used here
+
+    :return: list of str codec names, fastest first
+    '''
+    names = ["json"]
+    if orjson is not None:
+        names.insert(0, "orjson")
+    return names
+
+
+def get_codec(name=None):
+    '''Makes a codec
+
+    :param name: str codec name, None for the fastest one installed
+    :return: codec object
+    :raises ValueError: if the codec is unknown or not installed
+    '''
+    if name is None:
+        name = available_codecs()[0]
+    if name not in available_codecs():
+        raise ValueError("JSON codec {} is not available".format(name))
+    return CODECS[name]()
+
+
+def iter_int_array(codec, chunks):
+    '''Writes runs of ints as one JSON array
+
+    :param codec: codec object
+    :param chunks: iterable of arrays or memoryviews of ints
+    :return: generator of bytes pieces of the array
+    '''
+    opening = b"["
+    for chunk in chunks:
+        if len(chunk):
+            yield opening + codec.int_items(chunk)
+            opening = b","
+    yield (b"[" if opening == b"[" else b"") + b"]"
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    '''Flask JSON provider that serializes with a pluggable codec
+
+    Installed as app.json, it makes jsonify and request.get_json use the
+    codec, so every route goes through it.
+
+    :param app: Flask app
+    :param codec: codec object, None for the fastest one installed
+    '''
+
+    def __init__(self, app, codec=None):
+        super().__init__(app)
+        self.codec = codec or get_codec()
+
+    def dumps(self, obj, **kwargs):
+        return self.codec.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return self.codec.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return Response(self.codec.dumps(obj) + b"\n",
+                        mimetype=self.mimetype)
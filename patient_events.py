@@ -0,0 +1,110 @@
+import threading
+
+
+class Subscription:
+    '''Pending events for one subscriber, coalesced by key
+
+    Only the latest event for each key is kept, so a subscriber that falls
+    behind (a slow dashboard) holds at most one pending event per patient
+    instead of an ever growing backlog.
+
+    Subscribers that cannot block in pop_all (such as asyncio handlers)
+    pass a notify function, which is called after each push and can wake
+    them up to call pop_all with a timeout of 0.
+
+    :param notify: function without arguments called after each push,
+                   None for no notification
+    '''
+
+    def __init__(self, notify=None):
+        self._pending = dict()
+        self._condition = threading.Condition()
+        self._notify = notify
+
+    def push(self, key, event):
+        '''Adds an event, replacing any pending event with the same key
+
+        :param key: hashable key, such as a patient ID
+        :param event: object describing the change
+        '''
+        with self._condition:
+            self._pending.pop(key, None)
+            self._pending[key] = event
+            self._condition.notify()
+        if self._notify is not None:
+            self._notify()
+
+    def pop_all(self, timeout=None):
+        '''Takes every pending event, waiting for one if there are none
+
+        :param timeout: float seconds to wait, None to wait forever
+        :return: list of events in the order their keys last changed,
+                 empty if the timeout ran out
+        '''
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            events = list(self._pending.values())
+            self._pending.clear()
+        return events
+
+
+class EventBroker:
+    '''Fans events for a topic out to every subscriber of that topic
+
+    The server uses attending usernames as topics and patient IDs as keys,
+    so each dashboard subscribed to an attendant receives the changed rows
+    of that attendant's patients.
+    '''
+
+    def __init__(self):
+        self._topics = dict()
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, notify=None):
+        '''Creates a subscription to a topic
+
+        :param topic: hashable topic, such as an attending username
+        :param notify: function called after each event, see Subscription
+        :return: Subscription receiving the topic's events
+        '''
+        subscription = Subscription(notify)
+        with self._lock:
+            self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, topic, subscription):
+        '''Removes a subscription from a topic
+
+        :param topic: hashable topic the subscription was made to
+        :param subscription: Subscription returned by subscribe
+        '''
+        with self._lock:
+            subscriptions = self._topics.get(topic)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._topics[topic]
+
+    def subscriber_count(self, topic):
+        '''Returns the number of subscriptions to a topic
+
+        :param topic: hashable topic
+        :return: int number of subscriptions
+        '''
+        return len(self._topics.get(topic, ()))
+
+    def publish(self, topic, key, event):
+        '''Sends an event to every subscriber of a topic
+
+        :param topic: hashable topic
+        :param key: hashable key used to coalesce pending events
+        :param event: object describing the change
+        :return: int number of subscriptions the event was sent to
+        '''
+        with self._lock:
+            subscriptions = list(self._topics.get(topic, ()))
+        for subscription in subscriptions:
+            subscription.push(key, event)
+        return len(subscriptions)
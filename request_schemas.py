@@ -0,0 +1,82 @@
+MISSING_KEY = "{} key not found in input"
+WRONG_TYPE = "{} value is not the correct type"
+NOT_A_DICTIONARY = "input is not a dictionary"
+
+
+def _digits_to_int(value):
+    '''Converts a string of ASCII decimal digits to an int
+
+    :param value: value of an int field that is not an int
+    :return: int, or None if the value is not a string of digits
+    '''
+    if type(value) is str and value.isdigit() and value.isascii():
+        return int(value)
+    return None
+
+
+_COERCIONS = {int: _digits_to_int, str: None}
+
+
+def compile_schema(fields, name="validate"):
+    '''Compiles a request schema into a validate-and-coerce function
+
+    A schema is a sequence of (key, type) pairs. An int field takes an int
+    or a string of decimal digits, which is converted to an int; a str
+    field takes a string. Each field is turned once into a tuple of its
+    key, type, conversion and error messages, and the returned function
+    closes over those tuples, so each request is checked and converted in
+    a single pass over its fields without building anything per field.
+    Fields are checked in order and the first problem is reported with
+    the same messages the verify functions always used.
+
+    :param fields: sequence of (str key, int or str type) pairs
+    :param name: str name of the returned function
+    :return: function taking the decoded request body and returning a list
+             of the field values, converted, in schema order, or a str
+             describing the first problem
+    '''
+    checks = list()
+    for key, kind in fields:
+        if kind not in _COERCIONS:
+            raise ValueError("fields must be int or str, not " + str(kind))
+        checks.append((key, kind, _COERCIONS[kind], MISSING_KEY.format(key),
+                       WRONG_TYPE.format(key)))
+    checks = tuple(checks)
+
+    def validate(in_dict):
+        if type(in_dict) is not dict:
+            return NOT_A_DICTIONARY
+        values = list()
+        for key, kind, coerce, missing, wrong in checks:
+            try:
+                value = in_dict[key]
+            except KeyError:
+                return missing
+            if type(value) is not kind:
+                if coerce is None:
+                    return wrong
+                value = coerce(value)
+                if value is None:
+                    return wrong
+            values.append(value)
+        return values
+
+    validate.__name__ = validate.__qualname__ = name
+    validate.fields = tuple(fields)
+    return validate
+
+
+NEW_ATTENDING = compile_schema((("attending_username", str),
+                                ("attending_email", str),
+                                ("attending_phone", str)),
+                               "validate_new_attending")
+NEW_PATIENT = compile_schema((("patient_id", int),
+                              ("attending_username", str),
+                              ("patient_age", int)),
+                             "validate_new_patient")
+HEART_RATE = compile_schema((("patient_id", int),
+                             ("heart_rate", int)),
+                            "validate_heart_rate")
+INTERVAL_AVERAGE = compile_schema((("patient_id", int),
+                                   ("heart_rate_average_since", str)),
+                                  "validate_interval_average")
@@ -0,0 +1,555 @@
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import zlib
+from array import array
+from contextlib import nullcontext
+
+from heart_rate_series import HeartRateSeries
+from heart_rate_rollups import Rollups
+
+FSYNC_POLICIES = ("always", "interval", "none")
+
+RECORD_HEADER = struct.Struct("<BI")
+RECORD_CRC = struct.Struct("<I")
+READINGS_HEADER = struct.Struct("<qQI")
+SNAPSHOT_MAGIC = b"HRSNAP01"
+SNAPSHOT_HEADER = struct.Struct("<QQ")
+
+ATTENDANT = 1
+PATIENT = 2
+READINGS = 3
+
+WAL_NAME = re.compile(r"^wal-(\d{8})\.log$")
+SNAPSHOT_NAME = re.compile(r"^snapshot-(\d{8})\.bin$")
+
+
+def encode_record(kind, payload):
+    '''Frames a log record as type, length, payload and CRC32
+
+    :param kind: int record type (ATTENDANT, PATIENT or READINGS)
+    :param payload: bytes of the record body
+    :return: bytes of the framed record
+    '''
+    header = RECORD_HEADER.pack(kind, len(payload))
+    crc = zlib.crc32(payload, zlib.crc32(header))
+    return header + payload + RECORD_CRC.pack(crc)
+
+
+def decode_records(data):
+    '''Reads framed log records from the start of a buffer
+
+    Reading stops at the first record that is cut short or fails its CRC,
+    which is where a crash in the middle of a write leaves the log.
+
+    :param data: bytes of a log file
+    :return: list of (kind, payload) tuples and the int offset just past
+             the last good record
+    '''
+    records = list()
+    offset = 0
+    view = memoryview(data)
+    while offset + RECORD_HEADER.size <= len(data):
+        kind, length = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end + RECORD_CRC.size > len(data):
+            break
+        payload = view[offset + RECORD_HEADER.size:end]
+        crc = zlib.crc32(payload, zlib.crc32(view[offset:offset +
+                                                  RECORD_HEADER.size]))
+        if crc != RECORD_CRC.unpack_from(data, end)[0]:
+            break
+        records.append((kind, bytes(payload)))
+        offset = end + RECORD_CRC.size
+    return records, offset
+
+
+def encode_readings(patient_id, first_seq, rates, times):
+    '''Builds the payload of a READINGS record
+
+    :param patient_id: int containing patient ID
+    :param first_seq: int sequence number of the first reading
+    :param rates: array('H') of heart rates
+    :param times: array('q') of epoch milliseconds
+    :return: bytes payload
+    '''
+    return READINGS_HEADER.pack(patient_id, first_seq, len(rates)) + \
+        rates.tobytes() + times.tobytes()
+
+
+def decode_readings(payload):
+    '''Reads the payload of a READINGS record
+
+    :param payload: bytes payload made by encode_readings
+    :return: tuple of patient ID, first sequence number, array('H') of
+             heart rates and array('q') of epoch milliseconds
+    '''
+    patient_id, first_seq, count = READINGS_HEADER.unpack_from(payload)
+    rates = array('H')
+    times = array('q')
+    start = READINGS_HEADER.size
+    rates.frombytes(payload[start:start + 2 * count])
+    times.frombytes(payload[start + 2 * count:start + 10 * count])
+    return patient_id, first_seq, rates, times
+
+
+class StorageEngine:
+    '''Append-only write-ahead log with snapshots for the patient databases
+
+    Every new attendant, new patient and batch of heart rates is appended
+    to a binary write-ahead log (wal-NNNNNNNN.log) as a framed, CRC checked
+    record. Records are collected in memory and written by a single
+    flusher thread, so concurrent requests share one write and one fsync
+    (group commit). The fsync policy decides what a logging call waits
+    for:
+
+    * "always": the call returns once its record has been fsynced.
+    * "interval": the call returns at once; the flusher writes and fsyncs
+      every commit_interval seconds, so at most that much is lost in a
+      power failure.
+    * "none": like "interval" but never fsyncs, leaving it to the OS.
+
+    If writing the log fails, the flusher stops and every logging call
+    that is waiting, or made later, raises OSError instead of hanging.
+
+    After snapshot_every records a snapshot is written in the background:
+    the log is switched to a new file, the databases are written to
+    snapshot-NNNNNNNN.bin (heart rates and timestamps as raw columns), and
+    the older log files and snapshots are deleted once the new snapshot
+    has been read back and checked. recover loads the newest snapshot and
+    replays only the log written after it. When snapshot_lock_for is set,
+    each patient is copied into the snapshot while holding the lock it
+    returns for the patient ID, so a snapshot taken while heart rates are
+    being added still has matching columns.
+
+    Each heart rate record carries the patient's reading sequence number
+    (HeartRateSeries.appended), so a reading that reaches both a snapshot
+    and the log after it is only applied once.
+
+    :param directory: str path of the directory holding the files
+    :param fsync: str fsync policy, one of FSYNC_POLICIES
+    :param commit_interval: float seconds between flushes for "interval"
+                            and "none"
+    :param snapshot_every: int number of records between snapshots, 0 to
+                           only snapshot when snapshot is called
+    '''
+
+    def __init__(self, directory, fsync="interval", commit_interval=0.05,
+                 snapshot_every=100000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of " +
+                             ", ".join(FSYNC_POLICIES))
+        self.directory = directory
+        self.fsync = fsync
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+        self.snapshot_source = None
+        self.snapshot_lock_for = None
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._error = None
+        self._buffer = bytearray()
+        self._written = 0
+        self._durable = 0
+        self._since_snapshot = 0
+        self._wal = None
+        self._wal_seq = 0
+        self._closing = False
+        self._flusher = None
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _files(self, pattern):
+        found = list()
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), name))
+        return sorted(found)
+
+    def recover(self, apply):
+        '''Loads the newest snapshot and replays the log written after it
+
+        apply is called for every stored event, oldest first:
+
+        * apply("attendant", (username, email, phone))
+        * apply("patient", (patient_id, username, age, status, series)),
+          where series is a HeartRateSeries from a snapshot or None for a
+          patient from the log
+        * apply("readings", (patient_id, first_seq, rates, times))
+
+        After recovery a new log file is started, ready for new records.
+
+        :param apply: function taking an event kind and a tuple of values
+        '''
+        start_seq = 0
+        snapshots = self._files(SNAPSHOT_NAME)
+        while snapshots:
+            seq, name = snapshots.pop()
+            try:
+                start_seq = read_snapshot(self._path(name), apply)
+                break
+            except ValueError:
+                continue
+        for seq, name in self._files(WAL_NAME):
+            if seq < start_seq:
+                os.remove(self._path(name))
+                continue
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+            records, good = decode_records(data)
+            for kind, payload in records:
+                self._replay(kind, payload, apply)
+            if good < len(data):
+                with open(self._path(name), "r+b") as f:
+                    f.truncate(good)
+        for seq, name in self._files(SNAPSHOT_NAME):
+            if seq < start_seq:
+                os.remove(self._path(name))
+        wal_files = self._files(WAL_NAME)
+        next_seq = wal_files[-1][0] + 1 if wal_files else start_seq
+        self._open_wal(max(next_seq, start_seq))
+        self._start()
+
+    def _replay(self, kind, payload, apply):
+        if kind == ATTENDANT:
+            apply("attendant", tuple(json.loads(payload.decode("utf-8"))))
+        elif kind == PATIENT:
+            patient_id, username, age = json.loads(payload.decode("utf-8"))
+            apply("patient", (patient_id, username, age, None, None))
+        elif kind == READINGS:
+            apply("readings", decode_readings(payload))
+
+    def _open_wal(self, seq):
+        self._wal_seq = seq
+        self._wal = open(self._path("wal-{:08d}.log".format(seq)), "ab")
+
+    def _start(self):
+        if self._flusher is None:
+            self._closing = False
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             daemon=True,
+                                             name="storage-flusher")
+            self._flusher.start()
+
+    def log_attendant(self, username, email, phone):
+        '''Logs a new attendant
+
+        :param username: str containing attendant username
+        :param email: str containing attendant email
+        :param phone: str containing attendant phone number
+        '''
+        payload = json.dumps([username, email, phone]).encode("utf-8")
+        self._append(encode_record(ATTENDANT, payload))
+
+    def log_patient(self, patient_id, username, age):
+        '''Logs a new patient
+
+        :param patient_id: int containing patient ID
+        :param username: str containing the patient's attendant username
+        :param age: int containing patient age
+        '''
+        payload = json.dumps([patient_id, username, age]).encode("utf-8")
+        self._append(encode_record(PATIENT, payload))
+
+    def log_readings(self, patient_id, first_seq, rates, times):
+        '''Logs one or more heart rates of a patient
+
+        :param patient_id: int containing patient ID
+        :param first_seq: int sequence number of the first heart rate
+        :param rates: list or array of ints containing heart rates
+        :param times: list or array of ints containing epoch milliseconds
+        '''
+        payload = encode_readings(patient_id, first_seq, array('H', rates),
+                                  array('q', times))
+        self._append(encode_record(READINGS, payload))
+
+    def _append(self, record):
+        with self._condition:
+            if self._wal is None:
+                raise ValueError("storage engine is not open")
+            self._check_error()
+            self._buffer += record
+            self._written += 1
+            self._since_snapshot += 1
+            position = self._written
+            self._condition.notify_all()
+            if self.fsync == "always":
+                self._wait_durable(position)
+        if self.snapshot_every and self._since_snapshot >= \
+                self.snapshot_every:
+            self._snapshot_in_background()
+
+    def flush(self):
+        '''Waits until every logged record has been written (and fsynced,
+        unless the policy is "none")'''
+        with self._condition:
+            position = self._written
+            self._condition.notify_all()
+            self._wait_durable(position)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise OSError("write-ahead log failed: {}".format(self._error))
+
+    def _wait_durable(self, position):
+        # Called holding self._condition
+        while self._durable < position and self._wal is not None and \
+                self._error is None:
+            self._condition.wait()
+        if self._durable < position:
+            self._check_error()
+
+    def _write_buffer(self):
+        # Writes the buffered records to the current log file. Callers hold
+        # self._write_lock from taking the records until they are written,
+        # so _rotate never closes a file with a batch still going to it.
+        with self._condition:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            position = self._written
+            wal = self._wal
+        try:
+            if data:
+                wal.write(data)
+                wal.flush()
+                if self.fsync != "none":
+                    os.fsync(wal.fileno())
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._durable = position
+            self._condition.notify_all()
+        return bool(data)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while not self._buffer and not self._closing:
+                    self._condition.wait()
+                if self.fsync != "always" and not self._closing:
+                    self._condition.wait(self.commit_interval)
+                closing = self._closing
+            try:
+                with self._write_lock:
+                    written = self._write_buffer()
+            except Exception as e:
+                logging.error("Write-ahead log flush failed: {}".format(e))
+                return
+            if closing and not written:
+                return
+
+    def _rotate(self):
+        with self._write_lock:
+            self._write_buffer()
+            with self._condition:
+                old = self._wal
+                self._open_wal(self._wal_seq + 1)
+                self._since_snapshot = 0
+                seq = self._wal_seq
+            old.close()
+            return seq
+
+    def _snapshot_in_background(self):
+        with self._condition:
+            if self._snapshot_thread is not None and \
+                    self._snapshot_thread.is_alive():
+                return
+            if self.snapshot_source is None:
+                return
+            self._snapshot_thread = threading.Thread(target=self.snapshot,
+                                                     daemon=True,
+                                                     name="storage-snapshot")
+            self._snapshot_thread.start()
+
+    def snapshot(self, attendants=None, patients=None):
+        '''Writes a snapshot of the databases and drops the older log
+
+        The log is first switched to a new file, so the snapshot covers
+        everything in the older files, which are deleted once the snapshot
+        is safely on disk and reads back cleanly.
+
+        :param attendants: list of attendant dictionaries, defaults to
+                           those from snapshot_source
+        :param patients: list of patient dictionaries, defaults to those
+                         from snapshot_source
+        :return: str path of the snapshot file
+        :raises ValueError: if the snapshot does not read back, in which
+                            case it is removed and the older files kept
+        '''
+        with self._snapshot_lock:
+            if attendants is None or patients is None:
+                attendants, patients = self.snapshot_source()
+            seq = self._rotate()
+            path = self._path("snapshot-{:08d}.bin".format(seq))
+            write_snapshot(path + ".tmp", seq, attendants, patients,
+                           self.snapshot_lock_for)
+            try:
+                load_snapshot(path + ".tmp")
+            except ValueError:
+                os.remove(path + ".tmp")
+                raise
+            os.replace(path + ".tmp", path)
+            self._sync_directory()
+            for old_seq, name in self._files(WAL_NAME):
+                if old_seq < seq:
+                    os.remove(self._path(name))
+            for old_seq, name in self._files(SNAPSHOT_NAME):
+                if old_seq < seq:
+                    os.remove(self._path(name))
+            return path
+
+    def _sync_directory(self):
+        if self.fsync == "none" or not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        '''Flushes the log and stops the background threads'''
+        thread = self._snapshot_thread
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            if self._wal is None:
+                return
+            self._closing = True
+            self._condition.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        with self._condition:
+            self._wal.close()
+            self._wal = None
+            self._condition.notify_all()
+
+
+def write_snapshot(path, wal_seq, attendants, patients, lock_for=None):
+    '''Writes the databases to a snapshot file
+
+    The file holds a magic string, the number of the first log file that is
+    not covered, a JSON header describing the attendants and patients
+    (including any heart rate rollups), and then each patient's heart rate
+    and timestamp columns as raw bytes, ending with a CRC32 of everything
+    before it.
+
+    :param path: str path of the file to write
+    :param wal_seq: int number of the first log file written after the
+                    snapshot
+    :param attendants: list of attendant dictionaries
+    :param patients: list of patient dictionaries with a "series"
+    :param lock_for: function returning the lock to hold while copying a
+                     patient, given the patient ID, None to take no lock
+    '''
+    columns = list()
+    header = {"attendants": [[a["attending_username"], a["attending_email"],
+                              a["attending_phone"]]
+                             for a in list(attendants)],
+              "patients": list()}
+    for patient in list(patients):
+        lock = nullcontext()
+        if lock_for is not None:
+            lock = lock_for(patient["patient_id"])
+        with lock:
+            series = patient["series"]
+            rates, times, appended = series.columns()
+            status = patient["status"]
+            rollups = None
+            if series.rollups is not None:
+                rollups = series.rollups.to_dict()
+        columns.append((rates, times))
+        header["patients"].append([patient["patient_id"],
+                                   patient["attending_username"],
+                                   patient["patient_age"], status,
+                                   len(rates), appended, rollups])
+    header = json.dumps(header).encode("utf-8")
+    crc = 0
+    with open(path, "wb") as f:
+        for chunk in [SNAPSHOT_MAGIC,
+                      SNAPSHOT_HEADER.pack(wal_seq, len(header)), header]:
+            f.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+        for rates, times in columns:
+            for chunk in (rates.tobytes(), times.tobytes()):
+                f.write(chunk)
+                crc = zlib.crc32(chunk, crc)
+        f.write(RECORD_CRC.pack(crc))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_snapshot(path):
+    '''Reads and checks a whole snapshot file
+
+    :param path: str path of the snapshot file
+    :return: int number of the first log file not covered by the snapshot
+             and list of (kind, values) events, as passed to apply by
+             StorageEngine.recover
+    :raises ValueError: if the file is not a snapshot, is damaged or does
+                        not decode
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(SNAPSHOT_MAGIC) or len(data) < \
+            len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size + RECORD_CRC.size:
+        raise ValueError("not a snapshot file")
+    body = memoryview(data)[:-RECORD_CRC.size]
+    if zlib.crc32(body) != RECORD_CRC.unpack_from(data, len(body))[0]:
+        raise ValueError("snapshot file is damaged")
+    offset = len(SNAPSHOT_MAGIC)
+    wal_seq, header_length = SNAPSHOT_HEADER.unpack_from(data, offset)
+    offset += SNAPSHOT_HEADER.size
+    header = json.loads(bytes(body[offset:offset + header_length]))
+    offset += header_length
+    events = [("attendant", tuple(attendant))
+              for attendant in header["attendants"]]
+    for patient_id, username, age, status, count, appended, rollups in \
+            header["patients"]:
+        rates = array('H')
+        times = array('q')
+        rates.frombytes(body[offset:offset + 2 * count])
+        offset += 2 * count
+        times.frombytes(body[offset:offset + 8 * count])
+        offset += 8 * count
+        if len(rates) != count or len(times) != count:
+            raise ValueError("snapshot file is cut short")
+        series = HeartRateSeries.from_columns(rates, times, appended)
+        if rollups is not None:
+            series.attach_rollups(Rollups.from_dict(rollups))
+        events.append(("patient", (patient_id, username, age, status,
+                                   series)))
+    if offset != len(body):
+        raise ValueError("snapshot file has trailing bytes")
+    return wal_seq, events
+
+
+def read_snapshot(path, apply):
+    '''Reads a snapshot file, passing its contents to apply
+
+    The whole file is decoded and checked before apply is first called,
+    so a bad snapshot leaves the databases untouched.
+
+    :param path: str path of the snapshot file
+    :param apply: function taking an event kind and a tuple of values, as
+                  for StorageEngine.recover
+    :return: int number of the first log file not covered by the snapshot
+    :raises ValueError: if the file is not a snapshot, is damaged or does
+                        not decode
+    '''
+    wal_seq, events = load_snapshot(path)
+    for kind, values in events:
+        apply(kind, values)
+    return wal_seq
@@ -0,0 +1,95 @@
+import numpy as np
+
+# (first age in years, highest heart rate that is not tachycardic), from
+# https://en.wikipedia.org/wiki/Tachycardia. Ages are whole years, so a
+# band starts at the first age it covers and runs up to the next band. Age
+# 0 covers every infant band of the article and uses the lowest of them.
+TACHYCARDIA_BANDS = ((0, 159), (1, 151), (3, 137), (5, 133), (8, 130),
+                     (12, 119), (16, 100))
+
+
+def parse_bands(text):
+    '''Reads age bands written as "age:limit,age:limit,..."
+
+    :param text: str such as "0:159,1:151,16:100"
+    :return: tuple of (int age, int limit) pairs
+    :raises ValueError: if the text is not in that format
+    '''
+    bands = list()
+    for band in text.split(","):
+        age, limit = band.split(":")
+        bands.append((int(age), int(limit)))
+    return tuple(bands)
+
+
+class TachycardiaTable:
+    '''Age-indexed heart rate limits for classifying tachycardia
+
+    The bands are compiled into an array holding the highest heart rate
+    that is not tachycardic for every age from 0 up to the start of the
+    last band, so classifying a reading is one index and one comparison.
+    Ages past the end of the array use the last band and negative ages
+    use the first.
+
+    :param bands: sequence of (first age, limit) pairs sorted by age, the
+                  first starting at age 0
+    :raises ValueError: if the bands are not sorted or do not start at 0
+    '''
+
+    def __init__(self, bands=TACHYCARDIA_BANDS):
+        bands = [(int(age), int(limit)) for age, limit in bands]
+        if not bands or bands[0][0] != 0:
+            raise ValueError("the first band must start at age 0")
+        if any(a >= b for (a, _), (b, _) in zip(bands, bands[1:])):
+            raise ValueError("bands must be sorted by age")
+        self.bands = tuple(bands)
+        self.limits = np.empty(bands[-1][0] + 1, dtype=np.int64)
+        ends = [age for age, _ in bands[1:]] + [len(self.limits)]
+        for (age, limit), end in zip(bands, ends):
+            self.limits[age:end] = limit
+
+    def limit(self, age):
+        '''Returns the highest heart rate that is not tachycardic at an age
+
+        :param age: int age in years
+        :return: int heart rate
+        '''
+        return int(self.limits[min(max(age, 0), len(self.limits) - 1)])
+
+    def is_tachycardic(self, age, hr):
+        '''Classifies one heart rate
+
+        :param age: int age in years
+        :param hr: int heart rate
+        :return: True if tachycardic and False if not tachycardic
+        '''
+        return hr > self.limit(age)
+
+    def classify_batch(self, ages, heart_rates):
+        '''Classifies many heart rates at once
+
+        :param ages: int or array-like of int ages, broadcast against
+                     heart_rates
+        :param heart_rates: array-like of int heart rates
+        :return: numpy bool array, True for each tachycardic heart rate
+        '''
+        ages = np.clip(np.asarray(ages, dtype=np.int64), 0,
+                       len(self.limits) - 1)
+        return np.asarray(heart_rates) > self.limits[ages]
+
+
+default_table = TachycardiaTable()
+
+
+def classify_batch(ages, heart_rates, table=None):
+    '''Classifies many heart rates at once with a TachycardiaTable
+
+    :param ages: int or array-like of int ages, broadcast against
+                 heart_rates
+    :param heart_rates: array-like of int heart rates
+    :param table: TachycardiaTable, None for the default bands
+    :return: numpy bool array, True for each tachycardic heart rate
+    '''
+    if table is None:
+        table = default_table
+    return table.classify_batch(ages, heart_rates)
@@ -0,0 +1,179 @@
+import pytest
+
+
+def make_dispatcher(deliver, **kwargs):
+    from alert_dispatcher import AlertDispatcher
+    kwargs.setdefault("backoff", 0)
+    return AlertDispatcher(deliver, **kwargs)
+
+
+@pytest.mark.parametrize("results, retries, expected",
+                         [([True], 3, {"sent": 1, "failed": 0,
+                                       "retried": 0}),
+                          ([False], 3, {"sent": 0, "failed": 1,
+                                        "retried": 0}),
+                          ([IOError, True], 3, {"sent": 1, "failed": 0,
+                                                "retried": 1}),
+                          ([IOError, IOError, IOError], 2,
+                           {"sent": 0, "failed": 1, "retried": 2})])
+def test_dispatcher_delivery(results, retries, expected):
+    results = list(results)
+    delivered = list()
+
+    def deliver(alert):
+        result = results.pop(0)
+        if result is IOError:
+            raise IOError("email server down")
+        delivered.append(alert)
+        return result
+
+    dispatcher = make_dispatcher(deliver, retries=retries)
+    assert dispatcher.enqueue("alert") is True
+    dispatcher.join()
+    dispatcher.stop()
+    stats = dispatcher.stats()
+    for key, value in expected.items():
+        assert stats[key] == value
+    assert stats["queued"] == 1
+    assert stats["queue_depth"] == 0
+    assert (stats["last_latency"] is not None) == bool(expected["sent"])
+
+
+def test_dispatcher_drops_when_full():
+    import threading
+    release = threading.Event()
+
+    def deliver(alert):
+        release.wait()
+        return True
+
+    dispatcher = make_dispatcher(deliver, maxsize=1, workers=1)
+    assert dispatcher.enqueue(1) is True
+    # wait for the worker to take the first alert off the queue
+    while dispatcher.stats()["queue_depth"]:
+        pass
+    assert dispatcher.enqueue(2) is True
+    assert dispatcher.enqueue(3) is False
+    release.set()
+    dispatcher.join()
+    dispatcher.stop()
+    stats = dispatcher.stats()
+    assert stats["sent"] == 2
+    assert stats["dropped"] == 1
+
+
+def test_dispatcher_does_not_block_caller():
+    import threading
+    import time
+    release = threading.Event()
+    dispatcher = make_dispatcher(lambda alert: release.wait(5))
+    start = time.monotonic()
+    dispatcher.enqueue("alert")
+    assert time.monotonic() - start < 1
+    release.set()
+    dispatcher.join()
+    dispatcher.stop()
+    assert dispatcher.stats()["sent"] == 1
+
+
+def test_dispatcher_stop_cuts_backoff_short():
+    import threading
+    import time
+    attempted = threading.Event()
+
+    def deliver(alert):
+        attempted.set()
+        raise IOError("email server down")
+
+    dispatcher = make_dispatcher(deliver, workers=1, backoff=60)
+    dispatcher.enqueue("alert")
+    assert attempted.wait(5)
+    threads = list(dispatcher._threads)
+    start = time.monotonic()
+    dispatcher.stop(timeout=5)
+    assert time.monotonic() - start < 1
+    assert not any(thread.is_alive() for thread in threads)
+    stats = dispatcher.stats()
+    assert stats["failed"] == 1
+    assert stats["retried"] == 0
+
+
+@pytest.mark.parametrize("results, retries, expected",
+                         [([True], 3, {"sent": 1, "failed": 0,
+                                       "retried": 0}),
+                          ([False], 3, {"sent": 0, "failed": 1,
+                                        "retried": 0}),
+                          ([IOError, True], 3, {"sent": 1, "failed": 0,
+                                                "retried": 1}),
+                          ([IOError, IOError, IOError], 2,
+                           {"sent": 0, "failed": 1, "retried": 2})])
+def test_async_dispatcher_delivery(results, retries, expected):
+    import asyncio
+    from alert_dispatcher import AsyncAlertDispatcher
+    results = list(results)
+
+    async def deliver(alert):
+        await asyncio.sleep(0)
+        result = results.pop(0)
+        if result is IOError:
+            raise IOError("email server down")
+        return result
+
+    async def run():
+        dispatcher = AsyncAlertDispatcher(deliver, retries=retries,
+                                          backoff=0)
+        assert dispatcher.enqueue("alert") is True
+        await dispatcher.join()
+        await dispatcher.stop()
+        return dispatcher.stats()
+
+    stats = asyncio.run(run())
+    for key, value in expected.items():
+        assert stats[key] == value
+    assert stats["queued"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_async_dispatcher_drops_when_full():
+    import asyncio
+    from alert_dispatcher import AsyncAlertDispatcher
+
+    async def deliver(alert):
+        return True
+
+    async def run():
+        dispatcher = AsyncAlertDispatcher(deliver, maxsize=1, workers=1)
+        assert dispatcher.enqueue(1) is True
+        assert dispatcher.enqueue(2) is False
+        await dispatcher.stop()
+        return dispatcher.stats()
+
+    stats = asyncio.run(run())
+    assert stats["sent"] == 1
+    assert stats["dropped"] == 1
+
+
+def test_async_dispatcher_takes_alerts_from_other_threads():
+    import asyncio
+    from alert_dispatcher import AsyncAlertDispatcher
+    delivered = list()
+
+    async def deliver(alert):
+        delivered.append(alert)
+        return True
+
+    async def run():
+        dispatcher = AsyncAlertDispatcher(deliver)
+        dispatcher.start()
+        loop = asyncio.get_running_loop()
+        queued = await loop.run_in_executor(None, dispatcher.enqueue,
+                                            "alert")
+        await asyncio.sleep(0)
+        await dispatcher.join()
+        await dispatcher.stop()
+        return queued, dispatcher.stats()
+
+    queued, stats = asyncio.run(run())
+    assert queued is True
+    assert delivered == ["alert"]
+    assert stats["queued"] == stats["sent"] == 1
@@ -0,0 +1,67 @@
+import pytest
+
+
+def test_pack_and_decode_records():
+    from binary_ingest import RECORD, decode_records, pack_records
+    readings = [(1, 70, 1520593236000), (4294967295, 65535, 0),
+                (2, 0, -1)]
+    data = pack_records(readings)
+    assert len(data) == 3 * RECORD.size == 48
+    patient_ids, heart_rates, timestamps = decode_records(data)
+    assert list(zip(patient_ids.tolist(), heart_rates.tolist(),
+                    timestamps.tolist())) == readings
+    assert list(RECORD.iter_unpack(data)) == readings
+
+
+def test_decode_records_does_not_copy():
+    from binary_ingest import decode_records, pack_records
+    data = bytearray(pack_records([(1, 70, 5)]))
+    heart_rates = decode_records(data)[1]
+    data[4] = 71
+    assert heart_rates.tolist() == [71]
+
+
+@pytest.mark.parametrize("data", [b"x", b"\0" * 17, b"\0" * 31])
+def test_decode_records_rejects_partial_record(data):
+    from binary_ingest import decode_records
+    with pytest.raises(ValueError):
+        decode_records(data)
+
+
+@pytest.mark.parametrize("patient_ids, timestamps, expected",
+                         [([], [], []),
+                          ([3, 1, 3, 1], [5, 6, 1, 2],
+                           [(1, [3, 1]), (3, [2, 0])]),
+                          ([7, 7], [2, 2], [(7, [0, 1])])])
+def test_group_by_patient(patient_ids, timestamps, expected):
+    import numpy as np
+    from binary_ingest import group_by_patient
+    answer = [(patient_id, indexes.tolist()) for patient_id, indexes
+              in group_by_patient(np.array(patient_ids, dtype=np.uint32),
+                                  np.array(timestamps, dtype=np.int64))]
+    assert answer == expected
+
+
+@pytest.mark.parametrize("tail, expected_rejected", [(b"", 0),
+                                                     (b"\1\2\3", 1)])
+def test_binary_ingest_server(tail, expected_rejected):
+    import threading
+    from binary_ingest import (BinaryIngestServer, pack_records,
+                               decode_records, send_records)
+    received = list()
+
+    def ingest(data):
+        received.extend(decode_records(data)[1].tolist())
+        return {"stored": len(data) // 16, "rejected": 0}
+
+    server = BinaryIngestServer(("127.0.0.1", 0), ingest, buffer_records=3)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        data = pack_records([(1, rate, 0) for rate in range(10)])
+        answer = send_records("127.0.0.1", server.server_address[1],
+                              data + tail)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert answer == (10, expected_rejected)
+    assert received == list(range(10))
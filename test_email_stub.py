@@ -0,0 +1,59 @@
+import pytest
+
+EMAIL = {"from_email": "hrss@duke.edu", "to_email": "sim.0@example.com",
+         "subject": "Tachycardia", "content": "Heart rate of 180"}
+
+
+async def post_emails(emails, **options):
+    from aiohttp.test_utils import TestClient, TestServer
+    from email_stub import EMAIL_PATH, create_stub_app
+    answers = list()
+    async with TestClient(TestServer(create_stub_app(**options))) as client:
+        for email in emails:
+            r = await client.post(EMAIL_PATH, json=email)
+            answers.append((r.status, await r.text()))
+        r = await client.get("/hrss/stats")
+        stats = await r.json()
+    return answers, stats
+
+
+@pytest.mark.parametrize("email, fail_rate, expected", [
+    (EMAIL, 0.0, (200, "Email sent to sim.0@example.com")),
+    ({"to_email": "sim.0@example.com"}, 0.0, (400, "Email is missing a key")),
+    (EMAIL, 1.0, (503, "Email server busy")),
+])
+def test_email_stub_answers(email, fail_rate, expected):
+    import asyncio
+    answers, stats = asyncio.run(post_emails([email], fail_rate=fail_rate))
+    assert answers == [expected]
+    assert stats["received"] + stats["rejected"] + stats["failed"] == 1
+
+
+def test_email_stub_counts_by_recipient():
+    import asyncio
+    other = dict(EMAIL, to_email="sim.1@example.com")
+    answers, stats = asyncio.run(post_emails([EMAIL, other, EMAIL, None]))
+    assert [status for status, _ in answers] == [200, 200, 200, 400]
+    assert stats == {"received": 3, "failed": 0, "rejected": 1,
+                     "by_recipient": {"sim.0@example.com": 2,
+                                      "sim.1@example.com": 1}}
+
+
+def test_start_stub_takes_server_emails(monkeypatch):
+    import asyncio
+    import heart_rate_server as server
+    from email_stub import start_stub, stub_stats
+
+    async def run():
+        runner, url = await start_stub(port=0)
+        monkeypatch.setattr(server, "EMAIL_SERVER", url)
+        try:
+            delivered = await asyncio.get_running_loop().run_in_executor(
+                None, server.deliver_email, EMAIL)
+            return delivered, dict(stub_stats(runner))
+        finally:
+            await runner.cleanup()
+
+    delivered, stats = asyncio.run(run())
+    assert delivered is True
+    assert stats["received"] == 1
@@ -0,0 +1,214 @@
+import struct
+
+import pytest
+
+ATTENDANT = {"attending_username": "Smith.J",
+             "attending_email": "smith@example.com",
+             "attending_phone": "919-867-5309"}
+
+REQUESTS = [
+    ("POST", "/api/new_attending", ATTENDANT),
+    ("POST", "/api/new_attending", {"attending_username": "Smith.J"}),
+    ("POST", "/api/new_patient", {"patient_id": 1, "patient_age": 50,
+                                  "attending_username": "Smith.J"}),
+    ("POST", "/api/new_patient", {"patient_id": 2, "patient_age": 50,
+                                  "attending_username": "Nobody"}),
+    ("POST", "/api/heart_rate/batch", [
+        {"patient_id": 1, "heart_rate": 70,
+         "timestamp": "2020-03-09 11:00:36"},
+        {"patient_id": 1, "heart_rate": 80,
+         "timestamp": "2020-03-09 11:00:38"},
+        {"patient_id": 5, "heart_rate": 80}]),
+    ("POST", "/api/heart_rate/batch", {"records": []}),
+    ("POST", "/api/heart_rate/binary",
+     struct.pack("<IHxxqIHxxq", 1, 90, 1583751637000, 9, 90, 0)),
+    ("POST", "/api/heart_rate/binary", b"\x01\0\0"),
+    ("POST", "/api/heart_rate", {"patient_id": 1}),
+    ("GET", "/api/heart_rate/1", None),
+    ("GET", "/api/heart_rate/1?limit=1", None),
+    ("GET", "/api/heart_rate/1?format=ndjson", None),
+    ("GET", "/api/heart_rate/1?limit=0", None),
+    ("GET", "/api/heart_rate/average/1", None),
+    ("GET", "/api/heart_rate/average/7", None),
+    ("GET", "/api/heart_rate/summary/1", None),
+    ("GET", "/api/heart_rate/summary/7", None),
+    ("GET", "/api/status/1", None),
+    ("POST", "/api/heart_rate/interval_average",
+     {"patient_id": 1, "heart_rate_average_since": "2020-03-09 11:00:37"}),
+    ("POST", "/api/heart_rate/interval_average",
+     {"patient_id": 7, "heart_rate_average_since": "2020-03-09 11:00:37"}),
+    ("GET", "/api/patients/Smith.J", None),
+    ("GET", "/api/patients/Nobody", None)]
+
+
+def fresh_databases(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+
+
+def encode(body):
+    import json
+    if type(body) is bytes:
+        return body, "application/octet-stream"
+    return (None if body is None else json.dumps(body)), "application/json"
+
+
+def flask_answers():
+    from heart_rate_server import app
+    client = app.test_client()
+    answers = list()
+    for method, path, body in REQUESTS:
+        data, content_type = encode(body)
+        r = client.open(path, method=method, data=data,
+                        content_type=content_type)
+        answers.append((r.status_code, r.get_data(as_text=True)))
+    return answers
+
+
+async def aiohttp_answers():
+    from aiohttp.test_utils import TestClient, TestServer
+    from heart_rate_async import create_app
+    answers = list()
+    async with TestClient(TestServer(create_app())) as client:
+        for method, path, body in REQUESTS:
+            data, content_type = encode(body)
+            r = await client.request(method, path, data=data,
+                                     headers={"Content-Type": content_type})
+            answers.append((r.status, await r.text()))
+    return answers
+
+
+def test_async_app_answers_like_flask_app(monkeypatch):
+    import asyncio
+    import json
+    fresh_databases(monkeypatch)
+    expected = flask_answers()
+    fresh_databases(monkeypatch)
+    answers = asyncio.run(aiohttp_answers())
+    for request, answer, want in zip(REQUESTS, answers, expected):
+        path = request[1]
+        assert (path, answer[0]) == (path, want[0])
+        try:
+            assert (path, json.loads(answer[1])) == \
+                (path, json.loads(want[1]))
+        except ValueError:
+            assert (path, answer[1].strip()) == (path, want[1].strip())
+
+
+def test_async_status_etag(monkeypatch):
+    import asyncio
+    from aiohttp.test_utils import TestClient, TestServer
+    from heart_rate_async import create_app
+    fresh_databases(monkeypatch)
+
+    async def run():
+        async with TestClient(TestServer(create_app())) as client:
+            await client.post("/api/new_attending", json=ATTENDANT)
+            await client.post("/api/new_patient", json={
+                "patient_id": 1, "patient_age": 50,
+                "attending_username": "Smith.J"})
+            r = await client.get("/api/status/1")
+            etag = r.headers["ETag"]
+            r = await client.get("/api/status/1",
+                                 headers={"If-None-Match": etag})
+            assert r.status == 304
+            r = await client.get("/api/status/1",
+                                 headers={"If-None-Match": "*"})
+            assert r.status == 304
+            await client.post("/api/heart_rate", json={"patient_id": 1,
+                                                       "heart_rate": 70})
+            r = await client.get("/api/status/1",
+                                 headers={"If-None-Match": etag})
+            assert r.status == 200
+            assert (await r.json())["heart_rate"] == 70
+
+    asyncio.run(run())
+
+
+def test_async_stream_and_events(monkeypatch):
+    import asyncio
+    import json
+    import heart_rate_server as server
+    from aiohttp.test_utils import TestClient, TestServer
+    from heart_rate_async import create_app
+    fresh_databases(monkeypatch)
+
+    async def run():
+        async with TestClient(TestServer(create_app())) as client:
+            await client.post("/api/new_attending", json=ATTENDANT)
+            await client.post("/api/new_patient", json={
+                "patient_id": 1, "patient_age": 50,
+                "attending_username": "Smith.J"})
+            events = await client.get("/api/patients/Smith.J/events")
+            assert (await events.content.readline()).startswith(
+                b"event: roster")
+            await events.content.readline()
+            await events.content.readline()
+            r = await client.post(
+                "/api/heart_rate/stream",
+                data=b'{"patient_id": 1, "heart_rate": 70}\nnot json\n')
+            lines = (await r.text()).splitlines()
+            assert [json.loads(line).get("status_code")
+                    for line in lines] == [200, 400, None]
+            assert lines[-1] == server.app.json.codec.dumps(
+                {"stored": 1, "rejected": 1}).decode()
+            line = await asyncio.wait_for(events.content.readline(), 5)
+            assert line == b"event: patient\n"
+            line = await events.content.readline()
+            assert json.loads(line[len("data: "):])["last_heart_rate"] == 70
+            events.close()
+
+    asyncio.run(run())
+
+
+def test_async_app_swaps_alert_dispatcher(monkeypatch):
+    import asyncio
+    import heart_rate_server as server
+    from aiohttp.test_utils import TestClient, TestServer
+    from alert_dispatcher import AsyncAlertDispatcher
+    from heart_rate_async import create_app
+    original = server.alert_dispatcher
+
+    async def run():
+        async with TestClient(TestServer(create_app())) as client:
+            assert isinstance(server.alert_dispatcher, AsyncAlertDispatcher)
+            r = await client.get("/api/alerts/stats")
+            assert (await r.json())["queued"] == 0
+
+    asyncio.run(run())
+    assert server.alert_dispatcher is original
+
+
+def test_async_alerts_with_fsync_always(tmp_path, monkeypatch):
+    import asyncio
+    import heart_rate_server as server
+    from aiohttp.test_utils import TestClient, TestServer
+    from email_stub import start_stub, stub_stats
+    from heart_rate_async import create_app
+    fresh_databases(monkeypatch)
+    monkeypatch.setattr(server, "storage", None)
+    engine = server.open_storage(str(tmp_path), fsync="always")
+
+    async def run():
+        stub, url = await start_stub(port=0)
+        monkeypatch.setattr(server, "EMAIL_SERVER", url)
+        try:
+            async with TestClient(TestServer(create_app())) as client:
+                await client.post("/api/new_attending", json=ATTENDANT)
+                await client.post("/api/new_patient", json={
+                    "patient_id": 1, "patient_age": 50,
+                    "attending_username": "Smith.J"})
+                r = await client.post("/api/heart_rate", json={
+                    "patient_id": 1, "heart_rate": 180})
+                assert r.status == 200
+                await server.alert_dispatcher.join()
+            return stub_stats(stub)["received"]
+        finally:
+            await stub.cleanup()
+
+    try:
+        assert asyncio.run(run()) == 1
+    finally:
+        engine.close()
@@ -0,0 +1,300 @@
+import pytest
+from datetime import datetime
+
+
+@pytest.fixture
+def live_server(monkeypatch):
+    import threading
+    from werkzeug.serving import make_server
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    http = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(http.server_port)
+    http.shutdown()
+
+
+def flaky_server(failures):
+    import threading
+    from flask import Flask, jsonify, request
+    from werkzeug.serving import make_server
+    app = Flask(__name__)
+    seen = list()
+
+    @app.route("/api/heart_rate/batch", methods=["POST"])
+    def batch():
+        seen.append(request.get_json())
+        if len(seen) <= failures:
+            return "busy", 503
+        return jsonify({"stored": len(seen[-1]), "rejected": 0,
+                        "results": []})
+
+    http = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    return http, seen
+
+
+@pytest.mark.parametrize("timestamp, expected",
+                         [("2018-03-09 11:00:36", "2018-03-09 11:00:36"),
+                          (1520593236000, "2018-03-09 11:00:36"),
+                          (datetime(2018, 3, 9, 11, 0, 36),
+                           "2018-03-09 11:00:36")])
+def test_batch_timestamp(timestamp, expected):
+    from heart_rate_client import batch_timestamp
+    answer = batch_timestamp(timestamp)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_client_routes_and_flush(live_server, binary):
+    from heart_rate_client import HeartRateClient
+    with HeartRateClient(live_server, batch_size=3, flush_interval=60,
+                         binary=binary) as client:
+        assert client.add_attending("Client.C", "client@duke.edu",
+                                    "919-200-8973").status_code == 200
+        assert client.add_patient(1900, "Client.C", 30).status_code == 200
+        assert client.post_heart_rate(1900, 70).status_code == 200
+        for i in range(7):
+            assert client.add_reading(1900, 80 + i,
+                                      "2018-03-09 11:00:3{}".format(i))
+        assert client.add_reading(1901, 80, 1520593236000)
+        assert client.flush() == 7
+        assert client.stats() == {"buffered": 0, "sent": 8, "stored": 7,
+                                  "rejected": 1, "dropped": 0,
+                                  "retried": 0, "failed": 0}
+        assert client.heart_rates(1900).json() == list(range(80, 87)) + [70]
+        assert client.heart_rates(1900, limit=1).json()["readings"] == \
+            [{"heart_rate": 80, "timestamp": "2018-03-09 11:00:30"}]
+        assert client.summary(1900).json()["count"] == 8
+        r = client.status(1900)
+        assert r.json()["heart_rate"] == 70
+        assert client.status(1900, r.headers["ETag"]).status_code == 304
+        assert client.patients("Client.C").json()[0]["patient_id"] == 1900
+        r = client.interval_average(1900, "2018-03-09 11:00:35")
+        assert r.json() == pytest.approx((85 + 86 + 70) / 3)
+        assert client.average(1901).status_code == 200
+        assert "queue_depth" in client.alert_stats().json()
+        client.add_reading(1900, 90)
+    assert client.stats()["stored"] == 8
+
+
+def test_client_flushes_in_background(live_server):
+    import time
+    from heart_rate_client import HeartRateClient
+    client = HeartRateClient(live_server, batch_size=2, flush_interval=60)
+    client.add_attending("Client.C", "client@duke.edu", "919-200-8973")
+    client.add_patient(2000, "Client.C", 30)
+    client.add_reading(2000, 70)
+    client.add_reading(2000, 71)
+    deadline = time.monotonic() + 10
+    while client.stats()["stored"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client.stats()["stored"] == 2
+    client.add_reading(2000, 72)
+    client.flush_interval = 0.01
+    client._wakeup.set()
+    deadline = time.monotonic() + 10
+    while client.stats()["stored"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.close()
+    assert client.heart_rates(2000).json() == [70, 71, 72]
+
+
+@pytest.mark.parametrize("failures, retries, expected_stored",
+                         [(0, 3, 2), (2, 3, 2), (4, 3, 0)])
+def test_client_retries_with_backoff(failures, retries, expected_stored):
+    import requests
+    from heart_rate_client import HeartRateClient
+    http, seen = flaky_server(failures)
+    client = HeartRateClient("http://127.0.0.1:{}".format(http.server_port),
+                             flush_interval=60, retries=retries,
+                             backoff=0.001)
+    try:
+        client.add_reading(1, 70)
+        client.add_reading(2, 80)
+        if expected_stored:
+            assert client.flush() == expected_stored
+        else:
+            with pytest.raises(requests.HTTPError):
+                client.flush()
+    finally:
+        http.shutdown()
+    stats = client.stats()
+    assert stats["retried"] == min(failures, retries)
+    assert stats["stored"] == expected_stored
+    assert stats["buffered"] == 2 - expected_stored
+    assert len(seen) == min(failures, retries) + 1
+    assert all(batch == seen[0] for batch in seen)
+
+
+def test_client_keeps_readings_while_server_is_down():
+    import requests
+    from heart_rate_client import HeartRateClient
+    client = HeartRateClient("http://127.0.0.1:9", flush_interval=60,
+                             retries=1, backoff=0.001, max_buffered=2)
+    assert client.add_reading(1, 70)
+    assert client.add_reading(1, 71)
+    assert not client.add_reading(1, 72)
+    with pytest.raises(requests.ConnectionError):
+        client.flush()
+    assert client.stats()["buffered"] == 2
+    assert client.stats()["dropped"] == 1
+    assert client.stats()["failed"] == 1
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_async_client(live_server, binary):
+    import asyncio
+    from heart_rate_client import AsyncHeartRateClient
+
+    async def run():
+        async with AsyncHeartRateClient(live_server, batch_size=50,
+                                        flush_interval=0.01,
+                                        binary=binary) as client:
+            await client.add_attending("Client.C", "client@duke.edu",
+                                       "919-200-8973")
+            r = await client.add_patient(2100, "Client.C", 30)
+            assert r.status == 200
+            for i in range(120):
+                client.add_reading(2100, 60 + i % 50,
+                                   1520593236000 + 1000 * i)
+            for _ in range(1000):
+                if client.stats()["stored"] == 120:
+                    break
+                await asyncio.sleep(0.01)
+            r = await client.summary(2100)
+            assert (await r.json())["count"] == 120
+            r = await client.status(2100)
+            etag = r.headers["ETag"]
+            r = await client.status(2100, etag)
+            assert r.status == 304
+            client.add_reading(2100, 70)
+        return client.stats()
+
+    stats = asyncio.run(run())
+    assert stats["stored"] == 121
+    assert stats["buffered"] == 0
+
+
+def test_async_client_retries_with_backoff():
+    import asyncio
+    from heart_rate_client import AsyncHeartRateClient
+    http, seen = flaky_server(2)
+
+    async def run():
+        client = AsyncHeartRateClient(
+            "http://127.0.0.1:{}".format(http.server_port),
+            flush_interval=60, backoff=0.001)
+        client.add_reading(1, 70)
+        stored = await client.flush()
+        await client.close()
+        return stored, client.stats()
+
+    try:
+        stored, stats = asyncio.run(run())
+    finally:
+        http.shutdown()
+    assert stored == 1
+    assert stats["retried"] == 2
+    assert len(seen) == 3
+
+
+def test_run_demo(live_server, capsys):
+    import heart_rate_client
+    import heart_rate_server as server
+    assert not hasattr(heart_rate_client, "demo_client")
+    heart_rate_client.run_demo(live_server)
+    assert server.patient_db.get(1)["heart_rate"] == [90, 90, 60]
+    assert server.attendant_db.get("Therien.A")["patients"] == [2, 3]
+    assert "Attendant information stored" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("method, path, expected", [
+    ("GET", "/api/status/12", "GET /api/status/<id>"),
+    ("GET", "/api/heart_rate/12?limit=5", "GET /api/heart_rate/<id>"),
+    ("GET", "/api/heart_rate/average/12", "GET /api/heart_rate/average/<id>"),
+    ("GET", "/api/patients/Smith.J/events", "GET /api/patients/<id>/events"),
+    ("POST", "/api/heart_rate/batch", "POST /api/heart_rate/batch"),
+    ("POST", "/api/heart_rate", "POST /api/heart_rate"),
+    ("GET", "/api/alerts/stats", "GET /api/alerts/stats"),
+])
+def test_route_of(method, path, expected):
+    from heart_rate_client import route_of
+    answer = route_of(method, path)
+    assert answer == expected
+
+
+def test_latency_histogram():
+    from heart_rate_client import LatencyHistogram
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) is None
+    for i in range(1, 101):
+        histogram.record(i / 1000)
+    other = LatencyHistogram()
+    other.record(2.0)
+    other.errors = 1
+    histogram.merge(other)
+    summary = histogram.summary()
+    assert summary["count"] == 101
+    assert summary["errors"] == 1
+    assert summary["max"] == 2.0
+    assert summary["mean"] == pytest.approx((5.05 + 2.0) / 101)
+    assert 0.051 <= summary["p50"] <= 0.051 * 2 ** 0.125
+    assert 0.1 <= summary["p99"] <= 0.1 * 2 ** 0.125
+    assert histogram.percentile(100) == 2.0
+
+
+@pytest.mark.parametrize("episodes, tachycardic", [(0, False),
+                                                   (3600, True)])
+def test_heart_rate_walk(episodes, tachycardic):
+    import random
+    from itertools import islice
+    from heart_rate_client import heart_rate_walk
+    from tachycardia import default_table
+    limit = default_table.limit(40)
+    walk = heart_rate_walk(random.Random(1), 40, 1.0, episodes, 30.0)
+    readings = list(islice(walk, 100))
+    assert all(flag == tachycardic for _, flag in readings)
+    assert all((rate > limit) == flag for rate, flag in readings)
+
+
+@pytest.mark.parametrize("mode", ["single", "batch"])
+def test_simulate_fleet(live_server, monkeypatch, mode):
+    import asyncio
+    import socket
+    import heart_rate_server as server
+    from heart_rate_client import simulate_fleet, format_report
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(server, "EMAIL_SERVER",
+                        "http://127.0.0.1:{}/hrss/send_email".format(port))
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(server.deliver_email))
+    report = asyncio.run(simulate_fleet(
+        live_server, attendants=3, patients=10, rate=5, duration=1,
+        mode=mode, episodes=3600 * 5, dashboard_interval=0.2,
+        first_patient_id=3000, email_stub_port=port))
+    totals = report["totals"]
+    assert totals["registered"] == 13
+    assert totals["readings"] == totals["tachycardic"] == 50
+    assert totals["failed"] == totals["rejected"] == 0
+    assert sum(len(server.patient_db.get(3000 + i)["heart_rate"])
+               for i in range(10)) == 50
+    assert report["emails"]["received"] == report["alerts"]["sent"]
+    if mode == "single":
+        assert report["alerts"]["sent"] == 50
+    else:
+        # a batch emails at most once per patient
+        assert report["alerts"]["sent"] >= 10
+    assert totals["roster_changed"] >= 3
+    assert "GET /api/patients/<id>" in report["routes"]
+    route = "POST /api/heart_rate" if mode == "single" else \
+        "POST /api/heart_rate/batch"
+    assert report["routes"][route]["count"] >= 1
+    assert route in format_report(report)
+    server.alert_dispatcher.stop()
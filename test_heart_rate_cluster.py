@@ -0,0 +1,195 @@
+import pytest
+
+
+@pytest.mark.parametrize("patient_id, partitions, expected", [
+    (1, 4, 1),
+    (8, 4, 0),
+    ("7", 4, 3),
+    (123, 1, 0)])
+def test_partition_for(patient_id, partitions, expected):
+    from heart_rate_cluster import partition_for
+    assert partition_for(patient_id, partitions) == expected
+
+
+def test_partition_for_other_ids_is_stable():
+    from heart_rate_cluster import partition_for
+    first = partition_for("abc", 3)
+    assert 0 <= first < 3
+    assert partition_for("abc", 3) == first
+
+
+def test_split_and_merge_batch():
+    from heart_rate_cluster import split_batch, merge_batch_results
+    records = [{"patient_id": 1}, {"patient_id": 2}, "bad",
+               {"patient_id": 3}, {"heart_rate": 70}]
+    parts = split_batch(records, 2)
+    assert parts == {1: ([0, 3], [records[0], records[3]]),
+                     0: ([1, 2, 4], [records[1], "bad", records[4]])}
+    results = [(indexes, [{"index": i} for i in indexes])
+               for indexes, batch in parts.values()]
+    merged = merge_batch_results(len(records), results)
+    assert merged == [{"index": i} for i in range(len(records))]
+
+
+def test_split_ndjson_lines():
+    from heart_rate_cluster import split_ndjson_lines
+    lines = [(1, b'{"patient_id": 1}'), (2, b'{"patient_id": 2}'),
+             (4, b"{bad"), (5, None), (6, b'{"patient_id": 3}'),
+             (7, b"[1]")]
+    parts, acks = split_ndjson_lines(lines, 2)
+    assert parts == {1: ([1, 6], [b'{"patient_id": 1}',
+                                  b'{"patient_id": 3}']),
+                     0: ([2, 7], [b'{"patient_id": 2}', b"[1]"])}
+    assert acks == {4: ("line is not valid JSON", 400),
+                    5: ("line is too long", 400)}
+
+
+def test_split_and_merge_binary():
+    from binary_ingest import decode_records, pack_records
+    from heart_rate_cluster import merge_binary_results, split_binary
+    data = pack_records([(1, 70, 0), (2, 80, 0), (3, 90, 0), (4, 60, 0)])
+    parts = split_binary(data, 2)
+    assert sorted(parts) == [0, 1]
+    assert decode_records(parts[0])[0].tolist() == [2, 4]
+    assert decode_records(parts[1])[1].tolist() == [70, 90]
+    assert split_binary(b"", 2) == dict()
+    merged = merge_binary_results([
+        {"stored": 1, "rejected": 1, "tachycardic": 0,
+         "errors": [{"patient_id": 4, "readings": 1, "error": "x"}]},
+        {"stored": 2, "rejected": 1, "tachycardic": 1,
+         "errors": [{"patient_id": 3, "readings": 1, "error": "x"}]}])
+    assert merged == {"stored": 3, "rejected": 2, "tachycardic": 1,
+                      "errors": [{"patient_id": 3, "readings": 1,
+                                  "error": "x"},
+                                 {"patient_id": 4, "readings": 1,
+                                  "error": "x"}]}
+
+
+def test_merge_rosters():
+    from heart_rate_cluster import merge_rosters
+    rosters = [[{"patient_id": 2}, {"patient_id": 4}],
+               [{"patient_id": 3}, {"patient_id": 1}]]
+    assert [row["patient_id"] for row in merge_rosters(rosters)] == \
+        [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("stats, expected", [
+    ([{"queue_depth": 1, "queued": 3, "sent": 2, "failed": 0, "retried": 1,
+       "dropped": 0, "average_latency": 1.0, "last_latency": 0.5},
+      {"queue_depth": 0, "queued": 2, "sent": 2, "failed": 1, "retried": 0,
+       "dropped": 1, "average_latency": 2.0, "last_latency": 3.0}],
+     {"queue_depth": 1, "queued": 5, "sent": 4, "failed": 1, "retried": 1,
+      "dropped": 1, "average_latency": 1.5, "last_latency": 3.0}),
+    ([{"queue_depth": 0, "queued": 0, "sent": 0, "failed": 0, "retried": 0,
+       "dropped": 0, "average_latency": None, "last_latency": None}],
+     {"queue_depth": 0, "queued": 0, "sent": 0, "failed": 0, "retried": 0,
+      "dropped": 0, "average_latency": None, "last_latency": None})])
+def test_merge_alert_stats(stats, expected):
+    from heart_rate_cluster import merge_alert_stats
+    assert merge_alert_stats(stats) == expected
+
+
+def test_iter_sse_events():
+    from heart_rate_cluster import iter_sse_events
+    lines = ["event: roster", "data: []", "", ": keep-alive", "",
+             "event: patient", 'data: {"patient_id": 1}', ""]
+    assert list(iter_sse_events(lines)) == \
+        [("roster", "[]"), ("patient", '{"patient_id": 1}')]
+
+
+def test_worker_environment():
+    import os
+    from heart_rate_cluster import worker_environment
+    environ = {"HR_DATA_DIR": "data", "HR_FSYNC": "always",
+               "HR_BINARY_PORT": "5050"}
+    assert worker_environment(environ, 2) == \
+        {"HR_DATA_DIR": os.path.join("data", "worker-2"),
+         "HR_FSYNC": "always"}
+    assert environ["HR_DATA_DIR"] == "data"
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_router_spreads_patients_over_workers():
+    import json
+    import requests
+    from binary_ingest import pack_records
+    from heart_rate_cluster import create_router, start_workers, \
+        wait_for_workers
+    base_port = free_port()
+    processes, urls = start_workers(2, base_port=base_port, environ={})
+    try:
+        assert wait_for_workers(urls)
+        client = create_router(urls).test_client()
+        r = client.post("/api/new_attending", json={
+            "attending_username": "Smith.J",
+            "attending_email": "smith@example.com",
+            "attending_phone": "919-867-5309"})
+        assert r.status_code == 200
+        for patient_id in (1, 2, 3):
+            r = client.post("/api/new_patient", json={
+                "patient_id": patient_id, "attending_username": "Smith.J",
+                "patient_age": 50})
+            assert r.status_code == 200
+        r = client.post("/api/heart_rate/batch", json=[
+            {"patient_id": 1, "heart_rate": 70},
+            {"patient_id": 2, "heart_rate": 80},
+            {"patient_id": 9, "heart_rate": 80},
+            {"patient_id": 3, "heart_rate": 90}])
+        assert r.get_json()["stored"] == 3
+        assert [result["stored"] for result in r.get_json()["results"]] \
+            == [True, True, False, True]
+        r = client.post("/api/heart_rate/stream",
+                        data=b'{"patient_id": 2, "heart_rate": 60}\n')
+        assert r.data.splitlines() == [
+            b'{"line":1,"message":"Heart rate information is stored",'
+            b'"status_code":200}', b'{"rejected":0,"stored":1}']
+        r = client.post("/api/heart_rate/stream",
+                        data=b'{"patient_id": 1, "heart_rate": 71}\n'
+                             b'{"patient_id": 9, "heart_rate": 71}\n'
+                             b'\n{bad\n'
+                             b'{"patient_id": 3, "heart_rate": 91}')
+        acks = [json.loads(line) for line in r.data.splitlines()]
+        assert [(ack["line"], ack["status_code"]) for ack in acks[:-1]] \
+            == [(1, 200), (2, 400), (4, 400), (5, 200)]
+        assert acks[2]["message"] == "line is not valid JSON"
+        assert acks[-1] == {"stored": 2, "rejected": 2}
+        r = client.post("/api/heart_rate/binary",
+                        data=pack_records([(3, 95, 0), (2, 65, 0),
+                                           (8, 70, 0)]),
+                        content_type="application/octet-stream")
+        assert r.get_json()["stored"] == 2
+        assert r.get_json()["errors"][0]["patient_id"] == 8
+        assert client.get("/api/heart_rate/3").get_json() == [90, 91, 95]
+        r = client.post("/api/heart_rate/binary", data=b"\0",
+                        content_type="application/octet-stream")
+        assert r.status_code == 400
+        assert client.get("/api/heart_rate/2").get_json() == [80, 60, 65]
+        held = [requests.get(url + "/api/heart_rate/2").json()
+                for url in urls]
+        assert held == [[80, 60, 65], ["Patient not found", 400]]
+        r = client.get("/api/patients/Smith.J")
+        rows = r.get_json()
+        assert [row["patient_id"] for row in rows] == [1, 2, 3]
+        assert [row["last_heart_rate"] for row in rows] == [71, 65, 95]
+        r = client.get("/api/patients/Smith.J",
+                       headers={"If-None-Match": r.headers["ETag"]})
+        assert r.status_code == 304
+        r = client.get("/api/patients/Nobody")
+        assert r.status_code == 400
+        down = "http://127.0.0.1:" + str(free_port())
+        r = create_router(urls + [down]).test_client().post(
+            "/api/new_attending", json={
+                "attending_username": "Jones.A",
+                "attending_email": "jones@example.com",
+                "attending_phone": "919-555-0100"})
+        assert r.status_code == 502
+        assert r.data == b"Attendant information not stored on workers 2"
+    finally:
+        for process in processes:
+            process.terminate()
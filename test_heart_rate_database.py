@@ -0,0 +1,206 @@
+import pytest
+
+
+def make_patient(patient_id, age=21):
+    return {"patient_id": patient_id, "attending_username": "Therien.A",
+            "patient_age": age, "heart_rate": list(),
+            "timestamp": list(), "status": ""}
+
+
+@pytest.mark.parametrize("patient_id, expected",
+                         [(1, 1),
+                          ("1", 1),
+                          ("abc", "abc"),
+                          (20, 20)])
+def test_normalize_id(patient_id, expected):
+    from heart_rate_database import normalize_id
+    answer = normalize_id(patient_id)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("patient_id, expected",
+                         [(1, 1), ("2", 2), (3, None), ("abc", None)])
+def test_patient_store_get(patient_id, expected):
+    from heart_rate_database import PatientStore
+    db = PatientStore([make_patient(1), make_patient(2)])
+    answer = db.get(patient_id)
+    if expected is None:
+        assert answer is None
+    else:
+        assert answer["patient_id"] == expected
+
+
+def test_patient_store_first_duplicate_wins():
+    from heart_rate_database import PatientStore
+    db = PatientStore()
+    first = make_patient(5, 20)
+    db.append(first)
+    db.append(make_patient(5, 30))
+    assert db.get(5) is first
+    db.remove(first)
+    assert db.get(5)["patient_age"] == 30
+
+
+def test_patient_store_keeps_list_contract():
+    from heart_rate_database import PatientStore
+    db = PatientStore()
+    db.extend([make_patient(1), make_patient(2)])
+    db.insert(0, make_patient(0))
+    assert [patient["patient_id"] for patient in db] == [0, 1, 2]
+    assert 0 in db
+    del db[0]
+    assert db.get(0) is None
+    db.clear()
+    assert db.get(1) is None and len(db) == 0
+
+
+@pytest.mark.parametrize("patient_id, db, expected",
+                         [(1, [make_patient(1)], 1),
+                          ("1", [make_patient(1)], 1),
+                          (2, [make_patient(1)], None),
+                          (2, [], None)])
+def test_lookup_patient(patient_id, db, expected):
+    from heart_rate_database import lookup_patient, PatientStore
+    for patients in (db, PatientStore(db)):
+        answer = lookup_patient(patient_id, patients)
+        if expected is None:
+            assert answer is None
+        else:
+            assert answer["patient_id"] == expected
+
+
+def test_patient_store_attaches_series():
+    from heart_rate_database import PatientStore
+    patient = make_patient(7)
+    patient["heart_rate"] = [60, 70]
+    patient["timestamp"] = ["2020-03-09 11:00:36", "2020-03-09 11:00:40"]
+    db = PatientStore([patient])
+    assert len(db.get(7)["series"]) == 2
+    assert db.get(7)["heart_rate"] == [60, 70]
+    assert db.get(7)["timestamp"][-1] == "2020-03-09 11:00:40"
+
+
+def make_attendant(username, patients):
+    return {"attending_username": username,
+            "attending_email": username.lower() + "@duke.edu",
+            "attending_phone": "919-200-8973",
+            "patients": patients}
+
+
+@pytest.mark.parametrize("username, expected",
+                         [("Canyon.D", "canyon.d@duke.edu"),
+                          ("Aidan.T", "aidan.t@duke.edu"),
+                          ("Max.G", None)])
+def test_attendant_registry_get(username, expected):
+    from heart_rate_database import AttendantRegistry
+    db = AttendantRegistry([make_attendant("Canyon.D", [1]),
+                            make_attendant("Aidan.T", [2, 3])])
+    answer = db.get(username)
+    if expected is None:
+        assert answer is None
+    else:
+        assert answer["attending_email"] == expected
+
+
+@pytest.mark.parametrize("patient_id, expected",
+                         [(1, "Canyon.D"), (3, "Aidan.T"), ("3", "Aidan.T"),
+                          (4, "Aidan.T"), (5, None)])
+def test_attendant_registry_attendant_for_patient(patient_id, expected):
+    from heart_rate_database import AttendantRegistry
+    db = AttendantRegistry([make_attendant("Canyon.D", [1])])
+    db.append(make_attendant("Aidan.T", [2, 3]))
+    db.add_patient("Aidan.T", 4)
+    answer = db.attendant_for_patient(patient_id)
+    if expected is None:
+        assert answer is None
+    else:
+        assert answer["attending_username"] == expected
+
+
+def test_attendant_registry_add_patient():
+    from heart_rate_database import AttendantRegistry
+    db = AttendantRegistry([make_attendant("Canyon.D", [])])
+    assert db.add_patient("Max.G", 1) is None
+    assert db.add_patient("Canyon.D", 1)["patients"] == [1]
+    del db[0]
+    assert db.attendant_for_patient(1) is None
+    assert "Canyon.D" not in db
+
+
+@pytest.mark.parametrize("username, patient_id, db, expected",
+                         [("Canyon.D", 1, [make_attendant("Canyon.D", [1])],
+                           "Canyon.D"),
+                          ("Aidan.T", 2, [make_attendant("Canyon.D", [1])],
+                           None)])
+def test_lookup_attendant(username, patient_id, db, expected):
+    from heart_rate_database import (AttendantRegistry, lookup_attendant,
+                                     lookup_patient_attendant)
+    for attendants in (db, AttendantRegistry(db)):
+        by_name = lookup_attendant(username, attendants)
+        by_patient = lookup_patient_attendant(patient_id, attendants)
+        if expected is None:
+            assert by_name is None and by_patient is None
+        else:
+            assert by_name["attending_username"] == expected
+            assert by_patient["attending_username"] == expected
+
+
+def test_patient_store_versions():
+    from heart_rate_database import PatientStore
+    db = PatientStore()
+    assert db.version(1) == 0
+    assert db.bump_version(1) == 1
+    assert db.bump_version("1") == 2
+    assert db.version("1") == 2
+    db.clear()
+    assert db.version(1) == 2
+
+
+def test_attendant_registry_versions():
+    from heart_rate_database import AttendantRegistry
+    db = AttendantRegistry([{"attending_username": "Canyon.D",
+                             "attending_email": "dr_user_id@yourdomain.com",
+                             "attending_phone": "919-555-1212",
+                             "patients": []}])
+    assert db.version("Canyon.D") == 0
+    db.add_patient("Canyon.D", 1)
+    assert db.version("Canyon.D") == 1
+    db.add_patient("Nobody", 2)
+    assert db.version("Nobody") == 0
+    assert db.bump_version("Canyon.D") == 2
+
+
+def test_attendant_registry_roster():
+    from heart_rate_database import AttendantRegistry
+    db = AttendantRegistry([{"attending_username": "Canyon.D",
+                             "attending_email": "dr_user_id@yourdomain.com",
+                             "attending_phone": "919-555-1212",
+                             "patients": []}])
+    assert db.roster("Canyon.D") == []
+    assert db.update_roster_row("Nobody", {"patient_id": 3}) is None
+    first = db.update_roster_row("Canyon.D", {"patient_id": 1,
+                                              "status": ""})
+    db.update_roster_row("Canyon.D", {"patient_id": 2, "status": ""})
+    stored = db.update_roster_row("Canyon.D", {"patient_id": 1,
+                                               "status": "tachycardic"})
+    rows = db.roster("Canyon.D")
+    assert rows == [{"patient_id": 1, "status": "tachycardic"},
+                    {"patient_id": 2, "status": ""}]
+    assert rows[0] is stored
+    assert first == {"patient_id": 1, "status": ""}
+    assert db.roster_row("Canyon.D", 2) == {"patient_id": 2, "status": ""}
+    assert db.roster_row("Canyon.D", 3) is None
+    assert db.roster("Nobody") == []
+
+
+def test_lock_stripes():
+    from heart_rate_database import LockStripes, PatientStore
+    stripes = LockStripes(4)
+    assert len(stripes) == 4
+    assert stripes.lock_for(1) is stripes.lock_for(5)
+    assert stripes.lock_for(1) is not stripes.lock_for(2)
+    db = PatientStore(stripes=8)
+    assert db.lock_for("3") is db.lock_for(3)
+    with db.lock_for(3):
+        with db.lock_for(3):
+            pass
@@ -0,0 +1,102 @@
+import pytest
+
+
+def make_series(count=240, step=15000):
+    from heart_rate_series import HeartRateSeries
+    series = HeartRateSeries()
+    series.extend([60 + i % 37 for i in range(count)],
+                  [step * i for i in range(count)])
+    return series
+
+
+def test_rollup_table_add_merges_buckets():
+    from heart_rate_rollups import RollupTable
+    table = RollupTable(60000)
+    table.add(61000, 2, 150, 70, 80)
+    table.add(1000, 1, 60, 60, 60)
+    table.add(119999, 1, 90, 90, 90)
+    assert table.rows() == [[0, 1, 60, 60, 60], [60000, 3, 240, 70, 90]]
+    assert table.count == 4
+    assert table.total == 300
+
+
+@pytest.mark.parametrize("epoch_ms, expected",
+                         [(0, (6, 450)), (60000, (3, 240)),
+                          (60001, (0, 0)), (200000, (0, 0))])
+def test_rollup_table_since(epoch_ms, expected):
+    from heart_rate_rollups import RollupTable
+    table = RollupTable(60000)
+    table.add_readings([60, 60, 90, 70, 80, 90],
+                       [0, 30000, 59999, 60000, 61000, 119999])
+    assert table.since(epoch_ms) == expected
+
+
+@pytest.mark.parametrize("cutoff, expected_left",
+                         [(59999, 2), (60000, 1), (119999, 1),
+                          (120000, 0)])
+def test_rollup_table_expire_before(cutoff, expected_left):
+    from heart_rate_rollups import RollupTable
+    table = RollupTable(60000)
+    table.add_readings([60, 70], [0, 60000])
+    expired = table.expire_before(cutoff)
+    assert len(table) == expected_left
+    assert len(expired) == 2 - expected_left
+    assert table.count == expected_left
+
+
+def test_rollups_dict_round_trip():
+    from heart_rate_rollups import Rollups
+    rollups = Rollups()
+    rollups.minutes.add_readings([60, 70], [0, 60000])
+    rollups.hours.add(0, 3, 200, 50, 75)
+    copy = Rollups.from_dict(rollups.to_dict())
+    assert copy.to_dict() == rollups.to_dict()
+    assert copy.count == 5
+    assert copy.total == 330
+    assert copy.extremes() == (50, 75)
+    assert Rollups().extremes() == (None, None)
+
+
+@pytest.mark.parametrize("minute_age, minutes, expected_buckets",
+                         [(None, [0, 1, 17, 30, 59, 63, 64, 70], (64, 0)),
+                          (10 * 60000, [0, 60, 61, 64, 70], (4, 1))])
+def test_retention_policy_keeps_averages_exact(minute_age, minutes,
+                                               expected_buckets):
+    from heart_rate_rollups import RetentionPolicy
+    series = make_series(count=300)
+    expected = make_series(count=300)
+    policy = RetentionPolicy(10 * 60000, minute_age)
+    rolled = policy.apply(series)
+    assert rolled == 256
+    assert series.time_at(0) == 64 * 60000
+    assert series.average() == pytest.approx(expected.average())
+    assert series.summary()["count"] == 300
+    for minute in minutes:
+        start = minute * 60000
+        assert series.average_since(start) == pytest.approx(
+            expected.average_from(expected.index_at_or_after(start)))
+    assert (len(series.rollups.minutes), len(series.rollups.hours)) == \
+        expected_buckets
+
+
+def test_retention_policy_maybe_apply():
+    from heart_rate_rollups import RetentionPolicy
+    series = make_series(count=4)
+    policy = RetentionPolicy(60000)
+    assert policy.maybe_apply(series) == 0
+    assert series.rollups is None
+    series.append(70, 120000)
+    assert policy.maybe_apply(series) == 4
+    assert series.rates() == [70]
+
+
+def test_retention_policy_drops_whole_segments(tmp_path):
+    from heart_rate_rollups import RetentionPolicy
+    series = make_series(count=40)
+    series.seal(str(tmp_path / "a.seg"), 10)
+    series.seal(str(tmp_path / "b.seg"), 10)
+    RetentionPolicy(345000).apply(series)
+    assert [p.name for p in tmp_path.iterdir()] == ["b.seg"]
+    assert series.sealed == 10
+    assert len(series) == 30
+    assert series.average() == make_series(count=40).average()
@@ -0,0 +1,246 @@
+import pytest
+from datetime import datetime
+
+
+@pytest.mark.parametrize("timestamp, expected",
+                         [("1970-01-01 00:00:01", 1000),
+                          ("2018-03-09 11:00:36", 1520593236000),
+                          (datetime(2018, 3, 9, 11, 0, 36), 1520593236000),
+                          (1520593236000, 1520593236000)])
+def test_to_epoch_ms(timestamp, expected):
+    from heart_rate_series import to_epoch_ms
+    answer = to_epoch_ms(timestamp)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("epoch_ms, expected",
+                         [(1000, "1970-01-01 00:00:01"),
+                          (1520593236000, "2018-03-09 11:00:36"),
+                          (1520593236999, "2018-03-09 11:00:36")])
+def test_format_epoch_ms(epoch_ms, expected):
+    from heart_rate_series import format_epoch_ms
+    answer = format_epoch_ms(epoch_ms)
+    assert answer == expected
+
+
+def make_series():
+    from heart_rate_series import HeartRateSeries
+    return HeartRateSeries([70, 80, 90],
+                           ["2020-03-09 11:00:36", "2020-03-09 11:00:37",
+                            "2020-03-09 11:00:38"])
+
+
+@pytest.mark.parametrize("index, expected",
+                         [(0, 70), (-1, 90), (slice(1, None), [80, 90]),
+                          (slice(None, None, 2), [70, 90])])
+def test_heart_rate_view(index, expected):
+    series = make_series()
+    answer = series.heart_rate[index]
+    assert answer == expected
+
+
+@pytest.mark.parametrize("index, expected",
+                         [(0, "2020-03-09 11:00:36"),
+                          (-1, "2020-03-09 11:00:38"),
+                          (slice(2, None), ["2020-03-09 11:00:38"])])
+def test_timestamp_view(index, expected):
+    series = make_series()
+    answer = series.timestamp[index]
+    assert answer == expected
+
+
+def test_series_append_and_views():
+    series = make_series()
+    view = series.heart_rate
+    series.append(100, "2020-03-09 11:00:39")
+    assert len(view) == 4
+    assert view == [70, 80, 90, 100]
+    assert sum(view[2:]) == 190
+    with pytest.raises(IndexError):
+        view[4]
+
+
+@pytest.mark.parametrize("heart_rate", [-1, 70000, 1.5])
+def test_series_rejects_bad_heart_rate(heart_rate):
+    series = make_series()
+    with pytest.raises(ValueError):
+        series.append(heart_rate, "2020-03-09 11:00:39")
+    assert len(series) == 3
+
+
+def test_series_rejects_mismatched_lists():
+    from heart_rate_series import HeartRateSeries
+    with pytest.raises(ValueError):
+        HeartRateSeries([60], [])
+
+
+def test_attach_series():
+    from heart_rate_series import attach_series
+    patient = {"patient_id": 1, "heart_rate": [60],
+               "timestamp": ["2020-03-09 11:00:36"]}
+    series = attach_series(patient)
+    assert patient["series"] is series
+    assert attach_series(patient) is series
+    assert patient["heart_rate"] == [60]
+    assert patient["timestamp"] == ["2020-03-09 11:00:36"]
+
+
+@pytest.mark.parametrize("offset_ms, expected_index, expected_average",
+                         [(0, 0, 80),
+                          (1000, 1, 85),
+                          (1500, 2, 90),
+                          (3000, 3, None)])
+def test_series_index_and_average(offset_ms, expected_index,
+                                  expected_average):
+    from heart_rate_series import to_epoch_ms
+    series = make_series()
+    since = to_epoch_ms("2020-03-09 11:00:36") + offset_ms
+    index = series.index_at_or_after(since)
+    assert index == expected_index
+    assert series.average_from(index) == expected_average
+
+
+def test_series_inserts_out_of_order_reading():
+    series = make_series()
+    series.append(50, "2020-03-09 11:00:35")
+    series.append(100, "2020-03-09 11:00:37")
+    assert series.heart_rate == [50, 70, 80, 100, 90]
+    assert series.timestamp[0] == "2020-03-09 11:00:35"
+    assert series.sum_range() == 390
+    assert series.sum_range(1, 3) == 150
+    assert series.average_from(3) == 95
+
+
+def test_series_summary():
+    series = make_series()
+    series.append(60, "2020-03-09 11:00:35")
+    assert series.summary() == {"count": 4, "average": 75, "min": 60,
+                                "max": 90, "last_heart_rate": 90,
+                                "last_time": "2020-03-09 11:00:38"}
+    assert series.total == 300
+
+
+def test_empty_series_summary():
+    from heart_rate_series import HeartRateSeries
+    series = HeartRateSeries()
+    assert series.average() is None
+    assert series.last_reading() == (None, None)
+    assert series.summary()["count"] == 0
+
+
+@pytest.mark.parametrize("rates, times, expected_rates",
+                         [([100, 110], ["2020-03-09 11:00:39",
+                                        "2020-03-09 11:00:40"],
+                           [70, 80, 90, 100, 110]),
+                          ([100, 60], ["2020-03-09 11:00:40",
+                                       "2020-03-09 11:00:35"],
+                           [60, 70, 80, 90, 100]),
+                          ([], [], [70, 80, 90])])
+def test_series_extend(rates, times, expected_rates):
+    series = make_series()
+    series.extend(rates, times)
+    assert series.heart_rate == expected_rates
+    assert series.total == sum(expected_rates)
+    assert series.minimum == min(expected_rates)
+    assert series.maximum == max(expected_rates)
+    assert series.sum_range(1) == sum(expected_rates[1:])
+
+
+def test_series_extend_rejects_bad_heart_rate():
+    series = make_series()
+    with pytest.raises(ValueError):
+        series.extend([100, -1], ["2020-03-09 11:00:39",
+                                  "2020-03-09 11:00:40"])
+    assert len(series) == 3
+
+
+def test_series_appended_counts_every_reading():
+    series = make_series()
+    series.append(60, "2020-03-09 11:00:30")
+    series.extend([100, 110], ["2020-03-09 11:00:39",
+                               "2020-03-09 11:00:40"])
+    assert series.appended == 6
+
+
+def test_series_columns_round_trip():
+    from heart_rate_series import HeartRateSeries
+    series = make_series()
+    rates, times, appended = series.columns()
+    copy = HeartRateSeries.from_columns(rates, times, appended)
+    assert copy.heart_rate == series.heart_rate
+    assert copy.timestamp == series.timestamp
+    assert copy.summary() == series.summary()
+    assert copy.appended == 3
+    copy.append(100, "2020-03-09 11:00:39")
+    assert len(series) == 3
+
+
+def make_sealed_series(tmp_path, count=10, sizes=(3, 4)):
+    from heart_rate_series import HeartRateSeries
+    series = HeartRateSeries()
+    series.extend([60 + 7 * i % 50 for i in range(count)],
+                  [1000 * i for i in range(count)])
+    for i, size in enumerate(sizes):
+        series.seal(str(tmp_path / "{}.seg".format(i)), size)
+    return series
+
+
+def test_sealed_series_reads_like_resident_series(tmp_path):
+    from heart_rate_series import HeartRateSeries
+    series = make_sealed_series(tmp_path)
+    rates, times, appended = series.columns()
+    resident = HeartRateSeries.from_columns(rates, times, appended)
+    assert series.sealed == 7
+    assert series.resident == 3
+    assert series.heart_rate == resident.heart_rate
+    assert series.timestamp == resident.timestamp
+    assert series.summary() == resident.summary()
+    assert series.rates(2, 8) == resident.rates(2, 8)
+    assert series.times(-4) == resident.times(-4)
+    assert series.heart_rate[1:9:3] == resident.heart_rate[1:9:3]
+    for i in range(-10, 11):
+        assert series.sum_range(max(i, 0)) == resident.sum_range(max(i, 0))
+        assert series.index_at_or_after(1000 * i - 500) == \
+            resident.index_at_or_after(1000 * i - 500)
+    for i in range(-10, 10):
+        assert series.rate_at(i) == resident.rate_at(i)
+        assert series.time_at(i) == resident.time_at(i)
+    with pytest.raises(IndexError):
+        series.rate_at(10)
+    with pytest.raises(IndexError):
+        series.time_at(-11)
+
+
+@pytest.mark.parametrize("start, stop, expected_lengths",
+                         [(0, None, [3, 4, 3]), (2, 8, [1, 4, 1]),
+                          (4, 6, [2]), (5, 5, [])])
+def test_sealed_series_rate_chunks(tmp_path, start, stop, expected_lengths):
+    series = make_sealed_series(tmp_path)
+    chunks = [chunk for chunk in series.rate_chunks(start, stop)
+              if len(chunk)]
+    assert [len(chunk) for chunk in chunks] == expected_lengths
+    assert [rate for chunk in chunks for rate in chunk] == \
+        series.rates(start, stop)
+
+
+@pytest.mark.parametrize("epoch_ms, expected_sealed, expected_files",
+                         [(9500, 7, 2), (7500, 7, 2), (5500, 3, 1),
+                          (500, 0, 0)])
+def test_sealed_series_late_reading(tmp_path, epoch_ms, expected_sealed,
+                                    expected_files):
+    series = make_sealed_series(tmp_path)
+    expected = sorted(series.times() + [epoch_ms])
+    series.append(100, epoch_ms)
+    assert series.times() == expected
+    assert series.sealed == expected_sealed
+    assert series.total == sum(series.rates())
+    assert len(list(tmp_path.iterdir())) == expected_files
+
+
+def test_sealed_series_appends_after_sealing_everything(tmp_path):
+    series = make_sealed_series(tmp_path, count=4, sizes=(4,))
+    assert series.resident == 0
+    assert series.last_reading() == (81, "1970-01-01 00:00:03")
+    series.extend([90, 95], [5000, 6000])
+    assert series.rates() == [60, 67, 74, 81, 90, 95]
+    assert series.average_from(3) == (81 + 90 + 95) / 3
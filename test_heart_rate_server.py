@@ -8,7 +8,10 @@ from datetime import datetime
                           (2, 150, False),
                           (18, 120, True),
                           (5, 5, False),
-                          (9, 135, True)])
+                          (9, 135, True),
+                          (0, 170, True),
+                          (3, 140, True),
+                          (12, 125, True)])
 def test_is_tachycardic(age, hr, expected):
     from heart_rate_server import is_tachycardic
     answer = is_tachycardic(age, hr)
@@ -140,7 +143,10 @@ def test_verify_new_patient_info(data, expected):
                            "patient_id key not found in input"),
                           ({'patient_id': 'One',
                             'heart_rate': '100'},
-                           'patient_id value is not the correct type')])
+                           'patient_id value is not the correct type'),
+                          ({'patient_id': 1,
+                            'heart_rate': 100.5},
+                           'heart_rate value is not the correct type')])
 def test_verify_heart_rate_post(data, expected):
     from heart_rate_server import verify_heart_rate_post
     answer = verify_heart_rate_post(data)
@@ -201,8 +207,7 @@ def test_add_heart_rate_to_patient_db(hr_info, timestamp, db, expected):
                              "attending_email": "canyon@duke.edu",
                              "attending_phone": "919-200-8973",
                              "patients": [20]}],
-                           'E-mail sent to canyon@duke.edu'
-                           ' from warning@hrsentinalserver.com'),
+                           'Tachycardia alert queued for canyon@duke.edu'),
                           ([201, 200], '2018-03-09 11:00:36',
                            [{"patient_id": 201,
                              "attending_username": 'Duncan.C',
@@ -212,10 +217,13 @@ def test_add_heart_rate_to_patient_db(hr_info, timestamp, db, expected):
                              "attending_email": "",
                              "attending_phone": "919-200-8973",
                              "patients": [201]}],
-                           "'to_email' is not a correct e-mail address")
+                           "Tachycardia alert queued for ")
                           ])
-def test_check_heart_rate(hr_info, timestamp, pat_db, att_db, expected):
-    from heart_rate_server import check_heart_rate, patient_db, attendant_db
+def test_check_heart_rate(hr_info, timestamp, pat_db, att_db, expected,
+                          monkeypatch):
+    from heart_rate_server import (check_heart_rate, patient_db,
+                                   attendant_db, alert_dispatcher)
+    monkeypatch.setattr(alert_dispatcher, "deliver", lambda email: True)
     for attendant in att_db:
         attendant_db.append(attendant)
     for patient in pat_db:
@@ -311,13 +319,46 @@ def test_find_patient(patient_id, db, expected):
                                     "patient_age": 21,
                                     "heart_rate": [100, 120, 140],
                                     "timestamp": list(), "status": ""}],
-                           ('Patient not found', 400))])
+                           ('Patient not found', 400)),
+                          ('109', [{"patient_id": 109,
+                                    "attending_username": 'Therien.A',
+                                    "patient_age": 21,
+                                    "heart_rate": [],
+                                    "timestamp": list(), "status": ""}],
+                           ('No heart rate data for patient', 400))])
 def test_get_patient_average_heart_rate(patient_id, db, expected):
     from heart_rate_server import get_patient_average_heart_rate
     answer = get_patient_average_heart_rate(patient_id, db)
     assert answer == expected
 
 
+@pytest.mark.parametrize("patient_id, db, expected",
+                         [('110', [{"patient_id": 110,
+                                    "attending_username": 'Therien.A',
+                                    "patient_age": 21,
+                                    "heart_rate": [100, 120, 80],
+                                    "timestamp": ['2020-03-09 11:00:36',
+                                                  '2020-03-09 11:00:37',
+                                                  '2020-03-09 11:00:38'],
+                                    "status": "not tachycardic"}],
+                           {"patient_id": 110, "count": 3, "average": 100,
+                            "min": 80, "max": 120, "last_heart_rate": 80,
+                            "last_time": '2020-03-09 11:00:38'}),
+                          (111, [{"patient_id": 111,
+                                  "attending_username": 'Therien.A',
+                                  "patient_age": 21, "heart_rate": [],
+                                  "timestamp": [], "status": ""}],
+                           {"patient_id": 111, "count": 0, "average": None,
+                            "min": None, "max": None,
+                            "last_heart_rate": None, "last_time": None}),
+                          (112, [], ('Patient not found', 400))])
+def test_get_patient_summary(patient_id, db, expected):
+    from heart_rate_server import get_patient_summary
+    from heart_rate_database import PatientStore
+    answer = get_patient_summary(patient_id, PatientStore(db))
+    assert answer == expected
+
+
 def test_current_time():
     from heart_rate_server import current_time
     time_input = datetime(2018, 3, 9, 11, 0, 36)
@@ -345,6 +386,26 @@ def test_find_physician_email(patient_id, db, expected):
     assert answer == expected
 
 
+@pytest.mark.parametrize("hr_info, timestamp, expected",
+                         [([20, 200], '2018-03-09 11:00:36',
+                           {"from_email": "warning@hrsentinalserver.com",
+                            "to_email": "canyon@duke.edu",
+                            "subject": "PATIENT 20 HAS TACHYCARDIA",
+                            "content": "Your patient with the patient_id "
+                                       "number 20 had a tachycardic heart "
+                                       "rate of 200 at the date/time "
+                                       "2018-03-09 11:00:36"}),
+                          ([999, 200], '2018-03-09 11:00:36', False)])
+def test_build_email(hr_info, timestamp, expected):
+    from heart_rate_server import build_email, attendant_db
+    attendant_db.append({"attending_username": "Canyon.D",
+                         "attending_email": "canyon@duke.edu",
+                         "attending_phone": "919-200-8973",
+                         "patients": [20]})
+    answer = build_email(hr_info, timestamp)
+    assert answer == expected
+
+
 @pytest.mark.parametrize("patient_id, db, expected",
                          [(1002, [{"patient_id": 1000,
                                    "attending_username": 'Therien.A',
@@ -430,11 +491,22 @@ def test_get_patient_status(patient_id, db, expected):
                           ("2018-03-09 11:00:36",
                            ["2018-03-09 11:00:16", "2018-03-09 11:00:26",
                             "2018-03-09 11:00:36"],
-                           2)])
+                           2),
+                          ("2018-03-09 11:00:37",
+                           ["2018-03-09 11:00:16", "2018-03-09 11:00:36"],
+                           "Time out of bounds"),
+                          ("2018-03-09 11:00:36", [], "Time out of bounds"),
+                          ("March 9th", ["2018-03-09 11:00:36"],
+                           "heart_rate_average_since must be in "
+                           "%Y-%m-%d %H:%M:%S format")])
 def test_find_first_time(time, times, expected):
     from heart_rate_server import find_first_time
+    from heart_rate_series import HeartRateSeries
     answer = find_first_time(time, times)
     assert answer == expected
+    series = HeartRateSeries([60] * len(times), times)
+    answer = find_first_time(time, series.timestamp)
+    assert answer == expected
 
 
 @pytest.mark.parametrize("attending_username, db, expected",
@@ -577,3 +649,676 @@ def test_verify_internal_average(in_dict, expected):
     from heart_rate_server import verify_internal_average
     answer = verify_internal_average(in_dict)
     assert answer == expected
+
+
+@pytest.mark.parametrize("records, expected_groups, expected_results",
+                         [([{"patient_id": 1, "heart_rate": 70},
+                            {"patient_id": "1", "heart_rate": "80",
+                             "timestamp": "2018-03-09 11:00:30"},
+                            {"patient_id": 2, "heart_rate": 90}],
+                           {1: [(0, 70, "2018-03-09 11:00:36"),
+                                (1, 80, "2018-03-09 11:00:30")],
+                            2: [(2, 90, "2018-03-09 11:00:36")]},
+                           [None, None, None]),
+                          ([{"patient_id": 1}, 5,
+                            {"patient_id": 1, "heart_rate": 70000},
+                            {"patient_id": 1, "heart_rate": 70,
+                             "timestamp": "noon"}],
+                           {},
+                           [{"stored": False, "error":
+                             "heart_rate key not found in input"},
+                            {"stored": False, "error":
+                             "reading is not a dictionary"},
+                            {"stored": False, "patient_id": 1, "error":
+                             "heart_rate value is not a valid heart rate"},
+                            {"stored": False, "patient_id": 1, "error":
+                             "timestamp must be in %Y-%m-%d %H:%M:%S "
+                             "format"}])])
+def test_read_heart_rate_batch(records, expected_groups, expected_results):
+    from heart_rate_server import read_heart_rate_batch
+    groups, results = read_heart_rate_batch(records, "2018-03-09 11:00:36")
+    assert groups == expected_groups
+    assert results == expected_results
+
+
+def test_ingest_heart_rate_batch(monkeypatch):
+    from heart_rate_server import (ingest_heart_rate_batch, patient_db,
+                                   attendant_db, alert_dispatcher)
+    monkeypatch.setattr(alert_dispatcher, "deliver", lambda email: True)
+    attendant_db.append({"attending_username": "Batch.B",
+                         "attending_email": "batch@duke.edu",
+                         "attending_phone": "919-200-8973",
+                         "patients": [700]})
+    patient_db.append({"patient_id": 700, "attending_username": "Batch.B",
+                       "patient_age": 30, "heart_rate": list(),
+                       "timestamp": list(), "status": ""})
+    results = ingest_heart_rate_batch(
+        [{"patient_id": 700, "heart_rate": 150,
+          "timestamp": "2018-03-09 11:00:30"},
+         {"patient_id": 700, "heart_rate": 160,
+          "timestamp": "2018-03-09 11:00:31"},
+         {"patient_id": 700, "heart_rate": 80},
+         {"patient_id": 701, "heart_rate": 80}], "2018-03-09 11:00:36")
+    assert [result["stored"] for result in results] == [True, True, True,
+                                                        False]
+    assert [result.get("tachycardic") for result in results] == [True, True,
+                                                                 False, None]
+    assert "alert" not in results[0]
+    assert results[1]["alert"] == "Tachycardia alert queued for " \
+                                  "batch@duke.edu"
+    patient = patient_db.get(700)
+    assert patient["heart_rate"] == [150, 160, 80]
+    assert patient["status"] == "not tachycardic"
+
+
+@pytest.mark.parametrize("body, chunk_size, expected",
+                         [(b'{"a": 1}\n{"b": 2}\n', 4,
+                           [b'{"a": 1}', b'{"b": 2}']),
+                          (b'{"a": 1}\r\n\n{"b": 2}', 3,
+                           [b'{"a": 1}', b'', b'{"b": 2}']),
+                          (b'x' * 20 + b'\n{"a": 1}\n', 8,
+                           [None, b'{"a": 1}']),
+                          (b'x' * 12 + b'\n{"a": 1}\n', 100,
+                           [None, b'{"a": 1}']),
+                          (b'', 8, [])])
+def test_iter_ndjson_lines(body, chunk_size, expected):
+    import io
+    from heart_rate_server import iter_ndjson_lines
+    stream = io.BytesIO(body)
+    answer = list(iter_ndjson_lines(stream, chunk_size, max_line=10))
+    assert answer == expected
+
+
+@pytest.mark.parametrize("in_dict, expected",
+                         [({"patient_id": 800, "heart_rate": 70},
+                           ("Heart rate information is stored", 200)),
+                          ({"patient_id": 800, "heart_rate": 170},
+                           ("Tachycardia alert queued for stream@duke.edu",
+                            200)),
+                          ({"patient_id": 801, "heart_rate": 70},
+                           ("Error in adding heart rate info to database",
+                            400)),
+                          ({"patient_id": 800},
+                           ("heart_rate key not found in input", 400)),
+                          ([800, 70], ("reading is not a dictionary", 400))])
+def test_process_heart_rate(in_dict, expected, monkeypatch):
+    from heart_rate_server import (process_heart_rate, patient_db,
+                                   attendant_db, alert_dispatcher)
+    monkeypatch.setattr(alert_dispatcher, "deliver", lambda email: True)
+    if 800 not in patient_db:
+        attendant_db.append({"attending_username": "Stream.S",
+                             "attending_email": "stream@duke.edu",
+                             "attending_phone": "919-200-8973",
+                             "patients": [800]})
+        patient_db.append({"patient_id": 800,
+                           "attending_username": "Stream.S",
+                           "patient_age": 30, "heart_rate": list(),
+                           "timestamp": list(), "status": ""})
+    answer = process_heart_rate(in_dict, "2018-03-09 11:00:36")
+    assert answer == expected
+
+
+@pytest.mark.parametrize("hr_info, expected_status",
+                         [([900, 80], "not tachycardic"),
+                          ([900, 180], "tachycardic")])
+def test_check_heart_rate_publishes_row(hr_info, expected_status,
+                                        monkeypatch):
+    from heart_rate_server import (check_heart_rate, patient_db,
+                                   alert_dispatcher, patient_events)
+    monkeypatch.setattr(alert_dispatcher, "deliver", lambda email: True)
+    if 900 not in patient_db:
+        patient_db.append({"patient_id": 900,
+                           "attending_username": "Events.E",
+                           "patient_age": 30, "heart_rate": [70],
+                           "timestamp": ["2018-03-09 11:00:36"],
+                           "status": ""})
+    subscription = patient_events.subscribe("Events.E")
+    check_heart_rate(hr_info, "2018-03-09 11:00:36")
+    patient_events.unsubscribe("Events.E", subscription)
+    assert subscription.pop_all(0) == [{"patient_id": 900,
+                                        "last_heart_rate": 70,
+                                        "last_time": "2018-03-09 11:00:36",
+                                        "status": expected_status}]
+
+
+def test_open_storage_restores_databases(tmp_path, monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    for restart in range(3):
+        monkeypatch.setattr(server, "patient_db", PatientStore())
+        monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+        monkeypatch.setattr(server, "storage", None)
+        engine = server.open_storage(str(tmp_path))
+        if restart == 0:
+            server.add_attendant_to_db(["Store.S", "store@duke.edu",
+                                        "919-200-8973"], server.attendant_db)
+            server.add_patient_to_attendant_db([1000, "Store.S", 30],
+                                               server.attendant_db)
+            server.add_patient_to_db([1000, "Store.S", 30])
+            server.process_heart_rate({"patient_id": 1000,
+                                       "heart_rate": 80},
+                                      "2018-03-09 11:00:36")
+            server.ingest_heart_rate_batch(
+                [{"patient_id": 1000, "heart_rate": 170,
+                  "timestamp": "2018-03-09 11:00:37"}], None)
+        elif restart == 1:
+            engine.snapshot()
+        engine.close()
+    patient = server.patient_db.get(1000)
+    assert patient["heart_rate"] == [80, 170]
+    assert patient["status"] == "tachycardic"
+    assert server.attendant_db.get("Store.S")["patients"] == [1000]
+
+
+def test_snapshot_while_ingesting_keeps_every_reading(tmp_path, monkeypatch):
+    import sys
+    import threading
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    from heart_rate_series import format_epoch_ms
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    monkeypatch.setattr(server, "patient_db", PatientStore(stripes=4))
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "storage", None)
+    engine = server.open_storage(str(tmp_path), fsync="none",
+                                 commit_interval=0, snapshot_every=0)
+    patient_ids = list(range(1200, 1208))
+    for patient_id in patient_ids:
+        server.add_patient_to_db([patient_id, "Store.S", 30])
+
+    def ingest(patient_id):
+        for i in range(200):
+            server.add_heart_rates_to_patient_db(
+                patient_id, [60 + i % 50] * 5,
+                [format_epoch_ms(1520593236000 + 1000 * (5 * i + j))
+                 for j in range(5)])
+
+    threads = [threading.Thread(target=ingest, args=(patient_id,))
+               for patient_id in patient_ids]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            engine.snapshot()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    engine.snapshot()
+    engine.close()
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "storage", None)
+    server.open_storage(str(tmp_path)).close()
+    for patient_id in patient_ids:
+        assert len(server.patient_db.get(patient_id)["heart_rate"]) == 1000
+
+
+def test_snapshot_waits_for_patient_lock(tmp_path, monkeypatch):
+    import threading
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "storage", None)
+    engine = server.open_storage(str(tmp_path), snapshot_every=0)
+    server.add_patient_to_db([1300, "Store.S", 30])
+    server.add_heart_rates_to_patient_db(1300, [80], ["2018-03-09 11:00:36"])
+    snapshot = threading.Thread(target=engine.snapshot)
+    with server.patient_lock(1300):
+        snapshot.start()
+        snapshot.join(0.2)
+        assert snapshot.is_alive()
+        server.add_heart_rates_to_patient_db(1300, [90],
+                                             ["2018-03-09 11:00:37"])
+    snapshot.join()
+    engine.close()
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "storage", None)
+    server.open_storage(str(tmp_path)).close()
+    assert server.patient_db.get(1300)["heart_rate"] == [80, 90]
+
+
+def test_open_history_seals_old_heart_rates(tmp_path, monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "history_archive", None)
+    server.add_patient_to_db([1100, "Seal.S", 30])
+    server.add_heart_rates_to_patient_db(
+        1100, [70, 71, 72], ["2018-03-09 11:00:3{}".format(i)
+                             for i in range(3)])
+    server.open_history(str(tmp_path), segment_size=2, keep=1)
+    series = server.patient_db.get(1100)["series"]
+    assert series.sealed == 2
+    for i in range(3, 6):
+        server.add_heart_rate_to_patient_db([1100, 70 + i],
+                                            "2018-03-09 11:00:3{}".format(i))
+    assert series.sealed == 4
+    assert server.get_patient_heart_rates(1100, server.patient_db) == \
+        [70, 71, 72, 73, 74, 75]
+    timestamps = server.patient_db.get(1100)["timestamp"]
+    assert server.find_first_time("2018-03-09 11:00:31", timestamps) == 1
+
+
+def test_open_retention_keeps_average_exact(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "retention_policy", None)
+    server.add_patient_to_db([1200, "Roll.R", 30])
+    server.add_heart_rates_to_patient_db(
+        1200, [60, 70, 80], ["2018-03-09 11:00:00", "2018-03-09 11:01:00",
+                             "2018-03-09 11:02:00"])
+    server.open_retention(60000)
+    server.add_heart_rate_to_patient_db([1200, 90], "2018-03-09 11:03:00")
+    assert server.get_patient_heart_rates(1200, server.patient_db) == \
+        [80, 90]
+    assert server.get_patient_average_heart_rate(1200,
+                                                 server.patient_db) == 75
+    series = server.patient_db.get(1200)["series"]
+    assert series.average_since(server.to_epoch_ms(
+        "2018-03-09 11:01:00")) == 80
+
+
+@pytest.mark.parametrize("args, expected",
+                         [({}, {"since": 0, "skip": 0, "until": None,
+                                "format": "json", "limit": 1000}),
+                          ({"format": "ndjson"},
+                           {"since": 0, "skip": 0, "until": None,
+                            "format": "ndjson", "limit": None}),
+                          ({"since": "1970-01-01 00:00:01",
+                            "until": "1970-01-01 00:00:02", "limit": "5"},
+                           {"since": 1000, "skip": 0, "until": 2000,
+                            "format": "json", "limit": 5}),
+                          ({"cursor": "3000-2"},
+                           {"since": 3000, "skip": 2, "until": None,
+                            "format": "json", "limit": 1000}),
+                          ({"format": "xml"},
+                           "format must be json or ndjson"),
+                          ({"since": "yesterday"},
+                           "since and until must be in %Y-%m-%d %H:%M:%S "
+                           "format"),
+                          ({"cursor": "3000"}, "cursor is not valid"),
+                          ({"limit": "0"},
+                           "limit must be between 1 and 10000"),
+                          ({"limit": "ten"},
+                           "limit must be between 1 and 10000")])
+def test_read_history_args(args, expected):
+    from heart_rate_server import read_history_args
+    answer = read_history_args(args)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("since, skip, until, limit, expected",
+                         [(0, 0, None, None,
+                           ([70, 71, 72, 73, 74], [0, 1000, 1000, 1000,
+                                                   2000], None)),
+                          (0, 0, None, 2,
+                           ([70, 71], [0, 1000], "1000-1")),
+                          (1000, 1, None, 2,
+                           ([72, 73], [1000, 1000], "2000-0")),
+                          (500, 0, 2000, None,
+                           ([71, 72, 73], [1000, 1000, 1000], None)),
+                          (3000, 0, None, 5, ([], [], None))])
+def test_read_history_page(since, skip, until, limit, expected):
+    from heart_rate_server import read_history_page
+    from heart_rate_series import HeartRateSeries
+    series = HeartRateSeries([70, 71, 72, 73, 74],
+                             [0, 1000, 1000, 1000, 2000])
+    answer = read_history_page(series, since, skip, until, limit)
+    assert answer == expected
+
+
+def test_history_rows():
+    from heart_rate_server import history_rows
+    answer = history_rows([70], [1000])
+    assert answer == [{"heart_rate": 70,
+                       "timestamp": "1970-01-01 00:00:01"}]
+
+
+def test_bump_patient_version(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    server.add_attendant_to_db(["Tag.T", "tag@duke.edu", "919-200-8973"],
+                               server.attendant_db)
+    server.add_patient_to_attendant_db([1300, "Tag.T", 30],
+                                       server.attendant_db)
+    server.add_patient_to_db([1300, "Tag.T", 30])
+    assert server.attendant_db.version("Tag.T") == 1
+    server.add_heart_rate_to_patient_db([1300, 80], "2018-03-09 11:00:36")
+    server.update_patient_status(server.patient_db.get(1300), False)
+    assert server.patient_db.version(1300) == 2
+    assert server.attendant_db.version("Tag.T") == 3
+
+
+def test_set_tachycardia_bands_rescores_patients(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "tachycardia_table",
+                        server.tachycardia_table)
+    server.add_attendant_to_db(["Tag.T", "tag@duke.edu", "919-200-8973"],
+                               server.attendant_db)
+    for patient_id, rate in ((1, 95), (2, 110), (3, None)):
+        server.add_patient_to_attendant_db([patient_id, "Tag.T", 30],
+                                           server.attendant_db)
+        server.add_patient_to_db([patient_id, "Tag.T", 30])
+        if rate is not None:
+            server.add_heart_rate_to_patient_db([patient_id, rate],
+                                                "2018-03-09 11:00:36")
+    assert server.rescore_patients() == 2
+    assert [server.patient_db.get(i)["status"] for i in (1, 2, 3)] == \
+        ["not tachycardic", "tachycardic", ""]
+    server.set_tachycardia_bands([(0, 150), (16, 90)])
+    assert server.is_tachycardic(30, 95) is True
+    assert [row["status"] for row in server.get_roster("Tag.T")] == \
+        ["tachycardic", "tachycardic", ""]
+
+
+@pytest.mark.parametrize("if_none_match, etag, expected_code",
+                         [(None, "abc-1", 200),
+                          ('"abc-1"', "abc-1", 304),
+                          ('"abc-0", "abc-1"', "abc-1", 304),
+                          ('"abc-0"', "abc-1", 200),
+                          ("*", "abc-1", 304),
+                          ('"abc-1"', None, 200)])
+def test_conditional_json(if_none_match, etag, expected_code):
+    from heart_rate_server import app, conditional_json
+    headers = dict()
+    if if_none_match is not None:
+        headers["If-None-Match"] = if_none_match
+    built = list()
+
+    def build():
+        built.append(True)
+        return {"status": "tachycardic"}
+
+    with app.test_request_context(headers=headers):
+        response = conditional_json(etag, build)
+    assert response.status_code == expected_code
+    assert bool(built) == (expected_code == 200)
+    if etag is not None:
+        assert response.headers["ETag"] == '"{}"'.format(etag)
+
+
+def test_roster_follows_readings(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    server.add_attendant_to_db(["Roster.R", "roster@duke.edu",
+                                "919-200-8973"], server.attendant_db)
+    for patient_id in (1401, 1400):
+        server.add_patient_to_attendant_db([patient_id, "Roster.R", 30],
+                                           server.attendant_db)
+        server.add_patient_to_db([patient_id, "Roster.R", 30])
+    server.process_heart_rate({"patient_id": 1400, "heart_rate": 170},
+                              "2018-03-09 11:00:36")
+    answer = server.get_roster("Roster.R")
+    assert answer == [{"patient_id": 1401, "last_heart_rate": None,
+                       "last_time": None, "status": ""},
+                      {"patient_id": 1400, "last_heart_rate": 170,
+                       "last_time": "2018-03-09 11:00:36",
+                       "status": "tachycardic"}]
+    assert answer == server.patients_for_attending_username([1401, 1400])
+
+
+def test_roster_covers_patients_added_as_list_items(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    server.attendant_db.append({"attending_username": "List.L",
+                                "attending_email": "list@duke.edu",
+                                "attending_phone": "919-200-8973",
+                                "patients": [1450, 1451]})
+    server.patient_db.append({"patient_id": 1450,
+                              "attending_username": "List.L",
+                              "patient_age": 30, "heart_rate": [70, 180],
+                              "timestamp": ["2018-03-09 11:00:36",
+                                            "2018-03-09 11:00:37"],
+                              "status": "tachycardic"})
+    server.patient_db.append({"patient_id": 1451,
+                              "attending_username": "List.L",
+                              "patient_age": 30, "heart_rate": [],
+                              "timestamp": [], "status": ""})
+    expected = server.patients_for_attending_username([1450, 1451])
+    assert expected[0]["last_heart_rate"] == 180
+    assert server.get_roster("List.L") == expected
+    client = server.app.test_client()
+    r = client.get("/api/patients/List.L")
+    assert r.get_json() == expected
+
+
+def test_concurrent_heart_rates_stay_consistent(tmp_path, monkeypatch):
+    import sys
+    import threading
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore, AttendantRegistry
+    monkeypatch.setattr(server, "patient_db", PatientStore(stripes=4))
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True,
+                                               maxsize=100000))
+    monkeypatch.setattr(server, "storage", None)
+    engine = server.open_storage(str(tmp_path), fsync="none",
+                                 commit_interval=0, snapshot_every=0)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    server.add_attendant_to_db(["Stress.S", "stress@duke.edu",
+                                "919-200-8973"], server.attendant_db)
+    patients = list(range(1500, 1508))
+    for patient_id in patients:
+        server.add_patient_to_attendant_db([patient_id, "Stress.S", 30],
+                                           server.attendant_db)
+        server.add_patient_to_db([patient_id, "Stress.S", 30])
+    threads_count, rounds = 8, 150
+    timestamp = "2018-03-09 11:00:36"
+
+    def post(worker):
+        for i in range(rounds):
+            patient_id = patients[(worker + i) % len(patients)]
+            heart_rate = 60 + (worker * 37 + i * 11) % 140
+            if i % 3:
+                server.process_heart_rate({"patient_id": patient_id,
+                                           "heart_rate": heart_rate},
+                                          timestamp)
+            else:
+                server.ingest_heart_rate_batch(
+                    [{"patient_id": patient_id, "heart_rate": heart_rate},
+                     {"patient_id": patient_id,
+                      "heart_rate": heart_rate + 1}], timestamp)
+
+    threads = [threading.Thread(target=post, args=(worker,))
+               for worker in range(threads_count)]
+    try:
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            engine.snapshot()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+        engine.close()
+    expected = threads_count * (rounds + len(range(0, rounds, 3)))
+    stored = 0
+    for patient_id in patients:
+        patient = server.patient_db.get(patient_id)
+        series = patient["series"]
+        stored += len(series)
+        assert series.appended == len(series)
+        assert series.total == sum(series.rates())
+        latest = series.rate_at(-1)
+        expected_status = "tachycardic" if server.is_tachycardic(
+            30, latest) else "not tachycardic"
+        assert patient["status"] == expected_status
+        assert server.get_patient_status(patient_id) == {
+            "heart_rate": latest, "status": expected_status,
+            "timestamp": timestamp}
+    assert stored == expected
+    roster = server.get_roster("Stress.S")
+    assert [row["patient_id"] for row in roster] == patients
+    assert roster == server.patients_for_attending_username(patients)
+    live = [server.patient_db.get(patient_id) for patient_id in patients]
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    monkeypatch.setattr(server, "storage", None)
+    server.open_storage(str(tmp_path)).close()
+    for patient in live:
+        recovered = server.patient_db.get(patient["patient_id"])
+        assert list(recovered["series"].rates()) == \
+            list(patient["series"].rates())
+        assert recovered["series"].appended == patient["series"].appended
+        assert recovered["status"] == patient["status"]
+
+
+@pytest.mark.parametrize("codec", ["json", "orjson"])
+@pytest.mark.parametrize("history_page", [2, 1000])
+def test_heart_rate_list_matches_codecs(codec, history_page, tmp_path,
+                                        monkeypatch):
+    import json
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore
+    from json_codec import available_codecs
+    if codec not in available_codecs():
+        pytest.skip("orjson is not installed")
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "history_archive", None)
+    monkeypatch.setattr(server, "HISTORY_PAGE", history_page)
+    monkeypatch.setattr(server.app.json, "codec", server.app.json.codec)
+    server.set_json_codec(codec)
+    server.add_patient_to_db([1500, "Codec.C", 30])
+    rates = [60 + i for i in range(7)]
+    server.add_heart_rates_to_patient_db(
+        1500, rates, ["2018-03-09 11:00:3{}".format(i) for i in range(7)])
+    server.open_history(str(tmp_path), segment_size=2, keep=1)
+    client = server.app.test_client()
+    response = client.get("/api/heart_rate/1500")
+    assert response.data == json.dumps(rates,
+                                       separators=(",", ":")).encode() + b"\n"
+    response = client.get("/api/heart_rate/1500?format=ndjson&limit=3")
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert [line["heart_rate"] for line in lines[:-1]] == rates[:3]
+    assert list(lines[-1]) == ["next_cursor"]
+    response = client.get("/api/heart_rate/1501")
+    assert response.get_json() == ["Patient not found", 400]
+
+
+def test_heart_rate_stream_acks_use_codec(monkeypatch):
+    import heart_rate_server as server
+    from heart_rate_database import PatientStore
+    from json_codec import StdlibCodec
+    written = list()
+
+    class RecordingCodec(StdlibCodec):
+        def dumps(self, obj):
+            written.append(obj)
+            return super().dumps(obj)
+
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "history_archive", None)
+    monkeypatch.setattr(server.app.json, "codec", RecordingCodec())
+    server.add_patient_to_db([1550, "Codec.C", 30])
+    client = server.app.test_client()
+    response = client.post("/api/heart_rate/stream",
+                           data=b'{"patient_id": 1550, "heart_rate": 70}\n'
+                                b"{bad\n")
+    assert response.data.splitlines()[-1] == b'{"rejected":1,"stored":1}'
+    assert written == [{"line": 1, "status_code": 200,
+                        "message": "Heart rate information is stored"},
+                       {"line": 2, "status_code": 400,
+                        "message": "line is not valid JSON"},
+                       {"stored": 1, "rejected": 1}]
+
+
+def test_ingest_binary_records(monkeypatch):
+    import heart_rate_server as server
+    from binary_ingest import pack_records
+    from heart_rate_database import PatientStore, AttendantRegistry
+    from heart_rate_series import to_epoch_ms
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "attendant_db", AttendantRegistry())
+    emails = list()
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(emails.append))
+    server.add_attendant_to_db(["Binary.B", "binary@duke.edu",
+                                "919-200-8973"], server.attendant_db)
+    server.add_patient_to_attendant_db([1600, "Binary.B", 30],
+                                       server.attendant_db)
+    server.add_patient_to_db([1600, "Binary.B", 30])
+    data = pack_records([(1600, 170, to_epoch_ms("2018-03-09 11:00:37")),
+                         (1601, 80, 0),
+                         (1600, 90, 0),
+                         (1600, 80, to_epoch_ms("2018-03-09 11:00:36"))])
+    answer = server.ingest_binary_records(data, "2018-03-09 11:00:40")
+    assert answer == {"stored": 3, "rejected": 1, "tachycardic": 1,
+                      "errors": [{"patient_id": 1601, "readings": 1,
+                                  "error": "Error in adding heart rate "
+                                           "info to database"}]}
+    patient = server.patient_db.get(1600)
+    assert patient["heart_rate"] == [80, 170, 90]
+    assert patient["timestamp"][-1] == "2018-03-09 11:00:40"
+    assert patient["status"] == "not tachycardic"
+    server.alert_dispatcher.join()
+    assert "2018-03-09 11:00:37" in emails[0]["content"]
+    with pytest.raises(ValueError):
+        server.ingest_binary_records(data[:-1], "2018-03-09 11:00:40")
+
+
+@pytest.mark.parametrize("content_type, body, expected_code",
+                         [("application/octet-stream", 16, 200),
+                          ("application/octet-stream", 15, 400),
+                          ("application/json", 16, 400)])
+def test_post_heart_rate_binary(content_type, body, expected_code,
+                                monkeypatch):
+    import heart_rate_server as server
+    from binary_ingest import pack_records
+    from heart_rate_database import PatientStore
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    server.add_patient_to_db([1700, "Binary.B", 30])
+    data = pack_records([(1700, 75, 0)])[:body]
+    r = server.app.test_client().post("/api/heart_rate/binary", data=data,
+                                      content_type=content_type)
+    assert r.status_code == expected_code
+    if expected_code == 200:
+        assert r.get_json()["stored"] == 1
+        assert server.patient_db.get(1700)["heart_rate"] == [75]
+
+
+def test_open_binary_listener(monkeypatch):
+    import heart_rate_server as server
+    from binary_ingest import pack_records, send_records
+    from heart_rate_database import PatientStore
+    monkeypatch.setattr(server, "patient_db", PatientStore())
+    monkeypatch.setattr(server, "binary_listener", None)
+    monkeypatch.setattr(server, "alert_dispatcher",
+                        server.AlertDispatcher(lambda email: True))
+    server.add_patient_to_db([1800, "Binary.B", 30])
+    listener = server.open_binary_listener(port=0)
+    try:
+        answer = send_records("127.0.0.1", listener.server_address[1],
+                              pack_records([(1800, 60 + i, 1000 * i)
+                                            for i in range(1, 101)]))
+    finally:
+        listener.shutdown()
+        listener.server_close()
+    assert answer == (100, 0)
+    assert server.patient_db.get(1800)["heart_rate"] == \
+        list(range(61, 161))
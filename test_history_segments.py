@@ -0,0 +1,100 @@
+import pytest
+
+
+def make_columns(count):
+    from array import array
+    from itertools import accumulate
+    rates = array('H', [60 + i % 50 for i in range(count)])
+    times = array('q', [1000 * i for i in range(count)])
+    prefix = array('q', accumulate(rates, initial=500))
+    return rates, times, prefix
+
+
+@pytest.mark.parametrize("count", [1, 3, 10])
+def test_sealed_segment_round_trip(tmp_path, count):
+    import os
+    from history_segments import SealedSegment
+    rates, times, prefix = make_columns(count)
+    path = str(tmp_path / "1-000000000000.seg")
+    segment = SealedSegment.write(path, rates, times, prefix)
+    assert len(segment) == count
+    assert segment.rates.tolist() == rates.tolist()
+    assert segment.times.tolist() == times.tolist()
+    assert segment.prefix.tolist() == prefix.tolist()
+    assert segment.first_time == 0
+    assert segment.last_time == 1000 * (count - 1)
+    segment.close(remove=True)
+    assert not os.path.exists(path)
+
+
+def test_sealed_segment_rejects_other_files(tmp_path):
+    from history_segments import SealedSegment
+    path = tmp_path / "other.seg"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        SealedSegment(str(path))
+
+
+def test_sealed_segment_rejects_uneven_columns(tmp_path):
+    from history_segments import SealedSegment
+    rates, times, prefix = make_columns(3)
+    with pytest.raises(ValueError):
+        SealedSegment.write(str(tmp_path / "a.seg"), rates, times[:2],
+                            prefix)
+
+
+@pytest.mark.parametrize("readings, expected_sealed",
+                         [(5, 0), (6, 4), (13, 11)])
+def test_history_archive_maybe_seal(tmp_path, readings, expected_sealed):
+    from history_segments import HistoryArchive
+    from heart_rate_series import HeartRateSeries
+    (tmp_path / "stale.seg").write_bytes(b"old")
+    archive = HistoryArchive(str(tmp_path), segment_size=4, keep=2)
+    assert not (tmp_path / "stale.seg").exists()
+    series = HeartRateSeries()
+    series.extend(*make_columns(readings)[:2])
+    archive.maybe_seal(7, series)
+    assert series.sealed == expected_sealed
+    assert series.resident == readings - expected_sealed
+    assert len(series) == readings
+
+
+def test_segments_stay_within_open_map_limit(tmp_path, monkeypatch):
+    import os
+    from history_segments import SealedSegment, segment_maps
+    monkeypatch.setattr(segment_maps, "limit", 2)
+    rates, times, prefix = make_columns(5)
+    fds = len(os.listdir("/proc/self/fd"))
+    segments = [SealedSegment.write(str(tmp_path / "{}.seg".format(i)),
+                                    rates, times, prefix)
+                for i in range(20)]
+    assert len(os.listdir("/proc/self/fd")) <= fds + 2
+    assert sum(segment._columns is not None for segment in segments) == 2
+    for segment in segments:
+        assert segment.rates.tolist() == rates.tolist()
+        assert segment.last_time == 4000
+    assert len(os.listdir("/proc/self/fd")) <= fds + 2
+    segments[0].discard()
+    assert segments[0].prefix.tolist() == prefix.tolist()
+    for segment in segments[1:]:
+        segment.close(remove=True)
+    assert segments[0].times.tolist() == times.tolist()
+
+
+def test_history_archive_keeps_readings_if_sealing_fails(tmp_path,
+                                                         monkeypatch):
+    import errno
+    from history_segments import HistoryArchive, SealedSegment
+    from heart_rate_series import HeartRateSeries
+
+    def no_descriptors(*args):
+        raise OSError(errno.EMFILE, "Too many open files")
+
+    monkeypatch.setattr(SealedSegment, "write", no_descriptors)
+    archive = HistoryArchive(str(tmp_path), segment_size=4, keep=2)
+    series = HeartRateSeries()
+    rates, times = make_columns(8)[:2]
+    series.extend(rates, times)
+    assert archive.maybe_seal(7, series) is None
+    assert series.sealed == 0
+    assert series.heart_rate == rates.tolist()
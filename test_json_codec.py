@@ -0,0 +1,77 @@
+import pytest
+from array import array
+
+CODEC_NAMES = ["json", "orjson"]
+
+
+def make_codec(name):
+    from json_codec import get_codec
+    if name == "orjson":
+        pytest.importorskip("orjson")
+    return get_codec(name)
+
+
+@pytest.mark.parametrize("name", CODEC_NAMES)
+@pytest.mark.parametrize("obj, expected",
+                         [({"b": 1, "a": [1, 2]}, b'{"a":[1,2],"b":1}'),
+                          ("Patient not found", b'"Patient not found"'),
+                          ([], b"[]"),
+                          ({"status": None}, b'{"status":null}')])
+def test_dumps(name, obj, expected):
+    codec = make_codec(name)
+    answer = codec.dumps(obj)
+    assert answer == expected
+    assert codec.loads(answer) == obj
+
+
+@pytest.mark.parametrize("name", CODEC_NAMES)
+@pytest.mark.parametrize("column, expected",
+                         [(array("h", [70, -1, 200]), b"70,-1,200"),
+                          (memoryview(array("q", [1520593236000, 5])),
+                           b"1520593236000,5"),
+                          (array("H", [65535]), b"65535")])
+def test_int_items(name, column, expected):
+    answer = make_codec(name).int_items(column)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("name", CODEC_NAMES)
+@pytest.mark.parametrize("chunks, expected",
+                         [([], b"[]"),
+                          ([array("h")], b"[]"),
+                          ([array("h", [1, 2]), array("h"),
+                            memoryview(array("h", [3]))], b"[1,2,3]")])
+def test_iter_int_array(name, chunks, expected):
+    from json_codec import iter_int_array
+    answer = b"".join(iter_int_array(make_codec(name), chunks))
+    assert answer == expected
+
+
+@pytest.mark.parametrize("name", ["yaml", "ujson"])
+def test_get_codec_unknown(name):
+    from json_codec import get_codec
+    with pytest.raises(ValueError):
+        get_codec(name)
+
+
+def test_get_codec_default():
+    from json_codec import available_codecs, get_codec
+    assert get_codec().name == available_codecs()[0]
+    assert available_codecs()[-1] == "json"
+
+
+@pytest.mark.parametrize("name", CODEC_NAMES)
+def test_codec_json_provider(name):
+    from flask import Flask, jsonify, request
+    from json_codec import CodecJSONProvider
+    app = Flask(__name__)
+    app.json = CodecJSONProvider(app, make_codec(name))
+
+    @app.route("/echo", methods=["POST"])
+    def echo():
+        return jsonify(request.get_json())
+
+    response = app.test_client().post("/echo",
+                                      json={"b": [1, 2], "a": "x"})
+    assert response.data == b'{"a":"x","b":[1,2]}\n'
+    assert response.mimetype == "application/json"
@@ -0,0 +1,55 @@
+import pytest
+
+
+@pytest.mark.parametrize("pushes, expected",
+                         [([(1, "a")], ["a"]),
+                          ([(1, "a"), (2, "b")], ["a", "b"]),
+                          ([(1, "a"), (2, "b"), (1, "c")], ["b", "c"]),
+                          ([], [])])
+def test_subscription_coalesces(pushes, expected):
+    from patient_events import Subscription
+    subscription = Subscription()
+    for key, event in pushes:
+        subscription.push(key, event)
+    answer = subscription.pop_all(timeout=0)
+    assert answer == expected
+    assert subscription.pop_all(timeout=0) == []
+
+
+def test_subscription_wakes_waiting_reader():
+    import threading
+    from patient_events import Subscription
+    subscription = Subscription()
+    timer = threading.Timer(0.05, subscription.push, (1, "a"))
+    timer.start()
+    assert subscription.pop_all(timeout=5) == ["a"]
+
+
+def test_event_broker_fan_out():
+    from patient_events import EventBroker
+    broker = EventBroker()
+    first = broker.subscribe("Canyon.D")
+    second = broker.subscribe("Canyon.D")
+    other = broker.subscribe("Aidan.T")
+    assert broker.subscriber_count("Canyon.D") == 2
+    assert broker.publish("Canyon.D", 1, "row") == 2
+    assert first.pop_all(0) == ["row"]
+    assert second.pop_all(0) == ["row"]
+    assert other.pop_all(0) == []
+    broker.unsubscribe("Canyon.D", first)
+    broker.unsubscribe("Canyon.D", second)
+    broker.unsubscribe("Nobody", second)
+    assert broker.subscriber_count("Canyon.D") == 0
+    assert broker.publish("Canyon.D", 1, "row") == 0
+
+
+def test_subscription_notify():
+    from patient_events import EventBroker
+    calls = list()
+    broker = EventBroker()
+    subscription = broker.subscribe("Canyon.D", lambda: calls.append(1))
+    broker.publish("Canyon.D", 1, "first")
+    broker.publish("Canyon.D", 1, "second")
+    assert calls == [1, 1]
+    assert subscription.pop_all(0) == ["second"]
+    assert subscription.pop_all(0) == []
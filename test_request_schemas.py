@@ -0,0 +1,79 @@
+import pytest
+
+
+@pytest.mark.parametrize("in_dict, expected",
+                         [({"patient_id": 1, "heart_rate": 100}, [1, 100]),
+                          ({"patient_id": "1", "heart_rate": "100"},
+                           [1, 100]),
+                          ({"heart_rate": 100},
+                           "patient_id key not found in input"),
+                          ({"patient_id": 1},
+                           "heart_rate key not found in input"),
+                          ({"patient_id": "One", "heart_rate": 100},
+                           "patient_id value is not the correct type"),
+                          ({"patient_id": 1, "heart_rate": 70.5},
+                           "heart_rate value is not the correct type"),
+                          ({"patient_id": None, "heart_rate": 70},
+                           "patient_id value is not the correct type"),
+                          ({"patient_id": True, "heart_rate": 70},
+                           "patient_id value is not the correct type"),
+                          ({"patient_id": "²", "heart_rate": 70},
+                           "patient_id value is not the correct type"),
+                          ([1, 100], "input is not a dictionary")])
+def test_heart_rate_schema(in_dict, expected):
+    from request_schemas import HEART_RATE
+    assert HEART_RATE(in_dict) == expected
+
+
+@pytest.mark.parametrize("in_dict, expected",
+                         [({"attending_username": "Smith.J",
+                            "attending_email": "smith@duke.edu",
+                            "attending_phone": "919-867-5309"},
+                           ["Smith.J", "smith@duke.edu", "919-867-5309"]),
+                          ({"attending_username": "Smith.J",
+                            "attending_email": 5,
+                            "attending_phone": "919-867-5309"},
+                           "attending_email value is not the correct type"),
+                          ({"attending_username": "Smith.J",
+                            "attending_email": "smith@duke.edu"},
+                           "attending_phone key not found in input")])
+def test_new_attending_schema(in_dict, expected):
+    from request_schemas import NEW_ATTENDING
+    assert NEW_ATTENDING(in_dict) == expected
+
+
+@pytest.mark.parametrize("in_dict, expected",
+                         [({"patient_id": "12", "attending_username": "A.B",
+                            "patient_age": "50"}, [12, "A.B", 50]),
+                          ({"patient_id": 12, "attending_username": 7,
+                            "patient_age": 50},
+                           "attending_username value is not the correct "
+                           "type")])
+def test_new_patient_schema(in_dict, expected):
+    from request_schemas import NEW_PATIENT
+    assert NEW_PATIENT(in_dict) == expected
+
+
+def test_interval_average_schema():
+    from request_schemas import INTERVAL_AVERAGE
+    assert INTERVAL_AVERAGE({"patient_id": "3",
+                             "heart_rate_average_since":
+                             "2018-03-09 11:00:36"}) == \
+        [3, "2018-03-09 11:00:36"]
+
+
+def test_compile_schema():
+    from request_schemas import compile_schema
+    validate = compile_schema([("a", int), ("b", str)], "validate_test")
+    assert validate.__name__ == "validate_test"
+    assert validate.fields == (("a", int), ("b", str))
+    assert validate({"a": 1.0, "b": "x"}) == \
+        "a value is not the correct type"
+    assert validate({"a": "1", "b": "x", "c": None}) == [1, "x"]
+    assert compile_schema([])({}) == []
+
+
+def test_compile_schema_rejects_other_types():
+    from request_schemas import compile_schema
+    with pytest.raises(ValueError):
+        compile_schema([("a", float)])
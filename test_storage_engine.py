@@ -0,0 +1,242 @@
+import pytest
+
+
+def make_engine(directory, **options):
+    from storage_engine import StorageEngine
+    events = list()
+    engine = StorageEngine(str(directory), **options)
+    engine.recover(lambda kind, values: events.append((kind, values)))
+    return engine, events
+
+
+def make_patient(patient_id, rates, times):
+    from heart_rate_series import HeartRateSeries
+    series = HeartRateSeries(rates, times)
+    return {"patient_id": patient_id, "attending_username": "Canyon.D",
+            "patient_age": 30, "status": "not tachycardic",
+            "series": series}
+
+
+@pytest.mark.parametrize("cut, expected",
+                         [(0, [(1, b"first"), (2, b"second")]),
+                          (1, [(1, b"first")]),
+                          (5, [(1, b"first")])])
+def test_decode_records_stops_at_torn_record(cut, expected):
+    from storage_engine import encode_record, decode_records
+    data = encode_record(1, b"first") + encode_record(2, b"second")
+    records, good = decode_records(data[:len(data) - cut])
+    assert records == expected
+    assert good == sum(len(encode_record(*r)) for r in expected)
+
+
+def test_decode_records_rejects_bad_crc():
+    from storage_engine import encode_record, decode_records
+    data = bytearray(encode_record(1, b"first") + encode_record(2, b"x"))
+    data[-5] ^= 0xFF
+    records, good = decode_records(bytes(data))
+    assert records == [(1, b"first")]
+    assert good == len(encode_record(1, b"first"))
+
+
+def test_readings_round_trip():
+    from array import array
+    from storage_engine import encode_readings, decode_readings
+    payload = encode_readings(7, 3, array('H', [70, 80]),
+                              array('q', [1000, 2000]))
+    answer = decode_readings(payload)
+    assert answer == (7, 3, array('H', [70, 80]), array('q', [1000, 2000]))
+
+
+def test_storage_engine_rejects_unknown_policy(tmp_path):
+    from storage_engine import StorageEngine
+    with pytest.raises(ValueError):
+        StorageEngine(str(tmp_path), fsync="sometimes")
+
+
+@pytest.mark.parametrize("fsync", ["always", "interval", "none"])
+def test_storage_engine_replays_log(tmp_path, fsync):
+    from array import array
+    engine, events = make_engine(tmp_path, fsync=fsync)
+    assert events == []
+    engine.log_attendant("Canyon.D", "canyon@duke.edu", "919-200-8973")
+    engine.log_patient(1, "Canyon.D", 30)
+    engine.log_readings(1, 0, [70, 80], [1000, 2000])
+    engine.close()
+    engine, events = make_engine(tmp_path, fsync=fsync)
+    engine.close()
+    assert events == [("attendant", ("Canyon.D", "canyon@duke.edu",
+                                     "919-200-8973")),
+                      ("patient", (1, "Canyon.D", 30, None, None)),
+                      ("readings", (1, 0, array('H', [70, 80]),
+                                    array('q', [1000, 2000])))]
+
+
+def test_storage_engine_snapshot_replaces_log(tmp_path):
+    import os
+    engine, events = make_engine(tmp_path)
+    engine.log_readings(1, 0, [70, 80], [1000, 2000])
+    patient = make_patient(1, [70, 80], [1000, 2000])
+    attendant = {"attending_username": "Canyon.D",
+                 "attending_email": "canyon@duke.edu",
+                 "attending_phone": "919-200-8973", "patients": [1]}
+    engine.snapshot([attendant], [patient])
+    engine.log_readings(1, 2, [90], [3000])
+    engine.close()
+    names = sorted(os.listdir(str(tmp_path)))
+    assert names == ["snapshot-00000001.bin", "wal-00000001.log"]
+    engine, events = make_engine(tmp_path)
+    engine.close()
+    kinds = [kind for kind, values in events]
+    assert kinds == ["attendant", "patient", "readings"]
+    series = events[1][1][4]
+    assert series.heart_rate == [70, 80]
+    assert series.appended == 2
+    assert events[1][1][3] == "not tachycardic"
+    assert events[2][1][1] == 2
+
+
+def test_storage_engine_skips_damaged_snapshot(tmp_path):
+    import os
+    engine, events = make_engine(tmp_path)
+    engine.snapshot([], [make_patient(1, [70], [1000])])
+    engine.close()
+    path = os.path.join(str(tmp_path), "snapshot-00000001.bin")
+    with open(path, "r+b") as f:
+        f.seek(20)
+        f.write(b"\xff")
+    engine, events = make_engine(tmp_path)
+    engine.close()
+    assert events == []
+
+
+def test_storage_engine_snapshots_automatically(tmp_path):
+    engine, events = make_engine(tmp_path, snapshot_every=3)
+    patient = make_patient(1, [], [])
+    engine.snapshot_source = lambda: ([], [patient])
+    for i in range(3):
+        patient["series"].append(70 + i, 1000 * (i + 1))
+        engine.log_readings(1, i, [70 + i], [1000 * (i + 1)])
+    engine.close()
+    engine, events = make_engine(tmp_path)
+    engine.close()
+    assert len(events) == 1
+    assert events[0][1][4].heart_rate == [70, 71, 72]
+
+
+def test_storage_engine_snapshot_keeps_rollups(tmp_path):
+    from heart_rate_rollups import RetentionPolicy
+    engine, events = make_engine(tmp_path)
+    patient = make_patient(1, [70, 80, 90], [0, 60000, 120000])
+    RetentionPolicy(60000).apply(patient["series"])
+    engine.snapshot([], [patient])
+    engine.close()
+    engine, events = make_engine(tmp_path)
+    engine.close()
+    series = events[0][1][4]
+    assert series.heart_rate == [80, 90]
+    assert series.rollups.to_dict() == \
+        patient["series"].rollups.to_dict()
+    assert series.average() == 80
+
+
+@pytest.mark.parametrize("rates, expected",
+                         [([200, 70, 75], (70, 200)),
+                          ([40, 90, 95], (40, 95))])
+def test_storage_engine_snapshot_keeps_rolled_up_extremes(tmp_path, rates,
+                                                          expected):
+    from heart_rate_rollups import RetentionPolicy
+    engine, events = make_engine(tmp_path)
+    patient = make_patient(1, rates, [0, 60000, 120000])
+    RetentionPolicy(60000).apply(patient["series"])
+    assert patient["series"].heart_rate == rates[1:]
+    engine.snapshot([], [patient])
+    engine.close()
+    engine, events = make_engine(tmp_path)
+    engine.close()
+    summary = events[0][1][4].summary()
+    assert (summary["min"], summary["max"]) == expected
+    assert summary == patient["series"].summary()
+
+
+class TornSeries:
+    '''Series whose columns were read at two different moments'''
+
+    rollups = None
+
+    def columns(self):
+        from array import array
+        return array('H', [70, 80]), array('q', [1000]), 2
+
+
+def test_read_snapshot_checks_everything_before_applying(tmp_path):
+    import os
+    from storage_engine import read_snapshot, write_snapshot
+    path = os.path.join(str(tmp_path), "snapshot-00000001.bin")
+    attendant = {"attending_username": "Canyon.D",
+                 "attending_email": "canyon@duke.edu",
+                 "attending_phone": "919-200-8973", "patients": [1, 2]}
+    torn = dict(make_patient(2, [], []), series=TornSeries())
+    write_snapshot(path, 1, [attendant],
+                   [make_patient(1, [70], [1000]), torn])
+    events = list()
+    with pytest.raises(ValueError):
+        read_snapshot(path, lambda kind, values: events.append(kind))
+    assert events == []
+
+
+def test_storage_engine_keeps_old_files_if_snapshot_is_bad(tmp_path):
+    import os
+    engine, events = make_engine(tmp_path)
+    engine.snapshot([], [make_patient(1, [70], [1000])])
+    engine.log_readings(1, 1, [80], [2000])
+    torn = dict(make_patient(2, [], []), series=TornSeries())
+    with pytest.raises(ValueError):
+        engine.snapshot([], [make_patient(1, [70, 80], [1000, 2000]),
+                             torn])
+    engine.close()
+    names = sorted(os.listdir(str(tmp_path)))
+    assert names == ["snapshot-00000001.bin", "wal-00000001.log",
+                     "wal-00000002.log"]
+    engine, events = make_engine(tmp_path)
+    engine.close()
+    assert [kind for kind, values in events] == ["patient", "readings"]
+    assert events[1][1][2].tolist() == [80]
+
+
+def test_storage_engine_snapshots_while_logging_always(tmp_path):
+    import threading
+    engine, events = make_engine(tmp_path, fsync="always", snapshot_every=0)
+    engine.snapshot_source = lambda: ([], [])
+
+    def log(worker):
+        for i in range(100):
+            engine.log_attendant("Log.{}.{}".format(worker, i),
+                                 "log@duke.edu", "919-200-8973")
+
+    threads = [threading.Thread(target=log, args=(worker,))
+               for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        engine.snapshot()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert engine._flusher.is_alive()
+    engine.close()
+
+
+def test_storage_engine_passes_write_errors_to_callers(tmp_path,
+                                                       monkeypatch):
+    import os
+
+    def broken_fsync(fd):
+        raise OSError("disk full")
+
+    engine, events = make_engine(tmp_path, fsync="always")
+    monkeypatch.setattr(os, "fsync", broken_fsync)
+    with pytest.raises(OSError):
+        engine.log_attendant("Log.L", "log@duke.edu", "919-200-8973")
+    with pytest.raises(OSError):
+        engine.log_attendant("Log.M", "log@duke.edu", "919-200-8973")
+    engine.close()
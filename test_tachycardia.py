@@ -0,0 +1,70 @@
+import pytest
+
+
+@pytest.mark.parametrize("age, hr, expected",
+                         [(0, 159, False),
+                          (0, 160, True),
+                          (2, 152, True),
+                          (3, 138, True),
+                          (4, 137, False),
+                          (5, 134, True),
+                          (8, 131, True),
+                          (12, 120, True),
+                          (15, 119, False),
+                          (16, 101, True),
+                          (90, 100, False),
+                          (-1, 160, True)])
+def test_is_tachycardic(age, hr, expected):
+    from tachycardia import TachycardiaTable
+    assert TachycardiaTable().is_tachycardic(age, hr) is expected
+
+
+@pytest.mark.parametrize("bands", [((1, 150), (16, 100)),
+                                   ((0, 150), (16, 100), (10, 120)),
+                                   ()])
+def test_table_rejects_bad_bands(bands):
+    from tachycardia import TachycardiaTable
+    with pytest.raises(ValueError):
+        TachycardiaTable(bands)
+
+
+def test_custom_bands():
+    from tachycardia import TachycardiaTable
+    table = TachycardiaTable([(0, 150), (10, 90)])
+    assert table.limit(9) == 150
+    assert table.limit(10) == 90
+    assert table.limit(200) == 90
+
+
+def test_classify_batch_matches_is_tachycardic():
+    import numpy as np
+    from tachycardia import TachycardiaTable, classify_batch
+    table = TachycardiaTable()
+    ages = np.repeat(np.arange(-2, 30), 200)
+    rates = np.tile(np.arange(0, 200), 32)
+    flags = classify_batch(ages, rates)
+    assert flags.dtype == bool
+    assert flags.tolist() == [table.is_tachycardic(int(age), int(hr))
+                              for age, hr in zip(ages, rates)]
+
+
+def test_classify_batch_broadcasts_one_age():
+    from tachycardia import classify_batch
+    assert classify_batch(20, [90, 101, 120]).tolist() == \
+        [False, True, True]
+    assert classify_batch([], []).tolist() == []
+
+
+@pytest.mark.parametrize("text, expected",
+                         [("0:159,16:100", ((0, 159), (16, 100))),
+                          ("0:150", ((0, 150),))])
+def test_parse_bands(text, expected):
+    from tachycardia import parse_bands
+    assert parse_bands(text) == expected
+
+
+@pytest.mark.parametrize("text", ["0-150", "a:b", ""])
+def test_parse_bands_rejects_bad_text(text):
+    from tachycardia import parse_bands
+    with pytest.raises(ValueError):
+        parse_bands(text)